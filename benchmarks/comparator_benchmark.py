@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    comparator_benchmark
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Measures the temporal storage footprint and the results acceptance
+    time of ResultsComparatorController. Every task is solved by
+    ``THRESHOLD`` nodes, the footprint is measured when all the tasks
+    have the results of all but one node. The legacy implementation
+    (the full results are kept and compared pairwise) is run the same way
+    for comparison.
+
+    Usage: python benchmarks/comparator_benchmark.py [tasks_count]
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from kaylee.project import Project, AUTO_PROJECT_MODE
+from kaylee.node import Node, NodeID
+from kaylee.controller import NO_SOLUTION, NOT_SOLVED
+from kaylee.contrib.controllers import ResultsComparatorController
+from kaylee.contrib.storages import (MemoryTemporalStorage,
+                                     MemoryPermanentStorage)
+from kaylee.errors import NoneResultAssertError
+
+THRESHOLD = 3
+SAMPLES = 1000
+
+
+class SamplesProject(Project):
+    def __init__(self, tasks_count):
+        super(SamplesProject, self).__init__('', AUTO_PROJECT_MODE)
+        self.tasks_count = tasks_count
+        self._task_id = 0
+
+    def __getitem__(self, task_id):
+        return {'id' : str(task_id)}
+
+    def next_task(self):
+        if self._task_id < self.tasks_count:
+            self._task_id += 1
+            return self[self._task_id]
+        return None
+
+    def normalize_result(self, task_id, result):
+        return result
+
+
+class LegacyResultsComparatorController(ResultsComparatorController):
+    # the previous accept_result() implementation
+    def accept_result(self, node, result):
+        if result == NOT_SOLVED:
+            self.notify_tasks_available()
+            return
+
+        task_id = node.task_id
+
+        if result == NO_SOLUTION:
+            norm_result = result
+        else:
+            norm_result = self.project.normalize_result(task_id, result)
+            if norm_result is None:
+                raise NoneResultAssertError(result)
+
+        if not self.temporal_storage.contains(task_id):
+            self.temporal_storage.add(task_id, node.id, norm_result)
+            return
+
+        tmp_results = self.temporal_storage[task_id]
+        if len(tmp_results) == self._results_count_threshold - 1:
+            if self._results_are_equal(norm_result, tmp_results):
+                del self.temporal_storage[task_id]
+                self._tasks_pool.remove(task_id)
+                if result != NO_SOLUTION:
+                    self.store_result(task_id, norm_result)
+            else:
+                del self.temporal_storage[task_id]
+                if result == NO_SOLUTION:
+                    self._tasks_pool.remove(task_id)
+                else:
+                    self.notify_tasks_available()
+            node.task_id = None
+        else:
+            self.temporal_storage.add(task_id, node.id, norm_result)
+
+    @staticmethod
+    def _results_are_equal(r0, res):
+        for r in res.values():
+            if r0 != r:
+                return False
+        return True
+
+
+def measure(cls, count, trace_memory):
+    """Returns the temporal storage footprint (bytes) if trace_memory is
+    set (tracemalloc slows the allocations down), otherwise the amount of
+    results accepted per second."""
+    ctr = cls('app', SamplesProject(count), MemoryPermanentStorage(),
+              MemoryTemporalStorage(), results_count_threshold=THRESHOLD)
+    nodes = [Node(NodeID()) for i in range(THRESHOLD)]
+    for node in nodes:
+        node.subscribe(ctr)
+    rnd = random.Random(0)
+    # every node posts its own copy of the result
+    payloads = [json.dumps({'samples' : [rnd.random()
+                                         for i in range(SAMPLES)]})
+                for i in range(count)]
+    task_ids = [ctr.get_task(nodes[0])['id'] for i in range(count)]
+
+    def accept_results(node):
+        elapsed = 0.0
+        for task_id, payload in zip(task_ids, payloads):
+            node.task_id = task_id
+            result = json.loads(payload)
+            start = time.perf_counter()
+            ctr.accept_result(node, result)
+            elapsed += time.perf_counter() - start
+            del result
+        return elapsed
+
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    elapsed = sum(accept_results(node) for node in nodes[:-1])
+    gc.collect()
+    footprint = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    elapsed += accept_results(nodes[-1])
+    assert len(ctr.permanent_storage) == count
+    return footprint if trace_memory else count * THRESHOLD / elapsed
+
+
+def main(count):
+    print('{} tasks, {} results of {} samples per task'.format(
+        count, THRESHOLD, SAMPLES))
+    print('{:<10} {:>20} {:>16}'.format('controller', 'footprint, KiB',
+                                        'results / s'))
+    for name, cls in [('legacy', LegacyResultsComparatorController),
+                      ('current', ResultsComparatorController)]:
+        footprint = measure(cls, count, True)
+        rate = measure(cls, count, False)
+        print('{:<10} {:>20,.0f} {:>16,.0f}'.format(name, footprint / 1024,
+                                                    rate))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
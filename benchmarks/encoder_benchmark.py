@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    encoder_benchmark
+    ~~~~~~~~~~~~~~~~~
+
+    Compares the precompiled JSON response encoder to encoding the whole
+    response dict per call (the former ``json.dumps``-based encoding).
+
+    Usage: python benchmarks/encoder_benchmark.py [number]
+"""
+import os
+import sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from kaylee.codecs import get_codec, ResponseEncoder
+
+
+def dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def main(number):
+    codec = get_codec('json')
+    precompiled = codec.response_encoder()
+    generic = ResponseEncoder(codec)
+    config = {'AUTO_GET_ACTION' : True, 'LONG_POLL_TIMEOUT' : 0}
+    apps = ['hash_cracker.1', 'monte_carlo_pi.1', 'pi_calc.1']
+    task = {'id' : '12345', 'hash' : 'a6b1c9f4e2d8', 'salt' : 'xyz'}
+    node_id = '5237f8a96b1c0101a00b'
+
+    cases = [
+        ('register',
+         lambda: dumps({'node_id' : node_id, 'config' : config,
+                        'applications' : apps, 'codec' : 'json'}),
+         lambda: generic.register(node_id, config, apps),
+         lambda: precompiled.register(node_id, config, apps)),
+        ('nop',
+         lambda: dumps({'action' : 'nop', 'data' : ''}),
+         lambda: generic.action('nop'),
+         lambda: precompiled.action('nop')),
+        ('task',
+         lambda: dumps({'action' : 'task', 'data' : task}),
+         lambda: generic.action('task', task),
+         lambda: precompiled.action('task', task)),
+        ('unsubscribe',
+         lambda: dumps({'action' : 'unsubscribe', 'data' : 'Completed'}),
+         lambda: generic.action('unsubscribe', 'Completed'),
+         lambda: precompiled.action('unsubscribe', 'Completed')),
+    ]
+
+    print('{:<12} {:>12} {:>12} {:>12} {:>8}'.format(
+        'response', 'dumps, us', 'generic, us', 'compiled, us', 'speedup'))
+    for name, dumps_f, generic_f, precompiled_f in cases:
+        assert json.loads(dumps_f()) == json.loads(precompiled_f())
+        timings = [min(timeit.repeat(f, number=number, repeat=5))
+                   / number * 1e6
+                   for f in (dumps_f, generic_f, precompiled_f)]
+        print('{:<12} {:>12.3f} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(
+            name, timings[0], timings[1], timings[2],
+            timings[0] / timings[2]))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
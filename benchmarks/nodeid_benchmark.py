@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    nodeid_benchmark
+    ~~~~~~~~~~~~~~~~
+
+    Microbenchmarks of the NodeID handling on the path of every request:
+    the registry lookups by a hex node id (as received from the client),
+    NodeID comparisons and the temporal storage access.
+
+    Usage: python benchmarks/nodeid_benchmark.py [nodes_count]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from kaylee.node import Node, NodeID, extract_node_id
+from kaylee.contrib.registries import MemoryNodesRegistry
+from kaylee.contrib.storages import MemoryTemporalStorage
+
+
+def main(count):
+    registry = MemoryNodesRegistry(timeout='30m')
+    node_ids = [NodeID((i).to_bytes(10, 'big')) for i in range(count)]
+    for node_id in node_ids:
+        registry.add(Node(node_id))
+    hex_ids = [str(node_id) for node_id in node_ids]
+    nodes = [registry[node_id] for node_id in node_ids]
+    others = [NodeID(node_id) for node_id in node_ids]
+    storage = MemoryTemporalStorage()
+    for node_id in node_ids[:100]:
+        storage.add('t1', node_id, 'result')
+
+    cases = [
+        ('registry[hex id]',
+         lambda: [registry[h] for h in hex_ids]),
+        ('hex id in registry',
+         lambda: [h in registry for h in hex_ids]),
+        ('registry[NodeID]',
+         lambda: [registry[n] for n in node_ids]),
+        ('extract_node_id(hex id)',
+         lambda: [extract_node_id(h) for h in hex_ids]),
+        ('extract_node_id(node)',
+         lambda: [extract_node_id(n) for n in nodes]),
+        ('NodeID == NodeID',
+         lambda: [a == b for a, b in zip(node_ids, others)]),
+        ('NodeID == hex id',
+         lambda: [a == b for a, b in zip(node_ids, hex_ids)]),
+        ('NodeID < NodeID',
+         lambda: [a < b for a, b in zip(node_ids, others)]),
+        ('temporal_storage[task] (100 results)',
+         lambda: [storage['t1'] for i in range(count // 100)]),
+    ]
+    print('{} operations per case'.format(count))
+    print('{:<38} {:>14}'.format('case', 'ns / op'))
+    for name, case in cases:
+        best = min(timeit.repeat(case, number=1, repeat=5))
+        print('{:<38} {:>14.0f}'.format(name, best / count * 1e9))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    nodeid_stress
+    ~~~~~~~~~~~~~
+
+    Generates millions of NodeIDs concurrently by a number of processes,
+    each running a number of threads, and checks that there are no
+    duplicates. The legacy generator (a 16-bit per-process counter and
+    the remote host hash) is run the same way for comparison.
+
+    Usage: python benchmarks/nodeid_stress.py [ids_per_thread]
+"""
+import os
+import sys
+import time
+import struct
+import hashlib
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from kaylee.node import NodeID
+
+PROCESSES = 4
+THREADS = 4
+
+
+def legacy_generator():
+    # the previous NodeID._generate() implementation
+    state = {'inc' : 0}
+    lock = threading.Lock()
+
+    def generate():
+        nid = struct.pack('>i', int(time.time()))
+        with lock:
+            nid += struct.pack('>i', state['inc'])[2:4]
+            state['inc'] = (state['inc'] + 1) % 0xFFFF
+        nid += hashlib.md5('10.0.0.1'.encode('utf-8')).digest()[0:4]
+        return NodeID.from_binary(nid).binary
+    return generate
+
+
+def current_generator():
+    return lambda: NodeID.for_host('10.0.0.1').binary
+
+
+def run_process(args):
+    generator_name, count = args
+    generate = globals()[generator_name]()
+    chunks = []
+
+    def run_thread():
+        chunks.append(b''.join([generate() for i in range(count)]))
+
+    threads = [threading.Thread(target=run_thread) for i in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return b''.join(chunks)
+
+
+def stress(generator_name, count):
+    ctx = multiprocessing.get_context('fork')
+    start = time.perf_counter()
+    with ctx.Pool(PROCESSES) as pool:
+        blobs = pool.map(run_process, [(generator_name, count)] * PROCESSES)
+    elapsed = time.perf_counter() - start
+    ids = set()
+    total = 0
+    for blob in blobs:
+        for i in range(0, len(blob), 10):
+            ids.add(blob[i:i + 10])
+        total += len(blob) // 10
+    return total, total - len(ids), elapsed
+
+
+def main(count):
+    print('{} processes x {} threads x {} ids'.format(PROCESSES, THREADS,
+                                                      count))
+    print('{:<10} {:>12} {:>12} {:>14}'.format('generator', 'ids',
+                                               'duplicates', 'ids / s'))
+    for name in ('legacy_generator', 'current_generator'):
+        total, duplicates, elapsed = stress(name, count)
+        print('{:<10} {:>12,} {:>12,} {:>14,.0f}'.format(
+            name.split('_')[0], total, duplicates, total / elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 250000)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    registry_memory_benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures the memory occupied by the nodes registries filled with
+    subscribed nodes, each of which solves a task.
+
+    Usage: python benchmarks/registry_memory_benchmark.py [nodes_count]
+"""
+import os
+import sys
+import gc
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from kaylee.node import Node, NodeID
+from kaylee.contrib.registries import MemoryNodesRegistry, ArrayNodesRegistry
+from kaylee.testsuite.helper import TestController
+
+
+def fill(registry, count, controller):
+    for i in range(count):
+        node = Node(NodeID.for_host('10.0.{}.{}'.format(i // 256, i % 256)))
+        node.subscribe(controller)
+        node.task_id = str(i)
+        registry.add(node)
+
+
+def measure(registry_class, count, controller):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    registry = registry_class(timeout='30m')
+    fill(registry, count, controller)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # keep the registry alive until the memory is measured
+    assert len(registry) == count
+    return size, elapsed
+
+
+def main(count):
+    controller = TestController.new_test_instance()
+    print('{} nodes'.format(count))
+    print('{:<22} {:>12} {:>14} {:>10}'.format(
+        'registry', 'memory, MB', 'bytes / node', 'fill, s'))
+    for registry_class in (MemoryNodesRegistry, ArrayNodesRegistry):
+        size, elapsed = measure(registry_class, count, controller)
+        print('{:<22} {:>12.1f} {:>14.0f} {:>10.2f}'.format(
+            registry_class.__name__, size / 2**20, size / count, elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    registry_threads_benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Measures the throughput of the nodes registries accessed by a number
+    of worker threads. Every worker simulates the nodes' requests: a node
+    is added, looked up and updated several times and removed.
+    A registry guarded by a single global lock (which is what a threaded
+    server would require without ShardedNodesRegistry) is compared to
+    ShardedNodesRegistry with 64 shards of the same registry:
+
+    * in-memory: MemoryNodesRegistry. Under the GIL the dict operations
+      are serialized, so both stay flat.
+    * remote: a registry whose every operation waits for a round trip
+      (``LATENCY``) to a remote store, without holding the GIL. The
+      round trips of the different shards overlap.
+
+    Usage: python benchmarks/registry_threads_benchmark.py [ops_per_thread]
+"""
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from kaylee.node import Node, NodeID
+from kaylee.contrib.registries import (MemoryNodesRegistry,
+                                       ShardedNodesRegistry)
+
+
+# the round trip to the remote store, seconds
+LATENCY = 0.0002
+
+
+class RemoteNodesRegistry(MemoryNodesRegistry):
+    """Simulates a registry kept by a remote store: every operation
+    waits for a round trip over a single connection."""
+    def add(self, node):
+        time.sleep(LATENCY)
+        super(RemoteNodesRegistry, self).add(node)
+
+    def update(self, node):
+        time.sleep(LATENCY)
+        super(RemoteNodesRegistry, self).update(node)
+
+    def __delitem__(self, node):
+        time.sleep(LATENCY)
+        super(RemoteNodesRegistry, self).__delitem__(node)
+
+    def __getitem__(self, node_id):
+        time.sleep(LATENCY)
+        return super(RemoteNodesRegistry, self).__getitem__(node_id)
+
+
+class GlobalLockNodesRegistry(object):
+    def __init__(self, registry):
+        self._registry = registry
+        self._lock = threading.Lock()
+
+    def add(self, node):
+        with self._lock:
+            self._registry.add(node)
+
+    def update(self, node):
+        with self._lock:
+            self._registry.update(node)
+
+    def __delitem__(self, node):
+        with self._lock:
+            del self._registry[node]
+
+    def __getitem__(self, node_id):
+        with self._lock:
+            return self._registry[node_id]
+
+
+def worker(registry, node_ids, barrier):
+    barrier.wait()
+    for i, node_id in enumerate(node_ids):
+        registry.add(Node(node_id))
+        for j in range(3):
+            node = registry[node_id]
+            node.task_id = i
+            registry.update(node)
+        del registry[node_id]
+
+
+def measure(registry, threads_count, count):
+    # 1 add + 3 lookups + 3 updates + 1 removal per node
+    ops = 8 * count * threads_count
+    barrier = threading.Barrier(threads_count + 1)
+    # distinct ids are built beforehand, so that only the registry
+    # operations are measured
+    threads = [threading.Thread(target=worker,
+                                args=(registry,
+                                      [NodeID((i * count + j).to_bytes(10,
+                                                                       'big'))
+                                       for j in range(count)],
+                                      barrier))
+               for i in range(threads_count)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    return ops / (time.perf_counter() - start)
+
+
+def main(count):
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print('{} CPUs, GIL {}'.format(os.cpu_count(),
+                                   'enabled' if gil else 'disabled'))
+    # the remote round trips take much longer than the dict operations
+    for name, cls, ops_count in [('in-memory', MemoryNodesRegistry, count),
+                                 ('remote', RemoteNodesRegistry,
+                                  max(count // 100, 1))]:
+        print()
+        print('{}: {} operations per thread'.format(name, 8 * ops_count))
+        print('{:>8} {:>20} {:>20}'.format('threads', 'global lock, op/s',
+                                           'sharded, op/s'))
+        for threads_count in (1, 2, 4, 8, 16):
+            locked = measure(GlobalLockNodesRegistry(cls(timeout='30m')),
+                             threads_count, ops_count)
+            sharded = measure(ShardedNodesRegistry(timeout='30m', shards=64,
+                                                   shard_factory=cls),
+                              threads_count, ops_count)
+            print('{:>8} {:>20,.0f} {:>20,.0f}'.format(threads_count, locked,
+                                                       sharded))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    session_benchmark
+    ~~~~~~~~~~~~~~~~~
+
+    Measures the throughput of ClientSessionDataManager: every task is
+    stored (the session data is encrypted and attached to the task) and
+    restored from the result. The legacy implementation (AES-CBC with
+    space padding, HMAC-SHA1, the keys derived per task) and
+    SignedSessionDataManager (the session data is signed, not encrypted)
+    are run the same way for comparison. The legacy implementation
+    requires pycryptodome (the AES library used by the previous versions).
+
+    Usage: python benchmarks/session_benchmark.py [tasks_count]
+"""
+import os
+import sys
+import time
+import random
+import pickle
+from base64 import b64encode, b64decode
+from hmac import new as hmac
+from hashlib import sha1, sha256
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from Crypto.Cipher import AES
+
+from kaylee.node import Node, NodeID
+from kaylee.session import (ClientSessionDataManager,
+                            SignedSessionDataManager)
+
+
+SECRET_KEY = 'aJD2fn;1340913)*(!!&$)(#&<AHFB12b'
+
+
+def legacy_encrypt(data, secret_key):
+    # the previous _encrypt() implementation
+    bsecret_key = secret_key.encode('utf-8')
+    mac = hmac(bsecret_key, None, sha1)
+    encryption_key = sha256(bsecret_key).digest()
+    iv = bytes(random.randint(0, 0xFF) for i in range(16))
+    encryptor = AES.new(encryption_key, AES.MODE_CBC, iv)
+    val = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    val = val + (32 - len(val) % 32) * b' '
+    encrypted_data = b64encode(encryptor.encrypt(val))
+    mac.update(b'|' + encrypted_data)
+    data_out = (b'&'.join([b64encode(iv), encrypted_data])).decode('utf-8')
+    return '{}?{}'.format(b64encode(mac.digest()).decode('utf-8'), data_out)
+
+
+def legacy_decrypt(s, secret_key):
+    # the previous _decrypt() implementation
+    bsecret_key = secret_key.encode('utf-8')
+    base64_hash, data = s.split('?', 1)
+    mac = hmac(bsecret_key, None, sha1)
+    iv, data = data.split('&', 1)
+    decryptor = AES.new(sha256(bsecret_key).digest(), AES.MODE_CBC,
+                        b64decode(iv))
+    mac.update(b'|' + data.encode('utf-8'))
+    val = decryptor.decrypt(b64decode(data)).rstrip(b' ')
+    if b64decode(base64_hash) != mac.digest():
+        raise ValueError('Encrypted data signature verification failed.')
+    return pickle.loads(val)
+
+
+class LegacyClientSessionDataManager(ClientSessionDataManager):
+    def store(self, node, task):
+        session_data = self.get_session_data(task)
+        if session_data == {}:
+            return
+        task[self.SESSION_DATA_ATTRIBUTE] = legacy_encrypt(session_data,
+                                                           self.secret_key)
+        self.remove_session_data_from_task(session_data.keys(), task)
+
+    def restore(self, node, result):
+        if self.SESSION_DATA_ATTRIBUTE not in result:
+            return
+        sd = legacy_decrypt(result.pop(self.SESSION_DATA_ATTRIBUTE),
+                            self.secret_key)
+        result.update(sd)
+
+
+def measure(manager, count):
+    node = Node(NodeID())
+    attr = manager.SESSION_DATA_ATTRIBUTE
+    start = time.perf_counter()
+    for i in range(count):
+        task = {'id' : str(i), '#n' : i, '#path' : [i, i + 1, i + 2]}
+        manager.store(node, task)
+        result = {'res' : i, attr : task[attr]}
+        manager.restore(node, result)
+    elapsed = time.perf_counter() - start
+    return count / elapsed, len(task[attr])
+
+
+def main(count):
+    print('{} tasks stored and restored'.format(count))
+    print('{:<10} {:>14} {:>20}'.format('manager', 'tasks / s',
+                                        'session data, chars'))
+    for name, manager in [('legacy', LegacyClientSessionDataManager),
+                          ('current', ClientSessionDataManager),
+                          ('signed', SignedSessionDataManager)]:
+        rate, length = measure(manager(SECRET_KEY), count)
+        print('{:<10} {:>14,.0f} {:>20}'.format(name, rate, length))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -25,9 +25,10 @@ from .storage import (TemporalStorage,
                       PermanentStorage )
 from .session import SessionDataManager
 from .controller import Controller
-from .project import Project
+from .project import Project, RangeProject
 from .errors import (KayleeError,
                      InvalidNodeIDError,
+                     InvalidNodeTokenError,
                      NodeNotSubscribedError,
                      InvalidResultError,
                      NodeRequestRejectedError,
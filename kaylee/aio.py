@@ -0,0 +1,639 @@
+# -*- coding: utf-8 -*-
+"""
+    kaylee.aio
+    ~~~~~~~~~~
+
+    This module implements the asyncio counterpart of Kaylee's lower level
+    front-end (:class:`AsyncKaylee`), the interfaces of the awaitable
+    controllers, nodes registries and storages and the adapters which
+    run the synchronous implementations of the latter in a thread pool.
+
+    :copyright: (c) 2013 by Zaur Nasibov.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import time
+import asyncio
+import logging
+from abc import ABCMeta, abstractmethod
+from functools import wraps, partial
+
+from .core import (Kaylee, json_error, ACTION_TASK, ACTION_TASKS,
+                   ACTION_UNSUBSCRIBE, ACTION_NOP, KL_TASK_ID, KL_NODE_ID)
+from .node import Node, NodeID, parse_score
+from .codecs import negotiate
+from .controller import DEFAULT_TASKS_BATCH_LIMIT, KL_TASKS_BATCH_LIMIT
+from .errors import (KayleeError, InvalidResultError, NodeRequestRejectedError,
+                     NodeNotSubscribedError, ApplicationCompletedError)
+
+log = logging.getLogger(__name__)
+
+
+def async_json_error_handler(f):
+    """The coroutine version of :func:`kaylee.core.json_error_handler`."""
+    #pylint: disable-msg=W0703
+    @wraps(f)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await f(*args, **kwargs)
+        except Exception as e:
+            return json_error(e)
+
+    return wrapper
+
+
+class AsyncNodesRegistry(object, metaclass=ABCMeta):
+    """The awaitable counterpart of :class:`NodesRegistry`. Since
+    the special methods cannot be awaited, ``registry[node_id]``,
+    ``del registry[node]``, ``node in registry`` and ``len(registry)``
+    are replaced by :meth:`get`, :meth:`remove`, :meth:`contains` and
+    :meth:`count`.
+
+    The registries must have the ``timeout`` attribute, see
+    :attr:`NodesRegistry.timeout`.
+    """
+    @abstractmethod
+    async def add(self, node):
+        """Adds node to the storage."""
+
+    @abstractmethod
+    async def update(self, node):
+        """Updates previously added "dirty" nodes."""
+
+    @abstractmethod
+    async def clean(self):
+        """Removes the inactive nodes from the storage and returns
+        them (see :meth:`NodesRegistry.clean`)."""
+
+    @abstractmethod
+    async def get(self, node_id):
+        """Returns a node with the requested id."""
+
+    @abstractmethod
+    async def remove(self, node):
+        """Removes the node from the storage."""
+
+    @abstractmethod
+    async def contains(self, node):
+        """Checks if the storage contains the node."""
+
+    @abstractmethod
+    async def count(self):
+        """Returns the amount of nodes in the storage."""
+
+    def bind(self, applications):
+        """Called by :class:`AsyncKaylee` constructor (synchronously)
+        with the loaded applications, see :meth:`NodesRegistry.bind`."""
+
+
+class AsyncTemporalStorage(object, metaclass=ABCMeta):
+    """The awaitable counterpart of :class:`TemporalStorage`.
+    ``storage[task_id]`` is replaced by :meth:`get`."""
+    @abstractmethod
+    async def add(self, task_id, node_id, result):
+        """Stores the task result returned by a node."""
+
+    @abstractmethod
+    async def remove(self, task_id, node_id=None):
+        """Removes the task results from the storage."""
+
+    @abstractmethod
+    async def clear(self):
+        """Removes all results from the storage."""
+
+    @abstractmethod
+    async def get(self, task_id):
+        """Returns the ``{node_id : result, ...}`` task results dict."""
+
+    @abstractmethod
+    async def contains(self, task_id, node_id=None, result=None):
+        """Checks if any of the task results or a result from a node or a
+        particular task result is contained in the storage"""
+
+    @abstractmethod
+    async def count(self):
+        """The amount of the stored results' unique task id's."""
+
+
+class AsyncPermanentStorage(object, metaclass=ABCMeta):
+    """The awaitable counterpart of :class:`PermanentStorage`.
+    ``storage[task_id]`` is replaced by :meth:`get`."""
+    @abstractmethod
+    async def add(self, task_id, result):
+        """Stores the task result."""
+
+    @abstractmethod
+    async def get(self, task_id):
+        """Returns a list of task results."""
+
+    @abstractmethod
+    async def contains(self, task_id, result=None):
+        """Checks if any of the task results or a particular task result
+        is contained in the storage"""
+
+    @abstractmethod
+    async def count(self):
+        """The amount of unique task results in the storage."""
+
+
+class AsyncController(object, metaclass=ABCMeta):
+    """The awaitable counterpart of :class:`Controller`. The
+    implementations must provide the same attributes as the
+    synchronous controllers (``name``, ``project``, ``completed``,
+    ``tasks_batch_limit``) and the following coroutines.
+    """
+    tasks_batch_limit = DEFAULT_TASKS_BATCH_LIMIT
+    completed = False
+
+    def __init__(self):
+        self._tasks_listeners = []
+
+    @abstractmethod
+    async def get_task(self, node):
+        """Returns a task for the node (see :meth:`Controller.get_task`)."""
+
+    @abstractmethod
+    async def accept_result(self, node, result):
+        """Accepts and processes the results from a node (see
+        :meth:`Controller.accept_result`)."""
+
+    async def get_tasks(self, node, count):
+        """Returns a list of at most ``count`` tasks for the node and leases
+        them to the node (see :meth:`Controller.get_tasks`)."""
+        count = max(1, min(count, self.tasks_batch_limit))
+        tasks = []
+        task_ids = []
+        for _ in range(count):
+            try:
+                task = await self.get_task(node)
+            except NodeRequestRejectedError:
+                if not tasks:
+                    raise
+                break
+            if task is None or node.task_id in task_ids:
+                break
+            tasks.append(task)
+            task_ids.append(node.task_id)
+        node.lease_tasks(task_ids)
+        return tasks
+
+    def add_tasks_listener(self, callback):
+        """See :meth:`Controller.add_tasks_listener`."""
+        self._tasks_listeners.append(callback)
+
+    def remove_tasks_listener(self, callback):
+        """See :meth:`Controller.remove_tasks_listener`."""
+        try:
+            self._tasks_listeners.remove(callback)
+        except ValueError:
+            pass
+
+    def notify_tasks_available(self):
+        """See :meth:`Controller.notify_tasks_available`."""
+        for callback in list(self._tasks_listeners):
+            callback()
+
+    async def release_tasks(self, node):
+        """See :meth:`Controller.release_tasks`."""
+
+    async def reissue_due_in(self):
+        """See :meth:`Controller.reissue_due_in`."""
+        return None
+
+    @property
+    def client_config(self):
+        """See :attr:`Controller.client_config`."""
+        config = dict(self.project.client_config)
+        config[KL_TASKS_BATCH_LIMIT] = self.tasks_batch_limit
+        return config
+
+    def __hash__(self):
+        return hash(self.name)
+
+
+class _ThreadPoolAdapter(object):
+    """Runs the calls to the wrapped synchronous object in a thread pool.
+    The calls are serialized, since the wrapped objects are not expected
+    to be thread-safe.
+
+    :param wrapped: the wrapped object.
+    :param executor: an instance of :class:`concurrent.futures.Executor`.
+                     The event loop's default executor is used if ``None``.
+    """
+    def __init__(self, wrapped, executor=None):
+        self.wrapped = wrapped
+        self._executor = executor
+        self._lock = None
+
+    async def _call(self, func, *args):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            return await loop.run_in_executor(self._executor,
+                                              partial(func, *args))
+
+
+class ThreadPoolNodesRegistry(_ThreadPoolAdapter, AsyncNodesRegistry):
+    """Adapts a synchronous :class:`NodesRegistry` to
+    :class:`AsyncNodesRegistry`."""
+    @property
+    def timeout(self):
+        return self.wrapped.timeout
+
+    async def add(self, node):
+        return await self._call(self.wrapped.add, node)
+
+    async def update(self, node):
+        return await self._call(self.wrapped.update, node)
+
+    async def clean(self):
+        return await self._call(self.wrapped.clean)
+
+    async def get(self, node_id):
+        return await self._call(self.wrapped.__getitem__, node_id)
+
+    async def remove(self, node):
+        return await self._call(self.wrapped.__delitem__, node)
+
+    async def contains(self, node):
+        return await self._call(self.wrapped.__contains__, node)
+
+    async def count(self):
+        return await self._call(self.wrapped.__len__)
+
+    def bind(self, applications):
+        # The wrapped registry has been bound to the synchronous
+        # controllers by its Kaylee object, the nodes restored by it
+        # have to refer to the asynchronous ones.
+        self.wrapped.bind(applications)
+
+
+class ThreadPoolTemporalStorage(_ThreadPoolAdapter, AsyncTemporalStorage):
+    """Adapts a synchronous :class:`TemporalStorage` to
+    :class:`AsyncTemporalStorage`."""
+    async def add(self, task_id, node_id, result):
+        return await self._call(self.wrapped.add, task_id, node_id, result)
+
+    async def remove(self, task_id, node_id=None):
+        return await self._call(self.wrapped.remove, task_id, node_id)
+
+    async def clear(self):
+        return await self._call(self.wrapped.clear)
+
+    async def get(self, task_id):
+        return await self._call(self.wrapped.__getitem__, task_id)
+
+    async def contains(self, task_id, node_id=None, result=None):
+        return await self._call(self.wrapped.contains, task_id, node_id,
+                                result)
+
+    async def count(self):
+        return await self._call(lambda: self.wrapped.count)
+
+
+class ThreadPoolPermanentStorage(_ThreadPoolAdapter, AsyncPermanentStorage):
+    """Adapts a synchronous :class:`PermanentStorage` to
+    :class:`AsyncPermanentStorage`."""
+    async def add(self, task_id, result):
+        return await self._call(self.wrapped.add, task_id, result)
+
+    async def get(self, task_id):
+        return await self._call(self.wrapped.__getitem__, task_id)
+
+    async def contains(self, task_id, result=None):
+        return await self._call(self.wrapped.contains, task_id, result)
+
+    async def count(self):
+        return await self._call(lambda: self.wrapped.count)
+
+
+class ThreadPoolController(_ThreadPoolAdapter, AsyncController):
+    """Adapts a synchronous :class:`Controller` to :class:`AsyncController`.
+    The blocking calls to the controller, including the ones to the bound
+    storages and project callbacks, are carried out in a thread pool.
+    """
+    @property
+    def name(self):
+        return self.wrapped.name
+
+    @property
+    def project(self):
+        return self.wrapped.project
+
+    @property
+    def completed(self):
+        return self.wrapped.completed
+
+    @property
+    def tasks_batch_limit(self):
+        return self.wrapped.tasks_batch_limit
+
+    @property
+    def client_config(self):
+        return self.wrapped.client_config
+
+    def add_tasks_listener(self, callback):
+        self.wrapped.add_tasks_listener(callback)
+
+    def remove_tasks_listener(self, callback):
+        self.wrapped.remove_tasks_listener(callback)
+
+    def notify_tasks_available(self):
+        self.wrapped.notify_tasks_available()
+
+    async def reissue_due_in(self):
+        # the leases are examined by the controller, thus the call is
+        # serialized with the other calls
+        return await self._call(self.wrapped.reissue_due_in)
+
+    async def get_task(self, node):
+        return await self._call(self.wrapped.get_task, node)
+
+    async def get_tasks(self, node, count):
+        return await self._call(self.wrapped.get_tasks, node, count)
+
+    async def accept_result(self, node, result):
+        return await self._call(self.wrapped.accept_result, node, result)
+
+    async def release_tasks(self, node):
+        return await self._call(self.wrapped.release_tasks, node)
+
+
+class AsyncKaylee(Kaylee):
+    """The asyncio counterpart of :class:`Kaylee`. The public methods are
+    coroutines which return the same JSON-formatted data as the
+    corresponding :class:`Kaylee` methods.
+
+    :param registry: active nodes registry
+    :param session_data_manager: global session data manager
+    :param applications: a list of applications (:class:`AsyncController`
+                         objects)
+    :param \\**kwargs: Kaylee configuration arguments.
+    :type registry: :class:`AsyncNodesRegistry`
+    """
+    @classmethod
+    def wrap(cls, kl, executor=None):
+        """Returns an :class:`AsyncKaylee` object which runs the
+        synchronous registry and controllers of the given :class:`Kaylee`
+        object in a thread pool.
+
+        :param kl: Kaylee object, e.g. returned by :func:`kaylee.loader.load`.
+        :param executor: an instance of :class:`concurrent.futures.Executor`.
+                         The event loop's default executor is used if
+                         ``None``.
+        """
+        apps = [ThreadPoolController(kl.applications[name], executor)
+                for name in kl.applications.names]
+        akl = cls(ThreadPoolNodesRegistry(kl.registry, executor),
+                  kl.session_data_manager, apps)
+        akl.config = kl.config
+        akl.codecs = kl.codecs
+        akl.node_tokens = kl.node_tokens
+        return akl
+
+    @async_json_error_handler
+    async def register(self, remote_host, accept=None, score=None):
+        """See :meth:`Kaylee.register`."""
+        node = Node(NodeID.for_host(remote_host))
+        node.codec = negotiate(accept, self.codecs).name
+        node.score = parse_score(score)
+        if self.node_tokens is None:
+            await self.registry.add(node)
+            node_id = str(node.id)
+        else:
+            node_id = self.node_tokens.dumps(node)
+        encoder = self._encoder(node)
+        return encoder.register(node_id, self.config.client_config(),
+                                self._applications.names)
+
+    @async_json_error_handler
+    async def unregister(self, node_id):
+        """See :meth:`Kaylee.unregister`."""
+        try:
+            node = await self._node(node_id)
+        except KeyError:
+            return
+        if not self._is_token(node_id):
+            await self.registry.remove(node_id)
+        await self._release_tasks(node)
+
+    @async_json_error_handler
+    async def subscribe(self, node_id, application):
+        """See :meth:`Kaylee.subscribe`."""
+        try:
+            node = await self._node(node_id)
+        except KeyError:
+            raise KayleeError('Node "{}" is not registered'.format(node_id))
+
+        try:
+            app = self._applications[application]
+        except KeyError:
+            raise KayleeError('Application "{}" was not found'
+                              .format(application))
+        client_config = node.subscribe(app)
+        await self._update_node(node)
+        if self.node_tokens is not None:
+            client_config = dict(client_config)
+            client_config[KL_NODE_ID] = self.node_tokens.dumps(node)
+        return self._codec(node).encode(client_config)
+
+    @async_json_error_handler
+    async def unsubscribe(self, node_id):
+        """See :meth:`Kaylee.unsubscribe`."""
+        node = await self._node(node_id)
+        await self._release_tasks(node)
+        node.unsubscribe()
+        await self._update_node(node)
+
+    @async_json_error_handler
+    async def get_action(self, node_id, count=None):
+        """See :meth:`Kaylee.get_action`."""
+        node = await self._node(node_id)
+        node.touch()
+        return self._encode_action(node, *await self._get_action(node, count))
+
+    @async_json_error_handler
+    async def accept_result(self, node_id, result):
+        """See :meth:`Kaylee.accept_result`."""
+        if not isinstance(result, (str, bytes)):
+            raise ValueError('Kaylee expects the incoming result to be in '
+                             'string or bytes format, not {}'.format(
+                                 result.__class__.__name__))
+        node = await self._node(node_id)
+        node.touch()
+        parsed_result = self._codec(node).decode(result)
+        if isinstance(parsed_result, list):
+            return await self._accept_results(node, parsed_result)
+
+        if not isinstance(parsed_result, dict):
+            raise ValueError('The returned result was not parsed '
+                             'as dict: {}'.format(parsed_result))
+        task_id = parsed_result.pop(KL_TASK_ID, None)
+        try:
+            self._restore_session_data(node, parsed_result, task_id)
+            await self._accept_node_result(node, parsed_result, task_id)
+        except InvalidResultError as e:
+            await self._release_tasks(node)
+            node.unsubscribe()
+            await self._update_node(node)
+            raise e
+
+        #pylint: disable-msg=E1101
+        if self.config.AUTO_GET_ACTION:
+            if task_id is None:
+                return self._encode_action(node,
+                                           *await self._get_action(node))
+            elif not node.task_ids:
+                return self._encode_action(
+                    node, *await self._get_batch_action(node))
+        await self._update_node(node)
+        return self._encode_action(node, ACTION_NOP)
+
+    @async_json_error_handler
+    async def accept_results(self, node_id, results):
+        """See :meth:`Kaylee.accept_results`."""
+        node = await self._node(node_id)
+        node.touch()
+        if isinstance(results, (str, bytes)):
+            results = self._codec(node).decode(results)
+        return await self._accept_results(node, results)
+
+    async def _accept_results(self, node, results):
+        #pylint: disable-msg=W0703
+        if not isinstance(results, list):
+            raise ValueError('The returned results were not parsed '
+                             'as list: {}'.format(results))
+
+        errors = []
+        for entry in results:
+            try:
+                task_id, result = self._parse_results_entry(entry)
+            except ValueError as e:
+                errors.append({'task_id' : None, 'error' : str(e)})
+                continue
+            try:
+                self._restore_session_data(node, result, task_id)
+                await self._accept_node_result(node, result, task_id)
+            except Exception as e:
+                if isinstance(e, InvalidResultError):
+                    node.release_task(task_id)
+                errors.append({'task_id' : task_id, 'error' : str(e)})
+
+        #pylint: disable-msg=E1101
+        if self.config.AUTO_GET_ACTION and not node.task_ids:
+            action = await self._get_batch_action(node)
+        else:
+            await self._update_node(node)
+            action = (ACTION_NOP, )
+        return self._encode_action(node, *action, errors=errors)
+
+    async def clean(self):
+        """See :meth:`Kaylee.clean`."""
+        for node in await self.registry.clean() or ():
+            await self._release_tasks(node)
+
+    @staticmethod
+    async def _release_tasks(node):
+        if node.controller is not None and node.task_ids:
+            await node.controller.release_tasks(node)
+
+    async def _get_action(self, node, count=None):
+        action = await self._next_action(node, count)
+        #pylint: disable-msg=E1101
+        if action[0] == ACTION_NOP and self.config.LONG_POLL_TIMEOUT > 0:
+            action = await self._wait_for_action(node, count)
+        await self._update_node(node)
+        return action
+
+    async def _next_action(self, node, count=None):
+        try:
+            controller = _bound_controller(node)
+            if count is None:
+                task = await controller.get_task(node)
+                if task is None:
+                    return (ACTION_NOP, )
+                task['id'] = str(task['id']).strip()
+                self._store_session_data(node, task)
+                action = (ACTION_TASK, task)
+            else:
+                tasks = await controller.get_tasks(node, int(count))
+                if not tasks:
+                    return (ACTION_NOP, )
+                for task in tasks:
+                    task['id'] = str(task['id']).strip()
+                    self._store_session_data(node, task)
+                action = (ACTION_TASKS, tasks)
+            await self._update_node(node)
+            return action
+        except NodeRequestRejectedError as e:
+            return (ACTION_UNSUBSCRIBE,
+                    'The node has been automatically '
+                    'unsubscribed: {}'.format(e))
+
+    async def _wait_for_action(self, node, count):
+        # the coroutine version of Kaylee._wait_for_action(), the parked
+        # requests do not occupy any threads.
+        controller = node.controller
+        if controller is None:
+            return (ACTION_NOP, )
+        #pylint: disable-msg=E1101
+        deadline = time.monotonic() + self.config.LONG_POLL_TIMEOUT
+        loop = asyncio.get_running_loop()
+        tasks_available = asyncio.Event()
+        def on_tasks_available():
+            loop.call_soon_threadsafe(tasks_available.set)
+        controller.add_tasks_listener(on_tasks_available)
+        try:
+            action = (ACTION_NOP, )
+            while action[0] == ACTION_NOP:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                reissue_due_in = await controller.reissue_due_in()
+                if reissue_due_in is not None:
+                    timeout = min(timeout, max(reissue_due_in, 0.01))
+                try:
+                    await asyncio.wait_for(tasks_available.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                tasks_available.clear()
+                action = await self._next_action(node, count)
+            return action
+        finally:
+            controller.remove_tasks_listener(on_tasks_available)
+
+    async def _get_batch_action(self, node):
+        if node.controller is None:
+            return await self._get_action(node)
+        return await self._get_action(node,
+                                      node.controller.tasks_batch_limit)
+
+    async def _accept_node_result(self, node, result, task_id):
+        # the coroutine version of Node.accept_result()
+        controller = _bound_controller(node)
+        if task_id is None:
+            await controller.accept_result(node, result)
+            return
+        leased_id = node.select_task(task_id)
+        await controller.accept_result(node, result)
+        node.release_task(leased_id)
+
+    async def _node(self, node_id):
+        if self._is_token(node_id):
+            return self.node_tokens.loads(node_id, self._applications)
+        return await self.registry.get(node_id)
+
+    async def _update_node(self, node):
+        if node.dirty:
+            if self.node_tokens is None:
+                await self.registry.update(node)
+            node.dirty = False
+
+
+def _bound_controller(node):
+    if node.controller is None:
+        raise NodeNotSubscribedError(node)
+    if node.controller.completed:
+        raise ApplicationCompletedError(node.controller)
+    return node.controller
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+    kaylee.codecs
+    ~~~~~~~~~~~~~
+
+    Implements the wire codecs used to encode the data sent to the nodes
+    and decode the data received from them. JSON is the default codec,
+    MessagePack and CBOR are available if the ``msgpack`` or ``cbor2``
+    packages are installed.
+
+    :copyright: (c) 2013 by Zaur Nasibov.
+    :license: MIT, see LICENSE for more details.
+"""
+import json
+from abc import ABCMeta, abstractmethod
+
+from .errors import KayleeError
+
+#: The name of the default codec which is supported by every node.
+DEFAULT_CODEC = 'json'
+
+
+class EncodedData(bytes):
+    """The binary data encoded by a codec. The front-ends use the
+    :attr:`content_type` attribute as the response content-type."""
+    content_type = 'application/octet-stream'
+
+
+class Codec(object, metaclass=ABCMeta):
+    """The base class of Kaylee wire codecs."""
+    #: The codec name used in Kaylee settings.
+    name = None
+
+    #: The MIME type of the encoded data.
+    content_type = None
+
+    @abstractmethod
+    def encode(self, obj):
+        """Encodes the object. Returns a string (text codecs) or an
+        :class:`EncodedData` object (binary codecs)."""
+
+    @abstractmethod
+    def decode(self, data):
+        """Decodes the data received from a node.
+
+        :type data: str or bytes
+        """
+
+    def response_encoder(self):
+        """Returns a new :class:`ResponseEncoder` which encodes Kaylee
+        responses by this codec."""
+        return ResponseEncoder(self)
+
+
+class JSONCodec(Codec):
+    name = 'json'
+    content_type = 'application/json'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(separators=(',', ':'))
+        self._decoder = json.JSONDecoder()
+
+    def encode(self, obj):
+        return self._encoder.encode(obj)
+
+    def decode(self, data):
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode('utf-8')
+        return self._decoder.decode(data)
+
+    def response_encoder(self):
+        return JSONResponseEncoder(self)
+
+
+class MessagePackCodec(Codec):
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise KayleeError('The "msgpack" codec requires the msgpack '
+                              'package to be installed')
+        self._packb = msgpack.packb
+        self._unpackb = msgpack.unpackb
+        self._data_type = type('MessagePackData', (EncodedData, ),
+                               {'content_type' : self.content_type,
+                                '__slots__' : ()})
+
+    def encode(self, obj):
+        return self._data_type(self._packb(obj, use_bin_type=True))
+
+    def decode(self, data):
+        if isinstance(data, str):
+            raise ValueError('The msgpack codec expects binary data')
+        return self._unpackb(data, raw=False)
+
+
+class CBORCodec(Codec):
+    name = 'cbor'
+    content_type = 'application/cbor'
+
+    def __init__(self):
+        try:
+            import cbor2
+        except ImportError:
+            raise KayleeError('The "cbor" codec requires the cbor2 '
+                              'package to be installed')
+        self._dumps = cbor2.dumps
+        self._loads = cbor2.loads
+        self._data_type = type('CBORData', (EncodedData, ),
+                               {'content_type' : self.content_type,
+                                '__slots__' : ()})
+
+    def encode(self, obj):
+        return self._data_type(self._dumps(obj))
+
+    def decode(self, data):
+        if isinstance(data, str):
+            raise ValueError('The cbor codec expects binary data')
+        return self._loads(data)
+
+
+class ResponseEncoder(object):
+    """Encodes the responses returned by :class:`Kaylee` methods.
+
+    :param codec: the codec which encodes the responses.
+    """
+    def __init__(self, codec):
+        self.codec = codec
+
+    def register(self, node_id, config, applications):
+        """Encodes the :meth:`Kaylee.register` response."""
+        return self.codec.encode({ 'node_id' : node_id,
+                                   'config' : config,
+                                   'applications' : applications,
+                                   'codec' : self.codec.name })
+
+    def action(self, action, data='', **kwargs):
+        """Encodes the ``{'action' : <action>, 'data' : <data>}``
+        response. The keyword arguments are added to the response."""
+        kwargs['action'] = action
+        kwargs['data'] = data
+        return self.codec.encode(kwargs)
+
+
+class JSONResponseEncoder(ResponseEncoder):
+    """Keeps the constant parts of the responses serialized, so that
+    only the variable parts (e.g. a task) are encoded per response."""
+    def __init__(self, codec):
+        super(JSONResponseEncoder, self).__init__(codec)
+        self._encode = codec.encode
+        self._action_prefixes = {}
+        self._empty_actions = {}
+        for action in ('task', 'tasks', 'unsubscribe', 'nop'):
+            self._action_prefix(action)
+        # (config, applications, serialized prefix)
+        self._register = (None, None, None)
+
+    def register(self, node_id, config, applications):
+        # The config dict is re-created by Config.client_config() when
+        # the configuration changes, so the identity check is sufficient.
+        # The objects are referenced, so that their ids are not reused.
+        cached_config, cached_applications, prefix = self._register
+        if (config is not cached_config or
+                applications is not cached_applications):
+            fragment = self._encode({ 'config' : config,
+                                      'applications' : applications,
+                                      'codec' : self.codec.name })
+            prefix = fragment[:-1] + ',"node_id":"'
+            self._register = (config, applications, prefix)
+        # a node id (or a node token) requires no escaping
+        return prefix + node_id + '"}'
+
+    def action(self, action, data='', **kwargs):
+        if not kwargs:
+            if data == '':
+                try:
+                    return self._empty_actions[action]
+                except KeyError:
+                    pass
+            return self._action_prefix(action) + self._encode(data) + '}'
+        parts = [self._action_prefix(action), self._encode(data)]
+        for key, value in kwargs.items():
+            parts.append(',{}:{}'.format(self._encode(key),
+                                         self._encode(value)))
+        parts.append('}')
+        return ''.join(parts)
+
+    def _action_prefix(self, action):
+        try:
+            return self._action_prefixes[action]
+        except KeyError:
+            prefix = '{{"action":{},"data":'.format(self._encode(action))
+            self._action_prefixes[action] = prefix
+            self._empty_actions[action] = prefix + self._encode('') + '}'
+            return prefix
+
+
+_codec_classes = {c.name : c for c in [JSONCodec, MessagePackCodec,
+                                       CBORCodec]}
+_codecs = {}
+
+
+def get_codec(name):
+    """Returns the (shared) instance of the codec with the given name.
+
+    :raises KayleeError: if the codec is unknown or its dependencies
+                         are not installed.
+    """
+    try:
+        return _codecs[name]
+    except KeyError:
+        pass
+    try:
+        codec_class = _codec_classes[name]
+    except KeyError:
+        raise KayleeError('Unknown codec "{}"'.format(name))
+    codec = _codecs[name] = codec_class()
+    return codec
+
+
+def negotiate(accept, codecs):
+    """Chooses the codec for a node. Returns the first codec in the list
+    of the codecs accepted by the node which is available on the server.
+    Returns the default (JSON) codec if there is no such codec.
+
+    :param accept: the codecs accepted by the node: an HTTP ``Accept``
+                   header value or an iterable of codec names or content
+                   types, in the order of preference.
+    :param codecs: the codecs available on the server.
+    :type accept: str, iterable or None
+    :type codecs: list of :class:`Codec` objects
+    """
+    if accept:
+        if isinstance(accept, str):
+            accept = accept.split(',')
+        for entry in accept:
+            # strip the media type parameters, e.g. ";q=0.9"
+            entry = entry.split(';', 1)[0].strip()
+            for codec in codecs:
+                if entry == codec.name or entry == codec.content_type:
+                    return codec
+    return get_codec(DEFAULT_CODEC)
+
+
+def content_type(data):
+    """Returns the content type of the data returned by :class:`Kaylee`
+    methods."""
+    return getattr(data, 'content_type', JSONCodec.content_type)
@@ -12,4 +12,6 @@
 
 from .controllers import SimpleController, ResultsComparatorController
 from .storages import MemoryTemporalStorage, MemoryPermanentStorage
-from .registries import MemoryNodesRegistry
+from .registries import (MemoryNodesRegistry, ArrayNodesRegistry,
+                         ShardedNodesRegistry, SQLiteNodesRegistry,
+                         SharedMemoryNodesRegistry)
@@ -8,11 +8,24 @@
     :copyright: (c) 2013 by Zaur Nasibov.
     :license: MIT, see LICENSE for more details.
 """
-from kaylee.controller import Controller, NO_SOLUTION, NOT_SOLVED
+import time
+import bisect
+from collections import deque
+from datetime import timedelta
+
+from kaylee.node import node_key
+from kaylee.project import RangeProject
+from kaylee.util import parse_timedelta
+from kaylee.controller import (Controller, TaskLeases, CompletionTimes,
+                               NodeScores, Throughputs, result_digest,
+                               NO_SOLUTION, NOT_SOLVED)
 from kaylee.errors import (ApplicationCompletedError,
                            NodeRequestRejectedError,
                            NoneResultAssertError,)
 
+#: The default lease timeout of :class:`SimpleController` tasks.
+DEFAULT_LEASE_TIMEOUT = '5m'
+
 
 class SimpleController(Controller):
     """
@@ -20,55 +33,254 @@ class SimpleController(Controller):
     node requests and passes the accepted results directly to the project.
     Its ``completed`` indicator is set to ``True`` the moment the bound
     project is completed. The controller doesn't use a temporal storage.
+
+    Every task handed out is leased to the node (see :class:`TaskLeases`).
+    A task whose lease has expired, or whose nodes have left Kaylee, is
+    re-issued before any new tasks, the longest expired first. The lease
+    is released when the result of the task is accepted.
+
+    If ``speculation_factor`` is set, the controller re-executes the
+    stragglers speculatively: when the project runs out of new tasks, a
+    task which has been solved by a single node for longer than
+    ``speculation_factor`` times the median completion time (see
+    :class:`CompletionTimes`) is handed out to a node which completes
+    the tasks faster than the median. The first result is accepted, the
+    late duplicates are discarded.
+
+    If ``cost_lookahead`` is set, the new tasks are matched to the speed
+    of the nodes: the controller fetches that many tasks from the project
+    in advance and hands out a task whose estimated cost (see
+    :meth:`Project.task_cost`) ranks among the fetched tasks as the node's
+    benchmark score ranks among the recently served nodes (see
+    :class:`NodeScores`). Thus the heavy tasks go to the fast nodes and
+    the light ones to the slow (e.g. mobile) nodes. The nodes of unknown
+    speed get the tasks in the project's order. A task passed over for
+    ``cost_lookahead`` times is handed out to the next node regardless of
+    its speed.
+
+    If ``target_task_time`` is set, the granularity of the tasks of a
+    :class:`RangeProject <kaylee.project.RangeProject>` is adapted to the
+    nodes: a new task covers as many work units as the node is expected to
+    solve in ``target_task_time``, judging by the node's measured
+    throughput (see :class:`Throughputs`). A node whose throughput has
+    not been measured yet gets a task sized by the median throughput of
+    the nodes, or of :attr:`RangeProject.task_size
+    <kaylee.project.RangeProject.task_size>` units. Thus the fast nodes
+    make fewer requests and the slow nodes' tasks do not exceed the lease
+    timeout.
+
+    :param lease_timeout: the amount of seconds (or a string like ``'5m'``)
+                          after which an unsolved task is re-issued.
+    :param speculation_factor: enables the speculative re-execution of the
+                               overdue tasks, e.g. ``2``.
+    :param cost_lookahead: enables matching the tasks to the nodes' speed,
+                           e.g. ``16``.
+    :param target_task_time: the amount of seconds (or a string like
+                             ``'30s'``) which a task should take, enables
+                             the adaptive tasks' granularity.
     """
     def __init__(self, *args, **kwargs):
+        lease_timeout = kwargs.pop('lease_timeout', DEFAULT_LEASE_TIMEOUT)
+        self.speculation_factor = kwargs.pop('speculation_factor', None)
+        self.cost_lookahead = kwargs.pop('cost_lookahead', None)
+        if self.cost_lookahead is not None:
+            self.cost_lookahead = int(self.cost_lookahead)
+            if self.cost_lookahead < 1:
+                raise ValueError('cost_lookahead must be positive')
+        self.target_task_time = kwargs.pop('target_task_time', None)
+        if self.target_task_time is not None:
+            self.target_task_time = self._seconds(self.target_task_time)
+            if self.target_task_time <= 0:
+                raise ValueError('target_task_time must be positive')
+            if self.cost_lookahead is not None:
+                raise ValueError('cost_lookahead and target_task_time '
+                                 'cannot be used together')
         super(SimpleController, self).__init__(*args, **kwargs)
-        self._tasks_pool = set()
+        if (self.target_task_time is not None and
+                not isinstance(self.project, RangeProject)):
+            raise TypeError('target_task_time requires a {}, not {}'
+                            .format(RangeProject.__name__,
+                                    type(self.project).__name__))
+        self.leases = TaskLeases(lease_timeout)
+        self.completion_times = CompletionTimes()
+        self.node_scores = NodeScores()
+        self.throughputs = Throughputs()
+        # {task id : the ids of the nodes whose results are late}
+        self._late = {}
         self._project_depleted = False
+        # the tasks fetched in advance, [(cost, fetch number, task)]
+        # sorted by cost
+        self._lookahead = []
+        self._fetched = 0
 
     def get_task(self, node):
-        task = self.project.next_task()
-        if task is None:
-            try:
-                tp_id = self._tasks_pool.pop()
-                task = self.project[tp_id]
-            except KeyError:
-                # project depleted and nothing in the pool,
-                # looks like the application is completed.
-                self.completed = True
-                raise ApplicationCompletedError(self)
-
-        task_id = task['id']
-        node.task_id = task_id
-        self._tasks_pool.add(task_id)
+        task_id = self.leases.reissue(node)
+        if task_id is not None:
+            task = self.project[task_id]
+        else:
+            task = self._next_task(node)
+            if task is not None:
+                self.leases.issue(task['id'], node)
+            else:
+                self._project_depleted = True
+                task_id = self._speculative_task_id(node)
+                if task_id is not None:
+                    task = self.project[task_id]
+                elif len(self.leases) == 0:
+                    # project depleted and no outstanding tasks,
+                    # looks like the application is completed.
+                    self.completed = True
+                    raise ApplicationCompletedError(self)
+                else:
+                    return None
+        node.task_id = task['id']
         return task
 
     def accept_result(self, node, result):
+        task_id = node.task_id
+        if task_id in self._late and self._discard_late_result(node, task_id):
+            return
+
         if result == NO_SOLUTION:
-            self._tasks_pool.remove(node.task_id)
+            self._task_solved(node, task_id)
             return
         elif result == NOT_SOLVED:
+            self.leases.release_owner(task_id, node)
+            self.notify_tasks_available()
             return
 
-        norm_result = self.project.normalize_result(node.task_id, result)
+        norm_result = self.project.normalize_result(task_id, result)
         if norm_result is None:
             raise NoneResultAssertError(result)
 
-        self.store_result(node.task_id, norm_result)
-        self._tasks_pool.remove(node.task_id)
+        self.store_result(task_id, norm_result)
+        self._task_solved(node, task_id)
         if self.project.completed:
             self.completed = True
 
+    def release_tasks(self, node):
+        for task_id in node.task_ids:
+            self.leases.release_owner(task_id, node)
+            if task_id in self._late:
+                self._discard_late_result(node, task_id)
+        self.completion_times.forget(node)
+        self.node_scores.forget(node)
+        self.throughputs.forget(node)
+        self.notify_tasks_available()
+
+    def reissue_due_in(self):
+        due_in = self.leases.due_in()
+        median = self.completion_times.median()
+        if (self.speculation_factor is not None and self._project_depleted
+                and median is not None):
+            overdue_in = self.leases.overdue_in(median *
+                                                self.speculation_factor)
+            if overdue_in is not None:
+                due_in = overdue_in if due_in is None else min(due_in,
+                                                               overdue_in)
+        return due_in
+
+    def _next_task(self, node):
+        if self.target_task_time is not None:
+            return self.project.next_range(self._task_size(node))
+        if self.cost_lookahead is None:
+            return self.project.next_task()
+        self.node_scores.record(node)
+        pool = self._lookahead
+        while len(pool) < self.cost_lookahead:
+            task = self.project.next_task()
+            if task is None:
+                break
+            bisect.insort(pool, (self.project.task_cost(task), self._fetched,
+                                 task))
+            self._fetched += 1
+        if not pool:
+            return None
+
+        # the oldest task goes to a node of unknown speed, and to any
+        # node once the task has been passed over for cost_lookahead
+        # times, i.e. its fetch number lags behind the amount of the
+        # fetched tasks handed out.
+        oldest = min(range(len(pool)), key=lambda i: pool[i][1])
+        handed_out = self._fetched - len(pool)
+        rank = self.node_scores.rank(node)
+        if (rank is None or
+                handed_out - pool[oldest][1] >= self.cost_lookahead):
+            i = oldest
+        else:
+            i = min(int(rank * len(pool)), len(pool) - 1)
+        return pool.pop(i)[2]
+
+    @staticmethod
+    def _seconds(value):
+        if isinstance(value, str):
+            value = parse_timedelta(value)
+        if isinstance(value, timedelta):
+            value = value.total_seconds()
+        return float(value)
+
+    def _task_size(self, node):
+        throughput = self.throughputs.node_throughput(node)
+        if throughput is None:
+            throughput = self.throughputs.median()
+        if throughput is None:
+            return self.project.task_size
+        return max(int(throughput * self.target_task_time), 1)
+
+    def _task_solved(self, node, task_id):
+        leases = self.leases
+        if task_id not in leases:
+            return
+        owners = leases.owners(task_id)
+        key = node_key(node)
+        if key in owners:
+            seconds = time.monotonic() - leases.issued_at(task_id, node)
+            if self.speculation_factor is not None:
+                self.completion_times.record(node, seconds)
+            if self.target_task_time is not None:
+                start, stop = self.project.task_range(task_id)
+                self.throughputs.record(node, stop - start, seconds)
+        if len(owners) > 1:
+            self._late[task_id] = set(owners) - {key}
+        leases.release(task_id)
+
+    def _discard_late_result(self, node, task_id):
+        # the task has been solved by another node
+        late = self._late[task_id]
+        key = node_key(node)
+        if key not in late:
+            return False
+        late.discard(key)
+        if not late:
+            del self._late[task_id]
+        return True
+
+    def _speculative_task_id(self, node):
+        if self.speculation_factor is None:
+            return None
+        median = self.completion_times.median()
+        if median is None or not self.completion_times.is_fast(node):
+            return None
+        task_id = self.leases.overdue(median * self.speculation_factor, node)
+        if task_id is not None:
+            self.leases.issue(task_id, node)
+        return task_id
 
 
 class ResultsComparatorController(Controller):
     """
     This controller is a simple implementation of the "trust no one" idea.
-    The intermediate results are collected in a temporal storage until
-    their number reaches a user-defined limit. Then the results are pairly
-    compared and only if they all match among themselves, a single result
-    is stored inside the permanent storage. The results are discarded if they
-    don't match and the task is pushed back to the "unsolved tasks" pool.
+    The intermediate results are collected until their number reaches a
+    user-defined limit. Then, only if they all match among themselves,
+    a single result is stored inside the permanent storage. The results are
+    discarded if they don't match and the task is pushed back to the
+    "unsolved tasks" pool.
+
+    The results are not kept in full: every result is hashed when it
+    arrives (see :func:`result_digest <kaylee.controller.result_digest>`)
+    and compared to the digest of the first result of the task. The
+    temporal storage keeps the digests of the nodes' results, and only the
+    first result of a task is kept until the task is solved.
 
     :param results_count_threshold: The amount of task results to be collected
                                     before running the comparison routine.
@@ -77,9 +289,14 @@ class ResultsComparatorController(Controller):
         self._results_count_threshold = kwargs.pop('results_count_threshold')
         super(ResultsComparatorController, self).__init__(*args, **kwargs)
         self._tasks_pool = set()
+        self._released_tasks = deque()
+        # {task id : _Candidate}
+        self._candidates = {}
 
     def get_task(self, node):
-        task = self.project.next_task()
+        task = self._next_released_task()
+        if task is None:
+            task = self.project.next_task()
         if task is None:
             try:
                 tp_id = self._tasks_pool.pop()
@@ -101,6 +318,7 @@ class ResultsComparatorController(Controller):
 
     def accept_result(self, node, result):
         if result == NOT_SOLVED:
+            self.notify_tasks_available()
             return
 
         task_id = node.task_id
@@ -112,42 +330,72 @@ class ResultsComparatorController(Controller):
             if norm_result is None:
                 raise NoneResultAssertError(result)
 
-        # no previous results for current task
-        if not self.temporal_storage.contains(task_id):
-            self.temporal_storage.add(task_id, node.id, norm_result)
+        # every node's result is counted once
+        if self.temporal_storage.contains(task_id, node.id):
+            raise NodeRequestRejectedError('The result of this task has been '
+                                           'already accepted.')
+        digest = result_digest(norm_result)
+        self.temporal_storage.add(task_id, node.id, digest)
+        candidate = self._candidates.get(task_id)
+        if candidate is None:
+            # no previous results for current task
+            candidate = _Candidate(digest, norm_result)
+            self._candidates[task_id] = candidate
+        elif candidate.digest != digest:
+            candidate.matched = False
+        candidate.count += 1
+        if candidate.count < self._results_count_threshold:
             return
 
-        tmp_results = self.temporal_storage[task_id]
-        if len(tmp_results) == self._results_count_threshold - 1:
-            if self._results_are_equal(norm_result, tmp_results):
-                del self.temporal_storage[task_id]
+        del self.temporal_storage[task_id]
+        del self._candidates[task_id]
+        if candidate.matched:
+            self._tasks_pool.remove(task_id)
+            if result != NO_SOLUTION:
+                self.store_result(task_id, candidate.result)
+        else:
+            # Something is wrong with either current result or any result
+            # which was received previously. At this point we discard all
+            # results associated with task_id and task_id remains in
+            # tasks_pool (if the result is not NO_SOLUTION)
+            if result == NO_SOLUTION:
                 self._tasks_pool.remove(task_id)
-                if result != NO_SOLUTION:
-                    self.store_result(task_id, norm_result)
             else:
-                # Something is wrong with either current result or any result
-                # which was received previously. At this point we discard all
-                # results associated with task_id and task_id remains in
-                # tasks_pool (if the result is not NO_SOLUTION)
-                del self.temporal_storage[task_id]
-                if result == NO_SOLUTION:
-                    self._tasks_pool.remove(task_id)
-            node.task_id = None
-        else:
-            self.temporal_storage.add(task_id, node.id, norm_result)
+                self.notify_tasks_available()
+        node.task_id = None
 
-    @staticmethod
-    def _results_are_equal(r0, res):
-        #pylint: disable-msg=W0612
-        #W0612: Unused variable 'node_id'
-        ###
-        for node_id, res in res.items():
-            if r0 != res:
-                return False
-        return True
+    def release_tasks(self, node):
+        # the released tasks are still in the tasks pool, the deque just
+        # makes them the first to be handed out.
+        released = [tid for tid in node.task_ids if tid in self._tasks_pool]
+        if released:
+            self._released_tasks.extend(released)
+            self.notify_tasks_available()
 
     def store_result(self, task_id, result):
         super(ResultsComparatorController, self).store_result(task_id, result)
         if self.project.completed:
             self.completed = True
             self.temporal_storage.clear()
+            self._candidates.clear()
+
+    def _next_released_task(self):
+        while self._released_tasks:
+            task_id = self._released_tasks.popleft()
+            # the task could have been solved by another node meanwhile
+            if task_id in self._tasks_pool:
+                return self.project[task_id]
+        return None
+
+
+class _Candidate(object):
+    """The first result of a task and the digest of it. ``matched``
+    indicates whether the other results of the task have the same
+    digest."""
+    __slots__ = ('digest', 'result', 'count', 'matched')
+
+    def __init__(self, digest, result):
+        self.digest = digest
+        self.result = result
+        self.count = 0
+        self.matched = True
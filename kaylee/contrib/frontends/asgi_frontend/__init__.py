@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+from .asgi_frontend import make_asgi_app
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+    kaylee.contrib.frontends.asgi_frontend
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A dependency-free ASGI application which serves the default Kaylee
+    communication API via :class:`kaylee.aio.AsyncKaylee`. The API is
+    served over HTTP and over a persistent WebSocket connection.
+
+    :copyright: (c) 2013 by Zaur Nasibov.
+    :license: MIT, see LICENSE for more details.
+"""
+import re
+import json
+from urllib.parse import parse_qs
+
+from kaylee.aio import AsyncKaylee
+from kaylee.core import json_error
+from kaylee.codecs import content_type
+from kaylee.errors import KayleeError
+from kaylee.controller import app_name_pattern
+from kaylee.node import node_id_pattern
+
+def make_asgi_app(kl, url_prefix='/kaylee'):
+    """Returns an ASGI application which serves the ``/register``,
+    ``/apps/<app_name>/subscribe/<node_id>`` and ``/actions/<node_id>``
+    URLs. The connections are kept alive by the ASGI server, since every
+    response carries its content length.
+
+    The same API is served via WebSocket at the ``/ws`` URL. Every text
+    message sent by the client is a JSON object::
+
+      {
+          'id': <request id>,
+          'method': 'register' | 'subscribe' | 'get_action' | 'send_result',
+          # method arguments
+          'node_id': <node id>,   # optional after "register"
+          'score': <benchmark score>,   # optional, "register"
+          'app_name': <application name>,   # "subscribe"
+          'count': <amount of tasks>,   # optional, "get_action"
+          'result': <result or a list of results>,   # "send_result"
+      }
+
+    and the server replies with ``{'id': <request id>, 'data': <data>}``
+    message, where <data> is the data returned by the corresponding
+    :class:`Kaylee` method.
+
+    :param kl: Kaylee object. A synchronous :class:`Kaylee` object is
+               wrapped via :meth:`AsyncKaylee.wrap`.
+    :param url_prefix: the prefix of Kaylee URLs.
+    :type kl: :class:`Kaylee` or :class:`AsyncKaylee`
+    """
+    if not isinstance(kl, AsyncKaylee):
+        kl = AsyncKaylee.wrap(kl)
+    routes = _make_routes(kl, url_prefix)
+    ws_path = url_prefix + '/ws'
+    ws_session = _make_websocket_session(kl)
+
+    async def application(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await _lifespan(receive, send)
+            return
+        elif scope['type'] == 'websocket':
+            if scope['path'] == ws_path:
+                await ws_session(scope, receive, send)
+            else:
+                await send({'type' : 'websocket.close'})
+            return
+        elif scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type: {}'
+                             .format(scope['type']))
+
+        path = scope['path']
+        for regex, methods, endpoint in routes:
+            match = regex.match(path)
+            if match is None:
+                continue
+            if scope['method'] not in methods:
+                await _send_response(send, b'Method Not Allowed', 405,
+                                     b'text/plain')
+                return
+            body = await endpoint(scope, receive, **match.groupdict())
+            await _send_response(send, body,
+                                 content_type=content_type(body).encode())
+            return
+        await _send_response(send, b'Not Found', 404, b'text/plain')
+
+    return application
+
+
+def _make_routes(kl, url_prefix):
+    async def register_node(scope, receive):
+        #pylint: disable-msg=W0613
+        #W0613:  Unused argument 'receive'
+        return await kl.register(_remote_addr(scope),
+                                 _header(scope, b'accept'),
+                                 _query_arg(scope, 'score'))
+
+    async def subscribe_node(scope, receive, app_name, node_id):
+        #pylint: disable-msg=W0613
+        #W0613:  Unused argument 'scope', 'receive'
+        return await kl.subscribe(node_id, app_name)
+
+    async def actions(scope, receive, node_id):
+        if scope['method'] == 'GET':
+            count = _query_arg(scope, 'count')
+            return await kl.get_action(node_id, count)
+        else:
+            data = await _read_body(receive)
+            return await kl.accept_result(node_id, data)
+
+    prefix = re.escape(url_prefix)
+    return [
+        (re.compile(r'^{}/register$'.format(prefix)),
+         ('GET', ),
+         register_node),
+        (re.compile(r'^{}/apps/(?P<app_name>{})/subscribe/(?P<node_id>{})$'
+                    .format(prefix, app_name_pattern, node_id_pattern)),
+         ('POST', ),
+         subscribe_node),
+        (re.compile(r'^{}/actions/(?P<node_id>{})$'
+                    .format(prefix, node_id_pattern)),
+         ('GET', 'POST'),
+         actions),
+    ]
+
+
+def _make_websocket_session(kl):
+    async def register(scope, request, node_id):
+        #pylint: disable-msg=W0613
+        #W0613:  Unused argument 'node_id'
+        # the messages are JSON-formatted, thus JSON codec is used
+        return await kl.register(_remote_addr(scope), ['json'],
+                                 request.get('score'))
+
+    async def subscribe(scope, request, node_id):
+        #pylint: disable-msg=W0613
+        return await kl.subscribe(node_id, request['app_name'])
+
+    async def get_action(scope, request, node_id):
+        #pylint: disable-msg=W0613
+        return await kl.get_action(node_id, request.get('count'))
+
+    async def send_result(scope, request, node_id):
+        #pylint: disable-msg=W0613
+        result = request['result']
+        if isinstance(result, list):
+            return await kl.accept_results(node_id, result)
+        return await kl.accept_result(node_id, json.dumps(result))
+
+    methods = {
+        'register' : register,
+        'subscribe' : subscribe,
+        'get_action' : get_action,
+        'send_result' : send_result,
+    }
+
+    async def session(scope, receive, send):
+        #pylint: disable-msg=W0703
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        await send({'type' : 'websocket.accept'})
+
+        # the node id bound to the connection by "register"
+        bound_node_id = None
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.disconnect':
+                return
+            text = message.get('text')
+            if text is None:
+                text = message.get('bytes', b'').decode('utf-8')
+
+            request_id = None
+            try:
+                request = json.loads(text)
+                request_id = request.get('id')
+                method = methods[request['method']]
+                node_id = request.get('node_id', bound_node_id)
+                data = await method(scope, request, node_id)
+                if not isinstance(data, (str, type(None))):
+                    raise KayleeError('The node\'s codec is not supported '
+                                      'by the WebSocket transport')
+                if method is register:
+                    bound_node_id = json.loads(data).get('node_id')
+            except Exception as e:
+                data = json_error(e)
+            if data is None:
+                data = 'null'
+            # the data is already JSON-encoded by Kaylee
+            await send({
+                'type' : 'websocket.send',
+                'text' : '{{"id":{},"data":{}}}'.format(
+                    json.dumps(request_id), data),
+            })
+
+    return session
+
+
+async def _read_body(receive):
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    return b''.join(chunks)
+
+
+async def _send_response(send, body, status=200,
+                         content_type=b'application/json'):
+    if body is None:
+        body = b''
+    elif isinstance(body, str):
+        body = body.encode('utf-8')
+    await send({
+        'type' : 'http.response.start',
+        'status' : status,
+        'headers' : [
+            (b'content-type', content_type),
+            (b'content-length', str(len(body)).encode('ascii')),
+        ],
+    })
+    await send({
+        'type' : 'http.response.body',
+        'body' : body,
+    })
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type' : 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type' : 'lifespan.shutdown.complete'})
+            return
+
+
+def _remote_addr(scope):
+    client = scope.get('client')
+    return client[0] if client else '127.0.0.1'
+
+
+def _header(scope, name):
+    for key, value in scope.get('headers', []):
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _query_arg(scope, name):
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    values = query.get(name)
+    return values[0] if values else None
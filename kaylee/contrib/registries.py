@@ -9,47 +9,778 @@
     :license: MIT, see LICENSE for more details.
 """
 
-from datetime import datetime
-from kaylee.node import NodesRegistry, NodeID, extract_node_id
+import os
+import mmap
+import time
+import zlib
+import heapq
+import struct
+import pickle
+import atexit
+import sqlite3
+import weakref
+import threading
+from array import array
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from kaylee.node import NodesRegistry, NodeID, Node, node_key
+from kaylee.errors import KayleeError
 
 
 class MemoryNodesRegistry(NodesRegistry):
+    """Keeps the nodes in a dict keyed by :attr:`NodeID.binary`. The
+    nodes are indexed by the time of their last activity in a min-heap,
+    so :meth:`clean` takes time proportional to the amount of inactive
+    nodes.
+    """
     def __init__(self, *args, **kwargs):
         super(MemoryNodesRegistry, self).__init__(*args, **kwargs)
+        # {NodeID.binary : Node}
         self._d = {}
+        # The expiry index: a heap of (last activity, NodeID.binary) items.
+        # The items are not updated when a node becomes active, instead
+        # they are re-pushed by clean().
+        self._expiry = []
+        # guards the modifications of the dict and the expiry index
+        self._lock = threading.Lock()
 
     def add(self, node):
-        self._d[node.id] = node
+        binary = node.id.binary
+        with self._lock:
+            self._d[binary] = node
+            heapq.heappush(self._expiry, (node.last_activity, binary))
 
     def update(self, node):
         # a very naive and simple update
-        if node.id in self._d and node.dirty:
-            self._d[node.id] = node
-        else:
-            raise KeyError('Cannot update node in registry: '
-                           'node {} was not found'.format(node))
+        binary = node.id.binary
+        with self._lock:
+            if binary in self._d and node.dirty:
+                self._d[binary] = node
+                return
+        raise KeyError('Cannot update node in registry: '
+                       'node {} was not found'.format(node))
 
     def clean(self):
-        nodes_to_clean = (node for node in self._d.items()
-                          if datetime.now() - node.id.timestamp > self.timeout)
-        for node in nodes_to_clean:
-            del self._d[node]
+        #pylint: disable-msg=E1101
+        #E1101: Instance of 'timedelta' has no 'total_seconds' member
+        border = int(time.time() - self.timeout.total_seconds())
+        removed = []
+        with self._lock:
+            expiry = self._expiry
+            while expiry and expiry[0][0] < border:
+                binary = heapq.heappop(expiry)[1]
+                node = self._d.get(binary)
+                if node is None:
+                    # the node has been already removed
+                    continue
+                if node.last_activity < border:
+                    self._d.pop(binary, None)
+                    removed.append(node)
+                else:
+                    heapq.heappush(expiry, (node.last_activity, binary))
+        return removed
 
     def __len__(self):
         return len(self._d)
 
     def __delitem__(self, node):
-        node_id = extract_node_id(node)
+        binary = node_key(node)
+        with self._lock:
+            self._d.pop(binary, None)
+
+    def __getitem__(self, node_id):
+        return self._d[node_key(node_id)]
+
+    def __contains__(self, node):
+        return node_key(node) in self._d
+
+
+
+class ArrayNodesRegistry(NodesRegistry):
+    """A memory-efficient registry which keeps the nodes' fields
+    column-wise in arrays and lists indexed by :attr:`NodeID.binary`,
+    instead of keeping the :class:`Node` objects. The controllers and the
+    codecs are referred to by small integer indices. A :class:`Node`
+    object is constructed on every lookup, thus a modified node has to be
+    stored back via :meth:`update`.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ArrayNodesRegistry, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        # {NodeID.binary : row}
+        self._index = {}
+        self._free_rows = []
+
+        # columns
+        self._ids = []
+        self._codecs = array('B')
+        self._controllers = array('H')
+        self._subscription_timestamps = array('q')
+        self._task_timestamps = array('q')
+        self._activity_timestamps = array('q')
+        # 0.0 stands for the missing benchmark score
+        self._scores = array('d')
+        self._task_ids = []
+        self._task_id = []
+        self._session_data = []
+
+        # the controllers' and codecs' tables, the index 0 of controllers
+        # table refers to a non-subscribed node.
+        self._controllers_table = [None]
+        self._controllers_index = {None : 0}
+        self._codecs_table = []
+        self._codecs_index = {}
+
+    def add(self, node):
+        with self._lock:
+            binary = node.id.binary
+            if binary in self._index:
+                self._store(self._index[binary], node)
+                return
+            if self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                row = len(self._ids)
+                self._ids.append(None)
+                self._codecs.append(0)
+                self._controllers.append(0)
+                self._subscription_timestamps.append(0)
+                self._task_timestamps.append(0)
+                self._activity_timestamps.append(0)
+                self._scores.append(0.0)
+                self._task_ids.append(None)
+                self._task_id.append(None)
+                self._session_data.append(None)
+            self._ids[row] = binary
+            self._index[binary] = row
+            self._store(row, node)
+
+    def update(self, node):
+        with self._lock:
+            try:
+                row = self._index[node.id.binary]
+            except KeyError:
+                raise KeyError('Cannot update node in registry: '
+                               'node {} was not found'.format(node))
+            if node.dirty:
+                self._store(row, node)
+
+    def clean(self):
+        #pylint: disable-msg=E1101
+        #E1101: Instance of 'timedelta' has no 'total_seconds' member
+        border = int(time.time() - self.timeout.total_seconds())
+        with self._lock:
+            activity = self._activity_timestamps
+            # a scan of a typed array is cheap even for millions of nodes
+            rows = [row for row in range(len(activity))
+                    if activity[row] < border and self._ids[row] is not None]
+            removed = [self._node(row) for row in rows]
+            for node in removed:
+                self._remove(node.id.binary)
+        return removed
+
+    def __len__(self):
+        return len(self._index)
+
+    def __delitem__(self, node):
+        binary = node_key(node)
+        with self._lock:
+            if binary in self._index:
+                self._remove(binary)
+
+    def __getitem__(self, node_id):
+        binary = node_key(node_id)
+        with self._lock:
+            return self._node(self._index[binary])
+
+    def __contains__(self, node):
+        return node_key(node) in self._index
+
+    def _node(self, row):
+        node_id = NodeID.from_binary(self._ids[row])
+        task_id = self._task_id[row]
+        task_ids = self._task_ids[row]
+        if task_ids is None:
+            task_ids = (task_id, ) if task_id is not None else ()
+        state = (node_id,
+                 self._codecs_table[self._codecs[row]],
+                 self._controllers_table[self._controllers[row]],
+                 self._session_data[row],
+                 task_id,
+                 task_ids,
+                 self._subscription_timestamps[row] or None,
+                 self._task_timestamps[row] or None,
+                 self._activity_timestamps[row],
+                 self._scores[row] or None)
+        return Node.from_state(state)
+
+    def _store(self, row, node):
+        (_, codec, controller, session_data, task_id, task_ids,
+         subscription_timestamp, task_timestamp,
+         last_activity, score) = node.__getstate__()
+        self._codecs[row] = self._table_index(codec, self._codecs_table,
+                                              self._codecs_index)
+        self._controllers[row] = self._table_index(
+            controller, self._controllers_table, self._controllers_index)
+        self._subscription_timestamps[row] = subscription_timestamp or 0
+        self._task_timestamps[row] = task_timestamp or 0
+        self._activity_timestamps[row] = last_activity
+        self._scores[row] = score or 0.0
+        # the usual single leased task is not kept in a separate tuple
+        if task_ids == ((task_id, ) if task_id is not None else ()):
+            task_ids = None
+        self._task_ids[row] = task_ids
+        self._task_id[row] = task_id
+        self._session_data[row] = session_data
+
+    def _remove(self, binary):
+        row = self._index.pop(binary)
+        self._ids[row] = None
+        self._task_ids[row] = None
+        self._task_id[row] = None
+        self._session_data[row] = None
+        self._controllers[row] = 0
+        self._free_rows.append(row)
+
+    @staticmethod
+    def _table_index(value, table, index):
         try:
-            del self._d[node_id]
+            return index[value]
         except KeyError:
-            pass
+            index[value] = len(table)
+            table.append(value)
+            return index[value]
+
+
+class ShardedNodesRegistry(NodesRegistry):
+    """A thread-safe registry which partitions the nodes by
+    :class:`NodeID` hash across a number of shards. Every shard is guarded
+    by its own lock, so that the concurrent requests of different nodes
+    rarely wait for each other.
+
+    The lock striping pays off when a shard operation blocks without
+    holding the GIL, e.g. when the shards are backed by a remote store
+    (or with a free-threaded interpreter). The in-memory shards are
+    merely thread-safe: under the GIL their operations are serialized
+    anyway.
+
+    :param shards: the amount of shards.
+    :param shard_factory: a callable which receives the timeout and returns
+                          a new shard (a :class:`NodesRegistry`). The
+                          shards are not required to be thread-safe.
+                          Defaults to :class:`MemoryNodesRegistry`.
+    """
+    def __init__(self, timeout, shards=16, shard_factory=None):
+        super(ShardedNodesRegistry, self).__init__(timeout)
+        shards = int(shards)
+        if shards < 1:
+            raise ValueError('The amount of shards must be positive')
+        if shard_factory is None:
+            shard_factory = MemoryNodesRegistry
+        self._shards = [shard_factory(timeout) for i in range(shards)]
+        self._locks = [threading.Lock() for i in range(shards)]
+
+    def add(self, node):
+        i = self._shard_index(node.id.binary)
+        with self._locks[i]:
+            self._shards[i].add(node)
+
+    def update(self, node):
+        i = self._shard_index(node.id.binary)
+        with self._locks[i]:
+            self._shards[i].update(node)
+
+    def clean(self):
+        removed = []
+        for lock, shard in zip(self._locks, self._shards):
+            with lock:
+                removed.extend(shard.clean() or ())
+        return removed
+
+    def bind(self, applications):
+        for lock, shard in zip(self._locks, self._shards):
+            with lock:
+                shard.bind(applications)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def __delitem__(self, node):
+        binary = node_key(node)
+        i = self._shard_index(binary)
+        with self._locks[i]:
+            del self._shards[i][binary]
 
     def __getitem__(self, node_id):
-        node_id = extract_node_id(node_id)
-        return self._d[node_id]
+        binary = node_key(node_id)
+        i = self._shard_index(binary)
+        with self._locks[i]:
+            return self._shards[i][binary]
 
     def __contains__(self, node):
-        node_id = extract_node_id(node)
-        return node_id in self._d
+        binary = node_key(node)
+        i = self._shard_index(binary)
+        with self._locks[i]:
+            return binary in self._shards[i]
+
+    def _shard_index(self, binary):
+        # hash() of bytes differs between the processes
+        return zlib.crc32(binary) % len(self._shards)
+
+
+class SQLiteNodesRegistry(NodesRegistry):
+    """Keeps the nodes in a SQLite database (in WAL mode), so that they
+    survive a server restart without re-registering. All the nodes are
+    cached in memory, thus the lookups do not touch the database. The
+    added, updated and removed nodes are written in a single batched
+    transaction every ``flush_interval`` seconds by a background thread.
+
+    The nodes' controllers are stored by the applications' names and are
+    restored when Kaylee binds the registry to the loaded applications.
+    A node subscribed to an application which is no longer loaded is
+    unsubscribed.
+
+    :param path: the database file path.
+    :param flush_interval: the interval (in seconds) between the batched
+                           writes. ``0`` means that every modification is
+                           written immediately.
+    """
+    def __init__(self, timeout, path, flush_interval=1):
+        super(SQLiteNodesRegistry, self).__init__(timeout)
+        self.path = path
+        self.flush_interval = float(flush_interval)
+        if self.flush_interval < 0:
+            raise ValueError('The flush interval must be non-negative')
+        self._nodes = MemoryNodesRegistry(timeout)
+        # {NodeID.binary : Node or None (removed node)}
+        self._pending = {}
+        self._lock = threading.Lock()
+        # {NodeID.binary : application name} of the restored nodes.
+        # The registry may be bound more than once (e.g. by the Kaylee
+        # object and by AsyncKaylee.wrap()), so the names are kept.
+        self._restored = {}
+
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db_lock = threading.Lock()
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS nodes ('
+                         'id BLOB PRIMARY KEY, '
+                         'last_activity INTEGER NOT NULL, '
+                         'state BLOB NOT NULL)')
+        self._load()
+
+        self._stopped = threading.Event()
+        ref = weakref.ref(self)
+        if self.flush_interval > 0:
+            threading.Thread(target=_flush_periodically,
+                             args=(ref, self._stopped, self.flush_interval),
+                             daemon=True).start()
+        atexit.register(_close_registry, ref)
+
+    def add(self, node):
+        self._nodes.add(node)
+        self._modified(node.id.binary, node)
+
+    def update(self, node):
+        self._nodes.update(node)
+        self._modified(node.id.binary, node)
+
+    def clean(self):
+        removed = self._nodes.clean()
+        if removed:
+            with self._lock:
+                for node in removed:
+                    self._pending[node.id.binary] = None
+            if self.flush_interval == 0:
+                self.flush()
+        return removed
+
+    def bind(self, applications):
+        with self._lock:
+            restored = dict(self._restored)
+        for binary, app_name in restored.items():
+            node = self._nodes[binary] if binary in self._nodes else None
+            if (node is None or (node.controller is not None and
+                                 node.controller.name != app_name)):
+                # the node is gone or has subscribed to another application
+                with self._lock:
+                    self._restored.pop(binary, None)
+                continue
+            state = list(node.__getstate__())
+            if app_name in applications:
+                state[2] = applications[app_name]
+            else:
+                with self._lock:
+                    self._restored.pop(binary, None)
+                # controller, task id, task ids, subscription and task
+                # timestamps
+                state[2] = None
+                state[4:8] = (None, (), None, None)
+            node = Node.from_state(tuple(state))
+            self._nodes.add(node)
+            if app_name not in applications:
+                self._modified(binary, node)
+
+    def flush(self):
+        """Writes the pending modifications to the database."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        rows = []
+        removed = []
+        for binary, node in pending.items():
+            if node is None:
+                removed.append((binary, ))
+            else:
+                rows.append(self._row(node))
+        with self._db_lock:
+            with self._db:
+                self._db.execute('BEGIN')
+                self._db.executemany('DELETE FROM nodes WHERE id = ?',
+                                     removed)
+                self._db.executemany('INSERT OR REPLACE INTO nodes '
+                                     'VALUES (?, ?, ?)', rows)
+
+    def close(self):
+        """Stops the background writes, flushes the pending modifications
+        and closes the database."""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __delitem__(self, node):
+        binary = node_key(node)
+        if binary in self._nodes:
+            del self._nodes[binary]
+            self._modified(binary, None)
+
+    def __getitem__(self, node_id):
+        return self._nodes[node_id]
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def _modified(self, binary, node):
+        with self._lock:
+            self._pending[binary] = node
+        if self.flush_interval == 0:
+            self.flush()
+
+    def _load(self):
+        with self._db_lock:
+            rows = self._db.execute('SELECT id, last_activity, state '
+                                    'FROM nodes').fetchall()
+        for binary, last_activity, state in rows:
+            (codec, app_name, session_data, task_id, task_ids,
+             subscription_timestamp, task_timestamp,
+             score) = pickle.loads(state)
+            node = Node.from_state((NodeID(binary), codec, None,
+                                    session_data, task_id, task_ids,
+                                    subscription_timestamp, task_timestamp,
+                                    last_activity, score))
+            self._nodes.add(node)
+            if app_name is not None:
+                self._restored[binary] = app_name
+
+    @staticmethod
+    def _row(node):
+        (node_id, codec, controller, session_data, task_id, task_ids,
+         subscription_timestamp, task_timestamp,
+         last_activity, score) = node.__getstate__()
+        app_name = controller.name if controller is not None else None
+        state = pickle.dumps((codec, app_name, session_data, task_id,
+                              task_ids, subscription_timestamp,
+                              task_timestamp, score), pickle.HIGHEST_PROTOCOL)
+        return (node_id.binary, last_activity, state)
+
+
+def _flush_periodically(ref, stopped, interval):
+    # the thread refers to the registry weakly, so that the registry
+    # can be garbage collected.
+    while not stopped.wait(interval):
+        registry = ref()
+        if registry is None:
+            return
+        registry.flush()
+        del registry
+
+
+def _close_registry(ref):
+    registry = ref()
+    if registry is not None:
+        registry.close()
+
+
+class SharedMemoryNodesRegistry(NodesRegistry):
+    """Keeps the nodes in a memory-mapped file, so that all the worker
+    processes of a pre-fork server (on the same machine) share the
+    nodes. The file consists of a header and a hash table of fixed-size
+    records keyed by :attr:`NodeID.binary` with open addressing (linear
+    probing). The access is serialized by a POSIX file lock. A removed
+    record is marked as such (so that the probing continues past it) and
+    is reused by the next added node. Once the marked records take more
+    than 1/8 of the table, the table is rehashed in place.
+
+    A record keeps the node's state pickled, its controller is referred
+    to by the application name. A :class:`Node` object is constructed
+    on every lookup, thus a modified node has to be stored back via
+    :meth:`update`.
+
+    :param path: the path of the shared file. The file is created by the
+                 first process, the capacity and the record size of an
+                 existing file are used as is.
+    :param capacity: the maximum amount of nodes.
+    :param record_size: the size of a record in bytes. The pickled
+                        state of a node (including its session data)
+                        should fit into ``record_size - 21`` bytes.
+    """
+    # magic, capacity, record size, nodes count, removed records count
+    _HEADER = struct.Struct('>4sIIII')
+    _COUNT_OFFSET = 12
+    _REMOVED_COUNT_OFFSET = 16
+    # the share of the removed records which triggers rehashing
+    _REHASH_RATIO = 0.125
+    # flag, NodeID.binary, last activity, payload length
+    _RECORD = struct.Struct('>B10sqH')
+    _ACTIVITY_OFFSET = 11
+    _MAGIC = b'KLNR'
+    _EMPTY, _USED, _REMOVED = 0, 1, 2
+
+    def __init__(self, timeout, path, capacity=65536, record_size=256):
+        super(SharedMemoryNodesRegistry, self).__init__(timeout)
+        if fcntl is None:
+            raise KayleeError('SharedMemoryNodesRegistry requires POSIX '
+                              'file locking (the fcntl module)')
+        capacity = int(capacity)
+        record_size = int(record_size)
+        if capacity < 1:
+            raise ValueError('The capacity must be positive')
+        if record_size <= self._RECORD.size:
+            raise ValueError('The record size must be greater than {}'
+                             .format(self._RECORD.size))
+        self.path = path
+        # {application name : controller}
+        self._controllers = {}
+        # fcntl locks are held per process, the threads are serialized
+        # by a regular lock.
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self._fd, self._HEADER.size, 0)
+            if not header:
+                size = self._HEADER.size + capacity * record_size
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, self._HEADER.pack(self._MAGIC, capacity,
+                                                      record_size, 0, 0), 0)
+            else:
+                magic, capacity, record_size, _, _ = \
+                    self._HEADER.unpack(header)
+                if magic != self._MAGIC:
+                    raise KayleeError('"{}" is not a Kaylee nodes registry '
+                                      'file'.format(path))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self.capacity = capacity
+        self.record_size = record_size
+        self._mmap = mmap.mmap(self._fd,
+                               self._HEADER.size + capacity * record_size)
+        self._max_removed = max(1, int(capacity * self._REHASH_RATIO))
+
+    def add(self, node):
+        binary = node.id.binary
+        record = self._record(node)
+        with self._locked():
+            offset, free = self._find(binary)
+            if offset is None:
+                if free is None:
+                    raise KayleeError('The nodes registry is full')
+                offset = free
+                if self._mmap[offset] == self._REMOVED:
+                    self._set_removed_count(self._removed_count() - 1)
+                self._set_count(len(self) + 1)
+            self._mmap[offset:offset + len(record)] = record
+
+    def update(self, node):
+        with self._locked():
+            offset, _ = self._find(node.id.binary)
+            if offset is None:
+                raise KeyError('Cannot update node in registry: '
+                               'node {} was not found'.format(node))
+            if node.dirty:
+                record = self._record(node)
+                self._mmap[offset:offset + len(record)] = record
+
+    def clean(self):
+        #pylint: disable-msg=E1101
+        #E1101: Instance of 'timedelta' has no 'total_seconds' member
+        border = int(time.time() - self.timeout.total_seconds())
+        with self._locked():
+            mm = self._mmap
+            offsets = [offset for offset in self._used_offsets()
+                       if struct.unpack_from('>q', mm, offset +
+                                             self._ACTIVITY_OFFSET)[0]
+                       < border]
+            removed = [self._node(offset) for offset in offsets]
+            self._remove(offsets)
+        return removed
+
+    def bind(self, applications):
+        for name in applications.names:
+            self._controllers[name] = applications[name]
+
+    def close(self):
+        """Unmaps and closes the shared file."""
+        self._mmap.close()
+        os.close(self._fd)
+
+    def __len__(self):
+        return struct.unpack_from('>I', self._mmap, self._COUNT_OFFSET)[0]
+
+    def __delitem__(self, node):
+        binary = node_key(node)
+        with self._locked():
+            offset, _ = self._find(binary)
+            if offset is not None:
+                self._remove([offset])
+
+    def __getitem__(self, node_id):
+        binary = node_key(node_id)
+        with self._locked():
+            offset, _ = self._find(binary)
+            if offset is None:
+                raise KeyError(node_id)
+            return self._node(offset)
+
+    def __contains__(self, node):
+        binary = node_key(node)
+        with self._locked():
+            return self._find(binary)[0] is not None
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _offsets(self, start=0):
+        """Yields the offsets of the records in the probing order."""
+        header_size = self._HEADER.size
+        for i in range(self.capacity):
+            yield (header_size +
+                   ((start + i) % self.capacity) * self.record_size)
+
+    def _find(self, binary):
+        """Returns ``(offset, free_offset)``, where offset is the offset
+        of the node's record (or None) and free_offset is the offset of the
+        first record available for the node (or None)."""
+        # hash() of bytes differs between the processes
+        start = zlib.crc32(binary) % self.capacity
+        mm = self._mmap
+        free = None
+        for offset in self._offsets(start):
+            flag = mm[offset]
+            if flag == self._EMPTY:
+                return None, (offset if free is None else free)
+            elif flag == self._REMOVED:
+                if free is None:
+                    free = offset
+            elif mm[offset + 1:offset + 11] == binary:
+                return offset, None
+        return None, free
+
+    def _used_offsets(self):
+        """Returns the offsets of the used records in the table order."""
+        header_size = self._HEADER.size
+        # the records' flags, the unused records are skipped by find()
+        flags = self._mmap[header_size::self.record_size]
+        used = bytes([self._USED])
+        offsets = []
+        i = flags.find(used)
+        while i != -1:
+            offsets.append(header_size + i * self.record_size)
+            i = flags.find(used, i + 1)
+        return offsets
+
+    def _remove(self, offsets):
+        """Marks the records as removed."""
+        if not offsets:
+            return
+        for offset in offsets:
+            self._mmap[offset] = self._REMOVED
+        self._set_count(len(self) - len(offsets))
+        removed_count = self._removed_count() + len(offsets)
+        if removed_count > self._max_removed:
+            self._rehash()
+        else:
+            self._set_removed_count(removed_count)
+
+    def _rehash(self):
+        """Re-inserts the used records into the table cleared of the
+        removed records."""
+        mm = self._mmap
+        records = [mm[offset:offset + self.record_size]
+                   for offset in self._used_offsets()]
+        mm[self._HEADER.size::self.record_size] = bytes(self.capacity)
+        for record in records:
+            _, offset = self._find(record[1:11])
+            mm[offset:offset + self.record_size] = record
+        self._set_removed_count(0)
+
+    def _set_count(self, count):
+        struct.pack_into('>I', self._mmap, self._COUNT_OFFSET, count)
+
+    def _removed_count(self):
+        return struct.unpack_from('>I', self._mmap,
+                                  self._REMOVED_COUNT_OFFSET)[0]
+
+    def _set_removed_count(self, count):
+        struct.pack_into('>I', self._mmap, self._REMOVED_COUNT_OFFSET, count)
+
+    def _record(self, node):
+        (node_id, codec, controller, session_data, task_id, task_ids,
+         subscription_timestamp, task_timestamp,
+         last_activity, score) = node.__getstate__()
+        app_name = None
+        if controller is not None:
+            app_name = controller.name
+            self._controllers.setdefault(app_name, controller)
+        payload = pickle.dumps((codec, app_name, session_data, task_id,
+                                task_ids, subscription_timestamp,
+                                task_timestamp, score),
+                               pickle.HIGHEST_PROTOCOL)
+        if self._RECORD.size + len(payload) > self.record_size:
+            raise KayleeError('The state of node {} does not fit into a '
+                              '{} bytes record'.format(node_id,
+                                                       self.record_size))
+        return self._RECORD.pack(self._USED, node_id.binary, last_activity,
+                                 len(payload)) + payload
 
+    def _node(self, offset):
+        _, binary, last_activity, length = \
+            self._RECORD.unpack_from(self._mmap, offset)
+        start = offset + self._RECORD.size
+        (codec, app_name, session_data, task_id, task_ids,
+         subscription_timestamp, task_timestamp, score) = \
+            pickle.loads(self._mmap[start:start + length])
+        return Node.from_state((NodeID.from_binary(binary), codec,
+                                self._controllers.get(app_name),
+                                session_data, task_id, task_ids,
+                                subscription_timestamp, task_timestamp,
+                                last_activity, score))
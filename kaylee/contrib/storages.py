@@ -11,10 +11,11 @@
 #pylint: disable-msg=W0231
 
 from kaylee.storage import TemporalStorage, PermanentStorage
-from kaylee.node import NodeID
+from kaylee.node import NodeID, node_key
 
 class MemoryTemporalStorage(TemporalStorage):
-    """A simple Python dict-based temporal results storage."""
+    """A simple Python dict-based temporal results storage. The results
+    of a task are keyed by :attr:`NodeID.binary`."""
 
     def __init__(self):
         self._d = {}
@@ -23,7 +24,7 @@ class MemoryTemporalStorage(TemporalStorage):
 
     def add(self, task_id, node_id, result):
         d = self._d.get(task_id, {})
-        d[node_id.binary] = result
+        d[node_key(node_id)] = result
         self._d[task_id] = d
         self._total_count += 1
 
@@ -32,7 +33,7 @@ class MemoryTemporalStorage(TemporalStorage):
             deleted_results = self._d.pop(task_id)
             self._total_count -= len(deleted_results)
         else:
-            del self._d[task_id][node_id]
+            del self._d[task_id][node_key(node_id)]
             self._total_count -= 1
 
     def clear(self):
@@ -41,16 +42,17 @@ class MemoryTemporalStorage(TemporalStorage):
 
     def __getitem__(self, task_id):
         nr_dict = self._d[task_id]
-        return {NodeID(n): r for n, r in nr_dict.items()}
+        from_binary = NodeID.from_binary
+        return {from_binary(n): r for n, r in nr_dict.items()}
 
     def contains(self, task_id, node_id=None, result=None):
         try:
             if result is None and node_id is None:
                 return task_id in self._d
             elif result is None:
-                return node_id in self._d[task_id]
+                return node_key(node_id) in self._d[task_id]
             else:
-                return result in self._d[task_id][node_id]
+                return result in self._d[task_id][node_key(node_id)]
         except KeyError:
             return False
 
@@ -67,10 +69,10 @@ class MemoryTemporalStorage(TemporalStorage):
 
     def values(self):
         def node_result_tuple_generator():
+            from_binary = NodeID.from_binary
             for nr_dict in self._d.values():
-                for nid_res_tuple in nr_dict.items():
-                    # in Py3 yield from would be proper here
-                    yield nid_res_tuple
+                for binary, result in nr_dict.items():
+                    yield from_binary(binary), result
         return node_result_tuple_generator()
 
 
@@ -8,9 +8,22 @@
     :copyright: (c) 2012 by Zaur Nasibov.
     :license: MIT, see LICENSE for more details.
 """
+import io
 import re
+import time
+import heapq
+import bisect
+import pickle
+import itertools
+from hashlib import sha256
+from collections import OrderedDict, deque
+from datetime import timedelta
 from abc import ABCMeta, abstractmethod
 
+from .node import node_key
+from .util import parse_timedelta
+from .errors import NodeRequestRejectedError
+
 
 #: The Application name regular expression pattern which can be used in
 #: e.g. web frameworks' URL dispatchers.
@@ -23,6 +36,10 @@ COMPLETED = 0x4
 
 KL_RESULT = '__klr__'
 
+# a fixed protocol keeps the results' digests stable across the Python
+# versions
+_DIGEST_PICKLE_PROTOCOL = 4
+
 #: The ``NO_SOLUTION`` result returned by the node indicates that no solution
 #: was found for the given task. The controller must take this information
 #: into account.
@@ -33,6 +50,13 @@ NO_SOLUTION = { KL_RESULT : 0x2 }
 #: accept.
 NOT_SOLVED = { KL_RESULT : 0x4 }
 
+#: The default maximum amount of tasks which can be leased to a node
+#: by a single batched request (see :meth:`Controller.get_tasks`).
+#: The value of 1 disables batched requests on the client side.
+DEFAULT_TASKS_BATCH_LIMIT = 1
+
+KL_TASKS_BATCH_LIMIT = '__kl_tasks_batch_limit__'
+
 
 class Controller(object, metaclass=ABCMeta):
     """A Controller object maintains the data (tasks and the results) flow
@@ -49,6 +73,12 @@ class Controller(object, metaclass=ABCMeta):
     :type project: :class:`Project`
     :type permanent_storage: :class:`PermanentStorage`
     :type temporal_storage: :class:`TemporalStorage`
+
+    The following keyword arguments are recognized by all controllers:
+
+    :param tasks_batch_limit: the maximum amount of tasks leased to
+                              a node per batched request (see
+                              :meth:`get_tasks`).
     """
 
 
@@ -63,17 +93,54 @@ class Controller(object, metaclass=ABCMeta):
         self.project = project
         self.permanent_storage = permanent_storage
         self.temporal_storage = temporal_storage
+        self.tasks_batch_limit = kwargs.get('tasks_batch_limit',
+                                            DEFAULT_TASKS_BATCH_LIMIT)
+        if self.tasks_batch_limit < 1:
+            raise ValueError('tasks_batch_limit must be a positive number, '
+                             'not {}'.format(self.tasks_batch_limit))
         self._state = ACTIVE
+        self._tasks_listeners = []
 
     @abstractmethod
     def get_task(self, node):
-        """Returns a task for the node.
+        """Returns a task for the node or ``None`` if there are no tasks
+        to hand out right now.
 
         :param node: Kaylee Node requesting the task for computation.
         :type node: :class:`Node`
         :throws ApplicationCompletedError: if the application is completed.
         """
 
+    def get_tasks(self, node, count):
+        """Returns a list of at most ``count`` tasks for the node and leases
+        them to the node (see :attr:`Node.task_ids`). The amount of tasks is
+        limited by ``tasks_batch_limit``. The batch is cut short if the
+        controller runs out of tasks or offers a task which is already in
+        the batch.
+
+        :param node: Kaylee Node requesting the tasks for computation.
+        :param count: the requested amount of tasks.
+        :type node: :class:`Node`
+        :throws ApplicationCompletedError: if the application is completed
+                                           and no tasks could be returned.
+        """
+        count = max(1, min(count, self.tasks_batch_limit))
+        tasks = []
+        task_ids = []
+        for _ in range(count):
+            try:
+                task = self.get_task(node)
+            except NodeRequestRejectedError:
+                if not tasks:
+                    raise
+                break
+            if task is None or node.task_id in task_ids:
+                break
+            tasks.append(task)
+            task_ids.append(node.task_id)
+        node.lease_tasks(task_ids)
+        return tasks
+
     @abstractmethod
     def accept_result(self, node, result):
         """Accepts and processes the results from a node.
@@ -83,6 +150,50 @@ class Controller(object, metaclass=ABCMeta):
         :type result: :class:`dict` or :class:`list`
         """
 
+    def add_tasks_listener(self, callback):
+        """Registers a callback which is invoked (with no arguments) when
+        new tasks become available (see :meth:`notify_tasks_available`).
+        The callback may be invoked from any thread."""
+        self._tasks_listeners.append(callback)
+
+    def remove_tasks_listener(self, callback):
+        """Removes the previously added tasks callback."""
+        try:
+            self._tasks_listeners.remove(callback)
+        except ValueError:
+            pass
+
+    def notify_tasks_available(self):
+        """Notifies the listeners (e.g. the nodes waiting for a task in
+        long-poll mode) that the controller has got tasks to hand out.
+        Should be called by the controller or by the bound project's
+        routines whenever the tasks are added after :meth:`get_task`
+        returned ``None``."""
+        for callback in list(self._tasks_listeners):
+            callback()
+
+    def release_tasks(self, node):
+        """Called when the node leaves Kaylee (e.g. is evicted from the
+        nodes registry) without returning the results of its leased tasks
+        (see :attr:`Node.task_ids`). The controller should make the tasks
+        available to other nodes. The default implementation does
+        nothing."""
+
+    def reissue_due_in(self):
+        """Returns the amount of seconds (:class:`float`) in which an
+        outstanding task is due to be re-issued or ``None`` if no
+        re-issues are planned."""
+        return None
+
+    @property
+    def client_config(self):
+        """The configuration passed to the client-side of the application
+        on subscription. It is the project's ``client_config`` extended by
+        the controller's options."""
+        config = dict(self.project.client_config)
+        config[KL_TASKS_BATCH_LIMIT] = self.tasks_batch_limit
+        return config
+
     def store_result(self, task_id, result):
         """Stores the result to permanent storage and notifies the bound
         project."""
@@ -103,3 +214,360 @@ class Controller(object, metaclass=ABCMeta):
 
     def __hash__(self):
         return hash(self.name)
+
+
+class TaskLeases(object):
+    """Keeps track of the outstanding tasks: the nodes to which a task
+    is leased (the owners) and the time when it was issued. A lease
+    expires in ``timeout`` seconds after the task was (re-)issued or
+    immediately when the last owner leaves. The expired leases are kept
+    in a heap, so that the task whose lease has expired first is the
+    first to be re-issued.
+
+    :param timeout: the lease timeout: the amount of seconds or a string
+                    like ``'5m'`` (see :attr:`NodesRegistry.timeout`).
+    :type timeout: int, float, str or :class:`datetime.timedelta`
+    """
+    def __init__(self, timeout):
+        if isinstance(timeout, str):
+            timeout = parse_timedelta(timeout)
+        if isinstance(timeout, timedelta):
+            timeout = timeout.total_seconds()
+        if timeout < 0:
+            raise ValueError('The lease timeout must be non-negative')
+        #: The lease timeout in seconds.
+        self.timeout = float(timeout)
+        # {task id : _Lease} in the order of the last (re-)issue
+        self._leases = OrderedDict()
+        # [(expiration time, sequence number, task id)], the entries
+        # which do not match the current lease expiration time are stale
+        self._heap = []
+        self._seq = itertools.count()
+
+    def issue(self, task_id, node):
+        """Leases the task to the node. A task which is already leased
+        is re-issued: the node is added to its owners and the lease
+        timeout is restarted."""
+        now = time.monotonic()
+        lease = self._leases.get(task_id)
+        if lease is None:
+            lease = self._leases[task_id] = _Lease(now)
+        else:
+            self._leases.move_to_end(task_id)
+        lease.owners[node_key(node)] = now
+        lease.last_issued_at = now
+        self._expire_at(task_id, lease, now + self.timeout)
+
+    def reissue(self, node):
+        """Re-issues the task whose lease has expired first to the node.
+        Returns the task id or ``None`` if there are no expired leases."""
+        heap = self._heap
+        now = time.monotonic()
+        while heap and heap[0][0] <= now:
+            expires, _, task_id = heapq.heappop(heap)
+            lease = self._leases.get(task_id)
+            if lease is not None and lease.expires == expires:
+                self.issue(task_id, node)
+                return task_id
+        return None
+
+    def release(self, task_id):
+        """Removes the lease of the task (e.g. when the task is solved).
+        Returns ``False`` if the task is not leased."""
+        return self._leases.pop(task_id, None) is not None
+
+    def release_owner(self, task_id, node):
+        """Removes the node from the owners of the task (e.g. when the node
+        leaves Kaylee). The lease expires immediately if the task has no
+        other owners."""
+        lease = self._leases.get(task_id)
+        if lease is None:
+            return
+        lease.owners.pop(node_key(node), None)
+        if not lease.owners:
+            self._expire_at(task_id, lease, time.monotonic())
+
+    def owners(self, task_id):
+        """Returns the ids (binary) of the nodes to which the task is
+        leased."""
+        return frozenset(self._leases[task_id].owners)
+
+    def issued_at(self, task_id, node=None):
+        """Returns the time (:func:`time.monotonic`) at which the task was
+        first issued or, if the node is given, issued to the node."""
+        lease = self._leases[task_id]
+        if node is None:
+            return lease.issued_at
+        return lease.owners[node_key(node)]
+
+    def overdue(self, age, node):
+        """Returns the id of the task which has been leased to a single
+        node (other than the given node) for the longest time, if longer
+        than ``age`` seconds. Returns ``None`` otherwise."""
+        key = node_key(node)
+        deadline = time.monotonic() - age
+        for task_id, lease in self._leases.items():
+            if lease.last_issued_at > deadline:
+                break
+            if len(lease.owners) == 1 and key not in lease.owners:
+                return task_id
+        return None
+
+    def overdue_in(self, age):
+        """Returns the amount of seconds in which a task leased to a
+        single node becomes overdue (see :meth:`overdue`) or ``None`` if
+        there are no such tasks."""
+        for lease in self._leases.values():
+            if len(lease.owners) == 1:
+                return max(0.0, lease.last_issued_at + age - time.monotonic())
+        return None
+
+    def __iter__(self):
+        return iter(self._leases)
+
+    def due_in(self):
+        """Returns the amount of seconds in which the first lease expires
+        (``0`` if it has already expired) or ``None`` if there are no
+        leases."""
+        heap = self._heap
+        while heap:
+            expires, _, task_id = heap[0]
+            lease = self._leases.get(task_id)
+            if lease is not None and lease.expires == expires:
+                return max(0.0, expires - time.monotonic())
+            heapq.heappop(heap)
+        return None
+
+    def __contains__(self, task_id):
+        return task_id in self._leases
+
+    def __len__(self):
+        return len(self._leases)
+
+    def _expire_at(self, task_id, lease, expires):
+        lease.expires = expires
+        heapq.heappush(self._heap, (expires, next(self._seq), task_id))
+        # drop the stale entries once they outnumber the leases
+        if len(self._heap) > 2 * len(self._leases) + 64:
+            self._heap = [(other.expires, next(self._seq), tid)
+                          for tid, other in self._leases.items()]
+            heapq.heapify(self._heap)
+
+
+class _Lease(object):
+    __slots__ = ('owners', 'issued_at', 'last_issued_at', 'expires')
+
+    def __init__(self, issued_at):
+        # {node id (binary) : issue time}
+        self.owners = {}
+        self.issued_at = issued_at
+        self.last_issued_at = issued_at
+        self.expires = None
+
+
+class CompletionTimes(object):
+    """Collects the running distribution of the tasks' completion times
+    (the time between a task is issued to a node and the node's result is
+    accepted) and the average completion time of every node.
+
+    :param window: the amount of the recent completion times which form
+                   the distribution.
+    :param min_samples: the least amount of the completion times required
+                        to estimate the distribution.
+    :param node_weight: the weight of the latest completion time in the
+                        node's (exponentially weighted) average.
+    """
+    def __init__(self, window=256, min_samples=10, node_weight=0.3):
+        self.min_samples = min_samples
+        self.node_weight = node_weight
+        self._times = deque(maxlen=window)
+        self._median = None
+        # {node id (binary) : average completion time}
+        self._nodes = {}
+
+    def record(self, node, seconds):
+        """Records the completion time of a task solved by the node."""
+        self._times.append(seconds)
+        self._median = None
+        key = node_key(node)
+        average = self._nodes.get(key)
+        if average is None:
+            self._nodes[key] = seconds
+        else:
+            self._nodes[key] = average + self.node_weight * (seconds -
+                                                             average)
+
+    def median(self):
+        """Returns the median completion time or ``None`` if there are not
+        enough completion times collected."""
+        if self._median is None and len(self._times) >= self.min_samples:
+            times = sorted(self._times)
+            self._median = times[len(times) // 2]
+        return self._median
+
+    def node_average(self, node):
+        """Returns the average completion time of the node or ``None``."""
+        return self._nodes.get(node_key(node))
+
+    def is_fast(self, node):
+        """Checks whether the node completes the tasks not slower than
+        the median completion time."""
+        median = self.median()
+        average = self._nodes.get(node_key(node))
+        return (median is not None and average is not None and
+                average <= median)
+
+    def forget(self, node):
+        """Removes the node's average (e.g. when the node leaves)."""
+        self._nodes.pop(node_key(node), None)
+
+
+class NodeScores(object):
+    """Collects the benchmark scores (see :attr:`Node.score`) of the
+    recently served nodes and ranks the speed of a node among them.
+
+    :param window: the amount of the recently served nodes whose scores
+                   are kept.
+    :param min_samples: the least amount of the scores required to rank
+                        the nodes.
+    """
+    def __init__(self, window=256, min_samples=4):
+        self.window = window
+        self.min_samples = max(min_samples, 2)
+        # {node id (binary) : score} in the order of the nodes' requests
+        self._scores = OrderedDict()
+        self._sorted = None
+
+    def record(self, node):
+        """Records the score of the node, if the node has one."""
+        score = node.score
+        if score is None:
+            return
+        key = node_key(node)
+        scores = self._scores
+        if scores.get(key) != score:
+            self._sorted = None
+        scores[key] = score
+        scores.move_to_end(key)
+        if len(scores) > self.window:
+            scores.popitem(last=False)
+            self._sorted = None
+
+    def rank(self, node):
+        """Returns the share of the recorded nodes which are slower than
+        the node: a number from ``0`` (the slowest node) to ``1`` (the
+        fastest) or ``None`` if the node's score is unknown or there are
+        not enough scores recorded."""
+        score = node.score
+        if score is None or len(self._scores) < self.min_samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self._scores.values())
+        scores = self._sorted
+        # the node itself and a half of the equal scores are not counted
+        lower = bisect.bisect_left(scores, score)
+        upper = bisect.bisect_right(scores, score)
+        rank = (lower + upper - 1) / 2 / (len(scores) - 1)
+        return min(max(rank, 0.0), 1.0)
+
+    def forget(self, node):
+        """Removes the node's score (e.g. when the node leaves)."""
+        if self._scores.pop(node_key(node), None) is not None:
+            self._sorted = None
+
+
+class Throughputs(object):
+    """Collects the throughput of every node: the (exponentially weighted)
+    average amount of the work units solved per second.
+
+    :param node_weight: the weight of the latest measurement in the
+                        node's average.
+    """
+    def __init__(self, node_weight=0.3):
+        self.node_weight = node_weight
+        # {node id (binary) : average throughput}
+        self._nodes = {}
+        self._median = None
+
+    def record(self, node, units, seconds):
+        """Records that the node has solved ``units`` work units in
+        ``seconds``."""
+        # the clock resolution
+        throughput = units / max(seconds, 0.001)
+        key = node_key(node)
+        average = self._nodes.get(key)
+        if average is None:
+            self._nodes[key] = throughput
+        else:
+            self._nodes[key] = average + self.node_weight * (throughput -
+                                                             average)
+        self._median = None
+
+    def node_throughput(self, node):
+        """Returns the average throughput of the node or ``None``."""
+        return self._nodes.get(node_key(node))
+
+    def median(self):
+        """Returns the median of the nodes' throughputs or ``None`` if no
+        throughput has been recorded."""
+        if self._median is None and self._nodes:
+            throughputs = sorted(self._nodes.values())
+            self._median = throughputs[len(throughputs) // 2]
+        return self._median
+
+    def forget(self, node):
+        """Removes the node's average (e.g. when the node leaves)."""
+        if self._nodes.pop(node_key(node), None) is not None:
+            self._median = None
+
+
+# the types of the values which are kept as they are in the canonical form
+_SCALAR_TYPES = frozenset([str, int, bool, type(None)])
+
+
+def _canonical(value):
+    # a dict is replaced by the list of its items sorted by key, a list
+    # or a tuple by a tuple, thus no other lists are left in the canonical
+    # form. An integral float is replaced by int, since the equal numbers
+    # must have the same digest (bool is pickled as a type of its own).
+    cls = type(value)
+    if cls is float:
+        return int(value) if value.is_integer() else value
+    elif cls is dict:
+        return sorted((_canonical(k), _canonical(v))
+                      for k, v in value.items())
+    elif cls is list or cls is tuple:
+        if _SCALAR_TYPES.issuperset(map(type, value)):
+            return tuple(value)
+        try:
+            if not any(map(float.is_integer, value)):
+                return tuple(value)
+        except TypeError:
+            # not only floats in the sequence
+            pass
+        return tuple(map(_canonical, value))
+    return value
+
+
+def result_digest(result):
+    """Returns the SHA-256 digest (:class:`bytes`) of a normalized result.
+    The result is canonicalized first: the dicts' items are sorted by key
+    and the lists are treated as tuples, thus the equal JSON-like results
+    have the same digest regardless of the keys' order. The results whose
+    dicts' keys are not comparable are digested as they are.
+
+    .. note:: The numbers are compared by value, e.g. ``1`` and ``1.0``
+              have the same digest, but ``True`` and ``1`` have
+              different digests.
+    """
+    try:
+        canonical = _canonical(result)
+    except TypeError:
+        canonical = result
+    buf = io.BytesIO()
+    pickler = pickle.Pickler(buf, _DIGEST_PICKLE_PROTOCOL)
+    # the memo would make the equal results which share some of the
+    # objects differ
+    pickler.fast = True
+    pickler.dump(canonical)
+    return sha256(buf.getvalue()).digest()
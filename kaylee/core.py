@@ -11,15 +11,17 @@
 """
 
 import sys
-import json
+import time
+import threading
 import traceback
 import logging
 from io import StringIO
-from functools import partial
 from contextlib import closing
 from functools import wraps
 
-from .node import Node, NodeID
+from .node import Node, NodeID, parse_score
+from .tokens import NodeTokens, is_node_token
+from .codecs import get_codec, negotiate, DEFAULT_CODEC
 from .errors import (KayleeError, InvalidResultError, NodeRequestRejectedError)
 
 from .controller import KL_RESULT
@@ -27,13 +29,19 @@ from .util import DictAsObjectWrapper
 
 log = logging.getLogger(__name__)
 
-#: Returns the results of :function:`json.dumps` in compact encoding
-json.dumps = partial(json.dumps, separators=(',', ':'))
-
 ACTION_TASK = 'task'
+ACTION_TASKS = 'tasks'
 ACTION_UNSUBSCRIBE = 'unsubscribe'
 ACTION_NOP = 'nop'
 
+#: The result's key which refers to one of the tasks leased to the node
+#: by a batched request (see :meth:`Kaylee.get_action`).
+KL_TASK_ID = '__kl_task_id__'
+
+#: The client configuration's key which refers to the node token updated
+#: by the subscription in the stateless mode (see :config:`NODE_TOKENS`).
+KL_NODE_ID = '__kl_node_id__'
+
 
 def json_error_handler(f):
     """A decorator that wraps a function into try..catch block and returns
@@ -46,27 +54,35 @@ def json_error_handler(f):
         try:
             return f(*args, **kwargs)
         except Exception as e:
-            exc_str = str(e)
-            if log.getEffectiveLevel() == logging.DEBUG:
-                with closing(StringIO()) as buf:
-                    # exc_type, exc_value, exc_traceback = sys.exc_info()
-                    exc_traceback = sys.exc_info()[2]
-                    traceback.print_tb(exc_traceback,
-                                       limit= None,
-                                       file= buf)
-                    exc_str += '\n' + buf.getvalue()
-            return json.dumps({'error': exc_str })
+            return json_error(e)
 
     return wrapper
 
 
+def json_error(e):
+    """Returns JSON-formatted "{ error : str(e) }". The traceback is
+    attached to the error message on the DEBUG logging level."""
+    exc_str = str(e)
+    if log.getEffectiveLevel() == logging.DEBUG:
+        with closing(StringIO()) as buf:
+            # exc_type, exc_value, exc_traceback = sys.exc_info()
+            exc_traceback = sys.exc_info()[2]
+            traceback.print_tb(exc_traceback,
+                               limit= None,
+                               file= buf)
+            exc_str += '\n' + buf.getvalue()
+    return get_codec(DEFAULT_CODEC).encode({'error': exc_str })
+
+
 class Kaylee(object):
     """The Kaylee class serves as a layer between a WSGI server (framework)
     and Kaylee applications. The data flow between Kaylee server and the
-    client is kept in JSON format.
+    client is kept in JSON format, unless another codec is negotiated
+    by the node at registration (see :config:`CODECS`).
 
     .. note:: It is the job of the WSGI front-end to set the response
-              content-type to "application/json".
+              content-type returned by :func:`kaylee.codecs.content_type`
+              ("application/json" for JSON-formatted data).
 
     See :ref:`loading_kaylee_object` for  Kaylee object initialization and
     loading procedure.
@@ -90,32 +106,71 @@ class Kaylee(object):
         #: Active nodes registry (an instance of :class:`NodesRegistry`).
         self.registry = registry
 
+        #: The wire codecs (:class:`kaylee.codecs.Codec` objects) available
+        #: to the nodes, in the order of the server's preference.
+        self.codecs = [get_codec(name) for name in self.config.CODECS]
+        # {codec name : ResponseEncoder}, see _encoder()
+        self._encoders = {}
+
         self.session_data_manager = session_data_manager
         if applications is not None:
             self._applications = Applications(applications)
         else:
             self._applications = Applications.empty()
+        self.registry.bind(self._applications)
+
+        #: The node tokens serializer (:class:`kaylee.tokens.NodeTokens`)
+        #: in the stateless mode, ``None`` otherwise.
+        self.node_tokens = None
+        #pylint: disable-msg=E1101
+        if self.config.NODE_TOKENS:
+            secret_key = getattr(self.config, 'SECRET_KEY', None)
+            if not secret_key:
+                raise KayleeError('NODE_TOKENS requires the SECRET_KEY '
+                                  'to be set')
+            self.node_tokens = NodeTokens(secret_key, self.registry.timeout)
 
         log.info(str(self._applications))
 
 
     @json_error_handler
-    def register(self, remote_host):
+    def register(self, remote_host, accept=None, score=None):
         """Registers the remote host (browser) as Kaylee Node and returns
-        JSON-formatted data with the following fields:
+        the data with the following fields:
 
-        * node_id - node id (hex-formatted string)
+        * node_id - node id (hex-formatted string) or the node token in
+          the stateless mode (see :config:`NODE_TOKENS`).
         * config  - client configuration (see :ref:`settings`).
         * applications - a list of Kaylee applications' names.
+        * codec - the name of the codec negotiated for the node.
+
+        The codec is the first codec accepted by the node which is listed
+        in :config:`CODECS` (JSON if there is no such codec). The data sent
+        to the node and received from it, including the returned data,
+        is encoded by the negotiated codec.
 
         :param remote_host: the IP address of the remote host
+        :param accept: the codecs accepted by the node: an HTTP ``Accept``
+                       header value or a list of codec names or content
+                       types in the order of preference.
+        :param score: the node's benchmark score (see :attr:`Node.score`).
+                      A missing or invalid score leaves the node's speed
+                      unknown.
         :type remote_host: string
+        :type accept: string, list or None
+        :type score: number, string or None
         """
         node = Node(NodeID.for_host(remote_host))
-        self.registry.add(node)
-        return json.dumps ({ 'node_id' : str(node.id),
-                             'config' : self.config.client_config(),
-                             'applications' : self._applications.names } )
+        node.codec = negotiate(accept, self.codecs).name
+        node.score = parse_score(score)
+        if self.node_tokens is None:
+            self.registry.add(node)
+            node_id = str(node.id)
+        else:
+            node_id = self.node_tokens.dumps(node)
+        encoder = self._encoder(node)
+        return encoder.register(node_id, self.config.client_config(),
+                                self._applications.names)
 
     @json_error_handler
     def unregister(self, node_id):
@@ -123,10 +178,19 @@ class Kaylee(object):
         that the remote host (browser) disconnects or is disconnected from
         the Kaylee server.
 
+        The tasks leased by the node are released (see
+        :meth:`Controller.release_tasks`).
+
         :param node_id: a valid node id
         :type node_id: string
         """
-        del self.registry[node_id]
+        try:
+            node = self._node(node_id)
+        except KeyError:
+            return
+        if not self._is_token(node_id):
+            del self.registry[node_id]
+        self._release_tasks(node)
 
     @json_error_handler
     def subscribe(self, node_id, application):
@@ -138,32 +202,40 @@ class Kaylee(object):
         :param application: registered Kaylee application name
         :type node_id: string
         :type application: string
-        :returns: jsonified node configuration
+        :returns: encoded node configuration
         """
         try:
-            node = self.registry[node_id]
+            node = self._node(node_id)
         except KeyError:
             raise KayleeError('Node "{}" is not registered'.format(node_id))
 
         try:
             app = self._applications[application]
-            client_config = node.subscribe(app)
-            return json.dumps(client_config)
         except KeyError:
             raise KayleeError('Application "{}" was not found'
                               .format(application))
+        client_config = node.subscribe(app)
+        self._update_node(node)
+        if self.node_tokens is not None:
+            client_config = dict(client_config)
+            client_config[KL_NODE_ID] = self.node_tokens.dumps(node)
+        return self._codec(node).encode(client_config)
 
     @json_error_handler
     def unsubscribe(self, node_id):
-        """Unsubscribes the node from the bound application.
+        """Unsubscribes the node from the bound application. The tasks
+        leased by the node are released (see :meth:`Controller.release_tasks`).
 
         :param node_id: a valid node id.
         :type node_id: string
         """
-        self.registry[node_id].unsubscribe()
+        node = self._node(node_id)
+        self._release_tasks(node)
+        node.unsubscribe()
+        self._update_node(node)
 
     @json_error_handler
-    def get_action(self, node_id):
+    def get_action(self, node_id, count=None):
         """Returns an action (usually a task from the subscribed application).
         The format of the JSON response is::
 
@@ -176,6 +248,8 @@ class Kaylee(object):
         the attached data. The valid <actions> are:
 
         * **"task"** - indicated that <data> contains task data
+        * **"tasks"** - indicates that <data> contains a list of tasks
+          (returned if ``count`` is not ``None``).
         * **"unsubscribe"** - indicates that Kaylee server has unsubscribed
           the Node from the application. Any further action request by the
           node raises :class:`NodeNotSubscribedError
@@ -183,22 +257,29 @@ class Kaylee(object):
         * **"nop"** - indicates that no operation should be carried out by
           the node right now.
 
+        If the application has no tasks to hand out right now and
+        :config:`LONG_POLL_TIMEOUT` is set, the request is parked until
+        the application gets a task, a task re-issue becomes due, or the
+        timeout elapses (in which case the "nop" action is returned).
+
+        The results of the tasks received via the **"tasks"** action must
+        refer to the solved task via the ``"__kl_task_id__"`` key (see
+        :meth:`accept_result`).
+
+        In the stateless mode (see :config:`NODE_TOKENS`) the response
+        contains the ``"node_id"`` field: the node token which the node
+        must send with its next request.
+
         :param node_id: a valid node id
+        :param count: the amount of tasks requested by the node. The amount
+                      is limited by the application's ``tasks_batch_limit``
+                      (see :meth:`Controller.get_tasks`).
         :type node_id: string
+        :type count: int or None
         """
-        node = self.registry[node_id]
-        try:
-            task = node.get_task()
-            self._store_session_data(node, task)
-            # update node before returning a task
-            if node.dirty:
-                self.registry.update(node)
-                node.dirty = False
-            return self._json_action(ACTION_TASK, task)
-        except NodeRequestRejectedError as e:
-            return self._json_action(ACTION_UNSUBSCRIBE,
-                                     'The node has been automatically '
-                                     'unsubscribed: {}'.format(e))
+        node = self._node(node_id)
+        node.touch()
+        return self._encode_action(node, *self._get_action(node, count))
 
     @json_error_handler
     def accept_result(self, node_id, result):
@@ -209,42 +290,234 @@ class Kaylee(object):
         :param node_id: a valid node id
         :param result: the result returned by the node.
         :type node_id: string
-        :type result: string with JSON-encoded dict data.
+        :type result: string or bytes with dict data encoded by the node's
+                      codec.
         :returns: A task (an action) returned by :meth:`get_action` or
                  "nop" action.
+
+        If the result contains the ``"__kl_task_id__"`` key, the result is
+        accepted for one of the tasks leased by a batched :meth:`get_action`
+        request. In this case the next batch of tasks is returned only after
+        the results of all the leased tasks have been accepted.
         """
-        node = self.registry[node_id]
+        if not isinstance(result, (str, bytes)):
+            raise ValueError('Kaylee expects the incoming result to be in '
+                             'string or bytes format, not {}'.format(
+                                 result.__class__.__name__))
+        node = self._node(node_id)
+        node.touch()
+        parsed_result = self._codec(node).decode(result)
+        if isinstance(parsed_result, list):
+            return self._accept_results(node, parsed_result)
+
         try:
-            if not isinstance(result, str):
-                raise ValueError('Kaylee expects the incoming result to be in '
-                                 'string format, not {}'.format(
-                                     result.__class__.__name__))
-            parsed_result = json.loads(result)
             if not isinstance(parsed_result, dict):
                 raise ValueError('The returned result was not parsed '
                                  'as dict: {}'.format(parsed_result))
-            self._restore_session_data(node, parsed_result)
-            node.accept_result(parsed_result)
+            task_id = parsed_result.pop(KL_TASK_ID, None)
+            self._restore_session_data(node, parsed_result, task_id)
+            node.accept_result(parsed_result, task_id)
         except InvalidResultError as e:
-            self.unsubscribe(node)
+            self._release_tasks(node)
+            node.unsubscribe()
+            self._update_node(node)
             raise e
 
         #pylint: disable-msg=E1101
         if self.config.AUTO_GET_ACTION:
-            return self.get_action(node.id)
-        return self._json_action(ACTION_NOP)
+            if task_id is None:
+                return self._encode_action(node, *self._get_action(node))
+            elif not node.task_ids:
+                return self._encode_action(node,
+                                           *self._get_batch_action(node))
+        self._update_node(node)
+        return self._encode_action(node, ACTION_NOP)
+
+    @json_error_handler
+    def accept_results(self, node_id, results):
+        """Accepts the results of the tasks leased to the node by a batched
+        :meth:`get_action` request. Every result is processed in the same
+        way as a result accepted by :meth:`accept_result`. A failure to
+        accept a result does not affect the other results of the batch.
+        Returns one combined action::
+
+          {
+              'action': <action>,
+              'data': <data>,
+              'errors': [ {'task_id': <task_id>, 'error': <error>}, ... ]
+          }
+
+        Here, <action> and <data> are the same as returned by
+        :meth:`accept_result` and ``errors`` is the list of the rejected
+        results.
+
+        :param node_id: a valid node id
+        :param results: a list of ``{'task_id': <task_id>, 'result': <result>}``
+                        dicts or its representation encoded by the node's
+                        codec.
+        :type node_id: string
+        :type results: list, string or bytes
+        """
+        node = self._node(node_id)
+        node.touch()
+        if isinstance(results, (str, bytes)):
+            results = self._codec(node).decode(results)
+        return self._accept_results(node, results)
+
+    def _accept_results(self, node, results):
+        #pylint: disable-msg=W0703
+        if not isinstance(results, list):
+            raise ValueError('The returned results were not parsed '
+                             'as list: {}'.format(results))
+
+        errors = []
+        for entry in results:
+            try:
+                task_id, result = self._parse_results_entry(entry)
+            except ValueError as e:
+                errors.append({'task_id' : None, 'error' : str(e)})
+                continue
+            try:
+                self._restore_session_data(node, result, task_id)
+                node.accept_result(result, task_id)
+            except Exception as e:
+                if isinstance(e, InvalidResultError):
+                    # the task is not solved by the node, but the other
+                    # results of the batch are still accepted.
+                    node.release_task(task_id)
+                errors.append({'task_id' : task_id, 'error' : str(e)})
+
+        #pylint: disable-msg=E1101
+        if self.config.AUTO_GET_ACTION and not node.task_ids:
+            action = self._get_batch_action(node)
+        else:
+            self._update_node(node)
+            action = (ACTION_NOP, )
+        return self._encode_action(node, *action, errors=errors)
+
+    @staticmethod
+    def _parse_results_entry(entry):
+        try:
+            task_id = str(entry['task_id'])
+            result = entry['result']
+        except (KeyError, TypeError):
+            raise ValueError('Invalid results entry: {}'.format(entry))
+        if not isinstance(result, dict):
+            raise ValueError('The returned result was not parsed '
+                             'as dict: {}'.format(result))
+        return task_id, result
+
+    def _get_action(self, node, count=None):
+        """Returns the next ``(action, data)`` for the node, waits for it
+        in long-poll mode."""
+        action = self._next_action(node, count)
+        #pylint: disable-msg=E1101
+        if action[0] == ACTION_NOP and self.config.LONG_POLL_TIMEOUT > 0:
+            action = self._wait_for_action(node, count)
+        self._update_node(node)
+        return action
+
+    def _next_action(self, node, count=None):
+        """Returns the next ``(action, data)`` for the node."""
+        try:
+            if count is None:
+                task = node.get_task()
+                if task is None:
+                    return (ACTION_NOP, )
+                self._store_session_data(node, task)
+                action = (ACTION_TASK, task)
+            else:
+                tasks = node.get_tasks(int(count))
+                if not tasks:
+                    return (ACTION_NOP, )
+                for task in tasks:
+                    self._store_session_data(node, task)
+                action = (ACTION_TASKS, tasks)
+            # update node before returning a task
+            self._update_node(node)
+            return action
+        except NodeRequestRejectedError as e:
+            return (ACTION_UNSUBSCRIBE,
+                    'The node has been automatically '
+                    'unsubscribed: {}'.format(e))
+
+    def _wait_for_action(self, node, count):
+        """Waits for the next action until the long-poll timeout
+        elapses."""
+        controller = node.controller
+        if controller is None:
+            return (ACTION_NOP, )
+        #pylint: disable-msg=E1101
+        deadline = time.monotonic() + self.config.LONG_POLL_TIMEOUT
+        tasks_available = threading.Event()
+        controller.add_tasks_listener(tasks_available.set)
+        try:
+            action = (ACTION_NOP, )
+            while action[0] == ACTION_NOP:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                reissue_due_in = controller.reissue_due_in()
+                if reissue_due_in is not None:
+                    timeout = min(timeout, max(reissue_due_in, 0.01))
+                tasks_available.wait(timeout)
+                tasks_available.clear()
+                action = self._next_action(node, count)
+            return action
+        finally:
+            controller.remove_tasks_listener(tasks_available.set)
+
+    def _node(self, node_id):
+        """Returns the node by its id or restores it from the node token
+        in the stateless mode."""
+        if self._is_token(node_id):
+            return self.node_tokens.loads(node_id, self._applications)
+        return self.registry[node_id]
+
+    def _is_token(self, node_id):
+        return self.node_tokens is not None and is_node_token(node_id)
+
+    def _update_node(self, node):
+        # in the stateless mode the node's state is returned to it
+        # in a new token (see _encode_action())
+        if node.dirty:
+            if self.node_tokens is None:
+                self.registry.update(node)
+            node.dirty = False
+
+    def _get_batch_action(self, node):
+        """Returns the next batched ``(action, data)`` for the node which
+        has returned the results of all its leased tasks, waits for it
+        in long-poll mode."""
+        if node.controller is None:
+            return self._get_action(node)
+        return self._get_action(node, node.controller.tasks_batch_limit)
 
     def clean(self):
-        """Removes the outdated nodes from Kaylee's nodes storage."""
-        self.registry.clean()
+        """Removes the inactive nodes from Kaylee's nodes registry and
+        releases the tasks leased by them (see
+        :meth:`Controller.release_tasks`)."""
+        # the registries implemented before clean() returned the removed
+        # nodes return None
+        for node in self.registry.clean() or ():
+            self._release_tasks(node)
+
+    @staticmethod
+    def _release_tasks(node):
+        if node.controller is not None and node.task_ids:
+            node.controller.release_tasks(node)
 
     def _store_session_data(self, node, task):
         if self.session_data_manager is not None:
             self.session_data_manager.store(node, task)
 
-    def _restore_session_data(self, node, result):
+    def _restore_session_data(self, node, result, task_id=None):
         if not KL_RESULT in result:
             if self.session_data_manager is not None:
+                # the session data manager refers to the task via
+                # node.task_id
+                if task_id is not None:
+                    node.select_task(task_id)
                 self.session_data_manager.restore(node, result)
 
     @property
@@ -254,16 +527,40 @@ class Kaylee(object):
         return self._applications
 
     @staticmethod
-    def _json_action(action, data = ''):
-        return json.dumps( { 'action' : action, 'data' : data } )
+    def _codec(node):
+        """Returns the codec negotiated for the node."""
+        return get_codec(node.codec)
+
+    def _encoder(self, node):
+        """Returns the response encoder of the node's codec."""
+        try:
+            return self._encoders[node.codec]
+        except KeyError:
+            encoder = self._codec(node).response_encoder()
+            self._encoders[node.codec] = encoder
+            return encoder
+
+    def _encode_action(self, node, action, data = '', **kwargs):
+        if self.node_tokens is not None:
+            kwargs['node_id'] = self.node_tokens.dumps(node)
+        return self._encoder(node).action(action, data, **kwargs)
 
 
 class Config(DictAsObjectWrapper):
     """The ``Config`` object maintains the run-time Kaylee
     configuration options (see :ref:`configuration` for full description).
     """
+    #: The default values of the optional configuration options.
+    defaults = {
+        'LONG_POLL_TIMEOUT' : 0,
+        'CODECS' : ['json'],
+        'NODE_TOKENS' : False,
+    }
+
     def __init__(self, **kwargs):
-        super(Config, self).__init__(**kwargs)
+        options = dict(self.defaults)
+        options.update(kwargs)
+        super(Config, self).__init__(**options)
         self._dirty = True
         self._cached_dict = {}
 
@@ -277,6 +574,7 @@ class Config(DictAsObjectWrapper):
     def client_config(self):
         client_config_fields = [
             'AUTO_GET_ACTION',
+            'LONG_POLL_TIMEOUT',
         ]
 
         if self._dirty:
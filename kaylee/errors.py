@@ -28,6 +28,13 @@ class InvalidNodeIDError(KayleeError):
         KayleeError.__init__(self, '{} is not a valid node id'.format(node_id))
 
 
+class InvalidNodeTokenError(KayleeError):
+    """Raised when a node token is malformed, its signature verification
+    fails or it has expired."""
+    def __init__(self, why):
+        KayleeError.__init__(self, 'Invalid node token: {}'.format(why))
+
+
 class NodeNotSubscribedError(KayleeError):
     """Raised when a Node requests an action or submits results without
     being subscribed to an application."""
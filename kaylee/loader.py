@@ -21,7 +21,7 @@ import kaylee.contrib
 from .core import Kaylee
 from .errors import KayleeError, SettingsError
 from .util import (LazyObject, is_strong_subclass, MIN_SECRET_KEY_LENGTH,)
-from . import storage, controller, project, node, session
+from . import storage, controller, project, node, session, codecs
 
 import logging
 log = logging.getLogger(__name__)
@@ -93,6 +93,9 @@ class SettingsValidator:
     def validate(settings):
         SettingsValidator.validate_AUTO_GET_ACTION(settings)
         SettingsValidator.validate_SECRET_KEY(settings)
+        SettingsValidator.validate_LONG_POLL_TIMEOUT(settings)
+        SettingsValidator.validate_CODECS(settings)
+        SettingsValidator.validate_NODE_TOKENS(settings)
 
     @staticmethod
     def validate_AUTO_GET_ACTION(settings):
@@ -112,6 +115,42 @@ class SettingsValidator:
                                 'characters are required)'
                                 .format(MIN_SECRET_KEY_LENGTH))
 
+    @staticmethod
+    def validate_LONG_POLL_TIMEOUT(settings):
+        if 'LONG_POLL_TIMEOUT' not in settings:
+            return
+        val = settings['LONG_POLL_TIMEOUT']
+        if isinstance(val, bool) or not isinstance(val, (int, float)):
+            raise SettingsError('LONG_POLL_TIMEOUT is not a number')
+        if val < 0:
+            raise SettingsError('LONG_POLL_TIMEOUT is negative')
+
+    @staticmethod
+    def validate_CODECS(settings):
+        if 'CODECS' not in settings:
+            return
+        val = settings['CODECS']
+        if isinstance(val, str) or not isinstance(val, (list, tuple)):
+            raise SettingsError('CODECS is not a list')
+        if not val:
+            raise SettingsError('CODECS is empty')
+        for name in val:
+            try:
+                codecs.get_codec(name)
+            except KayleeError as e:
+                raise SettingsError('CODECS: {}'.format(e))
+
+    @staticmethod
+    def validate_NODE_TOKENS(settings):
+        if 'NODE_TOKENS' not in settings:
+            return
+        val = settings['NODE_TOKENS']
+        if not isinstance(val, bool):
+            raise SettingsError('NODE_TOKENS is not a boolean')
+        if val and 'SECRET_KEY' not in settings:
+            raise SettingsError('NODE_TOKENS requires the SECRET_KEY to be '
+                                'set')
+
 
 class Loader:
     _loadable_base_classes = [
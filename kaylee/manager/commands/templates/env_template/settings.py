@@ -2,6 +2,18 @@
 # when a result is accepted from a node.
 AUTO_GET_ACTION = True
 
+# The amount of seconds for which a node's action request is held
+# until a task is available (0 disables long-poll mode).
+LONG_POLL_TIMEOUT = 0
+
+# The wire codecs available to the nodes in the order of preference
+# ('json', 'msgpack', 'cbor').
+CODECS = ['json']
+
+# Indicates whether the state of the nodes is carried by signed node
+# tokens instead of being kept in the nodes registry (requires SECRET_KEY).
+NODE_TOKENS = False
+
 # A string that can be explicitly used in all the configurations
 # which require a secret key (for encryption, signing etc).
 SECRET_KEY = '{{ SECRET_KEY }}'
@@ -11,32 +11,45 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import os
 import time
+import random
 import binascii
 import struct
 import threading
-import hashlib
 from datetime import datetime
+from functools import lru_cache
 from abc import ABCMeta, abstractmethod
 
 from .errors import (warn, InvalidNodeIDError, NodeNotSubscribedError,
-                     ApplicationCompletedError)
+                     NodeRequestRejectedError, ApplicationCompletedError)
 from .util import parse_timedelta
+from .codecs import DEFAULT_CODEC
 
 #: The hex string formatted NodeID regular expression pattern which
 #: can be used in e.g. web frameworks' URL dispatchers.
-node_id_pattern = r'[\da-fA-F]{20}'
+# a node id, optionally followed by the signed node state
+# (see kaylee.tokens)
+node_id_pattern = r'[\da-fA-F]{20}(?:\.[\w-]+\.[\w-]+)?'
+
+#: The amount of the NodeID counter values reserved by a thread at once.
+NODE_ID_BLOCK_SIZE = 256
+# the counter is 3 bytes long
+_NODE_ID_BLOCKS = 2**24 // NODE_ID_BLOCK_SIZE
 
 
 class Node(object):
     """
     A Node object contains the information about a registered `Kaylee Node`.
+    The object is kept compact, since a registry may keep millions of them:
+    it is slot-based and the timestamps are kept as integer UNIX time.
 
     :param node_id: an instance of :class:`NodeID` or a string parsable by
                     :class:`NodeID`
     """
-    # __slots__ = ('id', '_task_id', 'subscription_timestamp', 'task_timestamp',
-    #              'controller', 'errors_count', 'session_data')
+    __slots__ = ('id', 'dirty', 'codec', 'score', 'last_activity',
+                 '_subscription_timestamp', '_task_timestamp', '_controller',
+                 '_session_data', '_task_id', '_task_ids')
 
     def __init__(self, node_id):
         if not isinstance(node_id, NodeID):
@@ -45,18 +58,59 @@ class Node(object):
         #: An instance of :class:`NodeID`
         self.id = node_id
 
+        #: Indicates that one of the Node attributes (except ID) has been
+        #: changed. ``Node.dirty`` has to be set to ``False`` manually.
         self.dirty = False
+        #: The name of the wire codec negotiated at registration.
+        self.codec = DEFAULT_CODEC
+        #: The benchmark score reported by the node at registration (the
+        #: higher the faster, see :func:`parse_score`) or ``None``.
+        self.score = None
+        #: The UNIX time (int) of the node's last request, updated by
+        #: :meth:`touch`. Used by the registries to evict inactive nodes.
+        self.last_activity = int(time.time())
         self._subscription_timestamp = None
         self._task_timestamp = None
         self._controller = None
         self._session_data = None
         self._task_id = None
+        self._task_ids = ()
+
+    def __getstate__(self):
+        """Returns the node's fields (except :attr:`dirty`) as a tuple.
+        Used by pickle and by the registries which keep the fields
+        separately from the Node objects."""
+        return (self.id, self.codec, self._controller, self._session_data,
+                self._task_id, self._task_ids, self._subscription_timestamp,
+                self._task_timestamp, self.last_activity, self.score)
+
+    def __setstate__(self, state):
+        (self.id, self.codec, self._controller, self._session_data,
+         self._task_id, self._task_ids, self._subscription_timestamp,
+         self._task_timestamp, self.last_activity, self.score) = state
+        self.dirty = False
+
+    @classmethod
+    def from_state(cls, state):
+        """Constructs a Node from the state returned by
+        :meth:`__getstate__`."""
+        node = cls.__new__(cls)
+        node.__setstate__(state)
+        return node
+
+    def touch(self):
+        """Updates :attr:`last_activity`. The node becomes dirty at most
+        once per second."""
+        now = int(time.time())
+        if self.last_activity != now:
+            self.last_activity = now
+            self.dirty = True
 
     def subscribe(self, controller):
         self._controller = controller
-        self._subscription_timestamp = datetime.now()
+        self._subscription_timestamp = int(time.time())
         self.dirty = True
-        return controller.project.client_config
+        return controller.client_config
 
     def unsubscribe(self):
         if self._controller is None:
@@ -66,25 +120,89 @@ class Node(object):
         self._task_timestamp = None
         self._controller = None
         self._task_id = None
-        #: Indicates that one of the Node attributes (except ID) has been
-        #: changed. ``Node.dirty`` has to be set to ``False`` manually.
+        self._task_ids = ()
         self.dirty = True
 
     def get_task(self):
+        """Returns a task from the bound controller or ``None`` if there
+        are no tasks to hand out right now."""
         if self.controller is None:
             raise NodeNotSubscribedError(self)
         if self.controller.completed:
             raise ApplicationCompletedError(self.controller)
         task = self.controller.get_task(self)
-        task['id'] = str(task['id']).strip()
+        if task is not None:
+            task['id'] = str(task['id']).strip()
         return task
 
-    def accept_result(self, result):
+    def get_tasks(self, count):
+        """Returns a list of at most ``count`` tasks leased to the node
+        (see :meth:`Controller.get_tasks`)."""
+        if self.controller is None:
+            raise NodeNotSubscribedError(self)
+        if self.controller.completed:
+            raise ApplicationCompletedError(self.controller)
+        tasks = self.controller.get_tasks(self, count)
+        for task in tasks:
+            task['id'] = str(task['id']).strip()
+        return tasks
+
+    def accept_result(self, result, task_id=None):
+        """Passes the result to the bound controller.
+
+        :param result: JSON-parsed task result.
+        :param task_id: the ID of one of the tasks leased by the node
+                        (see :attr:`task_ids`). If ``None``, the result
+                        is accepted for the current :attr:`task_id`.
+        """
         if self.controller is None:
             raise NodeNotSubscribedError(self)
         if self.controller.completed:
             raise ApplicationCompletedError(self.controller)
+        if task_id is None:
+            self.controller.accept_result(self, result)
+            return
+
+        leased_id = self.select_task(task_id)
         self.controller.accept_result(self, result)
+        self.release_task(leased_id)
+
+    def select_task(self, task_id):
+        """Makes one of the tasks leased by the node current, so that the
+        controller refers to it via :attr:`task_id`.
+
+        :param task_id: string representation of the leased task ID.
+        :returns: the leased task ID.
+        :throws NodeRequestRejectedError: if the task is not leased by the
+                                          node.
+        """
+        # the IDs received from a client are always strings, whereas
+        # the leased IDs are the ones returned by the project.
+        for leased_id in self._task_ids:
+            if str(leased_id).strip() == str(task_id):
+                self._task_id = leased_id
+                return leased_id
+        raise NodeRequestRejectedError('task "{}" is not leased by the '
+                                       'node'.format(task_id))
+
+    def lease_tasks(self, task_ids):
+        """Replaces the tasks leased by the node with ``task_ids``.
+        The last task in the list becomes the current :attr:`task_id`."""
+        self._task_ids = tuple(task_ids)
+        self._task_id = self._task_ids[-1] if self._task_ids else None
+        self._task_timestamp = int(time.time())
+        self.dirty = True
+
+    def release_task(self, task_id):
+        """Removes the task from the tasks leased by the node."""
+        if task_id not in self._task_ids:
+            return
+        task_ids = list(self._task_ids)
+        task_ids.remove(task_id)
+        self._task_ids = tuple(task_ids)
+        if self._task_id == task_id:
+            self._task_id = self._task_ids[-1] if self._task_ids else None
+        self.dirty = True
 
     @property
     def controller(self):
@@ -110,20 +228,28 @@ class Node(object):
     @task_id.setter
     def task_id(self, val):
         self._task_id = val
-        self._task_timestamp = datetime.now()
+        self._task_ids = (val, ) if val is not None else ()
+        self._task_timestamp = int(time.time())
         self.dirty = True
 
+    @property
+    def task_ids(self):
+        """A tuple of IDs of the tasks leased by the node (see
+        :meth:`Kaylee.get_action`). Usually it contains a single
+        item - the :attr:`task_id`."""
+        return self._task_ids
+
     @property
     def subscription_timestamp(self):
         """A :class:`datetime.datetime` instance which tracks the time
         when a node has subscribed to an application."""
-        return self._subscription_timestamp
+        return _from_timestamp(self._subscription_timestamp)
 
     @property
     def task_timestamp(self):
         """A :class:`datetime.datetime` instance which tracks the time
         of a node receiving its last to-compute task."""
-        return self._task_timestamp
+        return _from_timestamp(self._task_timestamp)
 
     def __hash__(self):
         return hash(self.id)
@@ -132,10 +258,17 @@ class Node(object):
 class NodeID(object):
     """
     NodeID is a 10-bytes long ID generated from the current UNIX time,
-    the remote host identifier and the internal incremental counter.
+    the server process identifier and the internal incremental counter.
     The format is::
 
-    [UNIX time (4)][counter (2)][remote host identifier hash (4)]
+    [UNIX time (4)][process id (3)][counter (3)]
+
+    The ids generated by the different processes of a machine never
+    collide, since the process id is a part of an id. Every thread
+    reserves a block of :data:`NODE_ID_BLOCK_SIZE` counter values at once
+    and generates the ids from the block without locking. A process
+    starts from a random block, so that a reused process id does not
+    repeat the ids generated by a finished process.
 
     Usually a new NodeID object is generated as follows::
 
@@ -147,7 +280,9 @@ class NodeID(object):
         NodeID() < NodeID()
         # >>> True
 
-    Is always ``True``, no matter what the remote host is.
+    Is always ``True`` for the ids generated by the same thread. The ids
+    generated within the same second by different threads or processes
+    are ordered arbitrarily.
     Another useful conversion is::
 
         n1 = NodeID()
@@ -167,7 +302,9 @@ class NodeID(object):
                     NodeID object is either binary 10-bytes long string
                     or 20-characters long hex string. If ``node_id``
                     is ``None``, then a new NodeID is generated.
-    :param remote_host: Remote host IP address or other identifier.
+    :param remote_host: Remote host IP address or other identifier. It is
+                        no longer a part of the id and is kept for
+                        backwards compatibility.
     :type node_id: string, NodeID object or ``None``
     :type remote_host: string
     """
@@ -175,8 +312,15 @@ class NodeID(object):
     #W0212: Access to a protected member _id of a client class (in __eg__ etc.)
 
     __slots__ = ('_id')
-    _inc = 0
-    _inc_lock = threading.Lock()
+
+    # The generator state, see _generate(). The process id and the
+    # next block are reset in a forked process, which also invalidates
+    # the threads' blocks via the generation number.
+    _process = b''
+    _generation = 0
+    _next_block = 0
+    _block_lock = threading.Lock()
+    _local = threading.local()
 
     def __init__(self, node_id=None, remote_host='127.0.0.1'):
         if node_id is None and not isinstance(remote_host, str):
@@ -200,24 +344,46 @@ class NodeID(object):
         """
         return NodeID(remote_host=host)
 
+    @classmethod
+    def from_binary(cls, binary):
+        """Constructs a NodeID object from a trusted 10-bytes binary
+        representation (e.g. a key stored by a registry or a storage),
+        bypassing the validation."""
+        nid = object.__new__(cls)
+        nid._id = binary
+        return nid
+
+
+    @classmethod
+    def _reset_generator(cls):
+        """Initializes the per-process state of the generator."""
+        # Linux process ids fit 22 bits
+        cls._process = (os.getpid() % 2**24).to_bytes(3, 'big')
+        # the first half of the blocks, so that the counter does not wrap
+        # around unless millions of ids are generated per second
+        cls._next_block = random.randrange(_NODE_ID_BLOCKS // 2)
+        cls._generation += 1
 
     def _generate(self, remote_host):
         """Generates a new value for this NodeID."""
-        nid = b''
-        # 4 bytes current time
-        nid += struct.pack('>i', int(time.time()))
-        # 2 bytes inc
-        with NodeID._inc_lock:
-            nid += struct.pack(">i", NodeID._inc)[2:4]
-            NodeID._inc = (NodeID._inc + 1) % 0xFFFF
-        # 4 bytes host
-        #pylint: disable-msg=E1101
-        #E1101: Instance of 'md5' has no 'update' member
-        host_hash = hashlib.md5()
-        host_hash.update(remote_host.encode('utf-8'))
-        nid += host_hash.digest()[0:4]
-        # 10 bytes total
-        self._id = nid
+        #pylint: disable-msg=W0613
+        #W0613: Unused argument 'remote_host'
+        local = NodeID._local
+        try:
+            generation, counter, end = local.block
+        except AttributeError:
+            generation = None
+        if generation != NodeID._generation or counter == end:
+            with NodeID._block_lock:
+                block = NodeID._next_block
+                NodeID._next_block = (block + 1) % _NODE_ID_BLOCKS
+                generation = NodeID._generation
+            counter = block * NODE_ID_BLOCK_SIZE
+            end = counter + NODE_ID_BLOCK_SIZE
+        local.block = (generation, counter + 1, end)
+        # 4 bytes time + 3 bytes process + 3 bytes counter
+        self._id = (struct.pack('>i', int(time.time())) + NodeID._process +
+                    counter.to_bytes(3, 'big'))
 
     def _parse(self, nid):
         if isinstance(nid, NodeID):
@@ -228,10 +394,7 @@ class NodeID(object):
             else:
                 raise InvalidNodeIDError(nid)
         elif isinstance(nid, str):
-            if len(nid) == 20:
-                self._id = bytes.fromhex(nid)
-            else:
-                raise InvalidNodeIDError(nid)
+            self._id = _parse_hex(nid)._id
         else:
             raise TypeError('id must be an instance of {}, {} or {}, not {}'
                             .format(str.__name__,
@@ -263,28 +426,22 @@ class NodeID(object):
         return "NodeID('{}')".format(str(self))
 
     def __eq__(self, other):
-        other = NodeID(other)
-        return self._id == other._id
+        return self is other or self._id == node_key(other)
 
     def __ne__(self, other):
-        other = NodeID(other)
-        return self._id != other._id
+        return self is not other and self._id != node_key(other)
 
     def __lt__(self, other):
-        other = NodeID(other)
-        return self._id < other._id
+        return self._id < node_key(other)
 
     def __le__(self, other):
-        other = NodeID(other)
-        return self._id <= other._id
+        return self._id <= node_key(other)
 
     def __gt__(self, other):
-        other = NodeID(other)
-        return self._id > other._id
+        return self._id > node_key(other)
 
     def __ge__(self, other):
-        other = NodeID(other)
-        return self._id >= other._id
+        return self._id >= node_key(other)
 
     def __hash__(self):
         """Python ``hash()`` of the internal id representation."""
@@ -299,7 +456,7 @@ class NodesRegistry(object, metaclass=ABCMeta):
     for the user to choose.
 
     :param timeout: Nodes timeout. Used by :meth:`clean` to determine if a
-                    node is obsolete.
+                    node is inactive.
                     Format: ``1d 12h 59m 59s``, e.g.:
 
                     * ``'1d 10m'`` - one day, ten minutes
@@ -327,7 +484,21 @@ class NodesRegistry(object, metaclass=ABCMeta):
 
     @abstractmethod
     def clean(self):
-        """Removes the obsolete nodes from the storage."""
+        """Removes the nodes which have been inactive (see
+        :attr:`Node.last_activity`) for longer than :attr:`timeout`.
+
+        :returns: a list of the removed :class:`Node` objects. ``None``
+                  is treated as an empty list.
+        """
+
+    def bind(self, applications):
+        """Called by :class:`Kaylee` with the loaded applications.
+        A persistent registry uses it to restore the controllers of the
+        nodes which were subscribed before a restart. Does nothing by
+        default.
+
+        :type applications: :class:`kaylee.core.Applications`
+        """
 
     @abstractmethod
     def __len__(self):
@@ -351,6 +522,35 @@ class NodesRegistry(object, metaclass=ABCMeta):
         :param node: an instance of :class:`Node` or a valid node id.
         """
 
+def _from_timestamp(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp)
+
+
+NodeID._reset_generator()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=NodeID._reset_generator)
+
+
+#: The maximum amount of the hex node ids parsed by :func:`_parse_hex`
+#: kept in memory.
+NODE_ID_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=NODE_ID_CACHE_SIZE)
+def _parse_hex(hex_id):
+    """Returns a NodeID parsed from a hex string. The same ids arrive
+    with every request of a node, thus the parsed (immutable) NodeID
+    objects are cached."""
+    if len(hex_id) != 20:
+        raise InvalidNodeIDError(hex_id)
+    try:
+        return NodeID.from_binary(bytes.fromhex(hex_id))
+    except ValueError:
+        raise InvalidNodeIDError(hex_id)
+
+
 def extract_node_id(node_or_node_id):
     """Extracts or constructs NodeID from the given object.
 
@@ -360,8 +560,15 @@ def extract_node_id(node_or_node_id):
     :returns: :class:`NodeID` object
     """
     no = node_or_node_id
-    if isinstance(no, str):
-        return NodeID(node_id=no)
+    cls = type(no)
+    if cls is str:
+        return _parse_hex(no)
+    elif cls is NodeID:
+        return no
+    elif cls is Node and type(no.id) is NodeID:
+        return no.id
+    elif isinstance(no, str):
+        return _parse_hex(str(no))
     elif isinstance(no, NodeID):
         return no
     elif isinstance(no, Node):
@@ -372,3 +579,55 @@ def extract_node_id(node_or_node_id):
                                      NodeID.__name__,
                                      Node.__name__,
                                      type(no).__name__))
+
+
+def node_key(node_or_node_id):
+    """Returns the 10-bytes binary key (:attr:`NodeID.binary`) of the
+    given node or node id. The registries and the storages use the keys
+    instead of NodeID objects, since the bytes are hashed and compared
+    natively.
+
+    :type node_or_node_id: string, bytes, :class:`NodeID` or :class:`Node`
+    :raises InvalidNodeIDError: if the node id is invalid.
+    """
+    #pylint: disable-msg=W0212
+    #W0212: Access to a protected member _id of a client class
+    cls = type(node_or_node_id)
+    if cls is NodeID:
+        return node_or_node_id._id
+    elif cls is str:
+        # no NodeID object is required, thus the cache is not used
+        if len(node_or_node_id) == 20:
+            try:
+                return bytes.fromhex(node_or_node_id)
+            except ValueError:
+                pass
+        raise InvalidNodeIDError(node_or_node_id)
+    elif cls is bytes and len(node_or_node_id) == 10:
+        return node_or_node_id
+    elif cls is Node and type(node_or_node_id.id) is NodeID:
+        return node_or_node_id.id._id
+    elif isinstance(node_or_node_id, Node):
+        return NodeID(node_or_node_id.id)._id
+    return NodeID(node_or_node_id)._id
+
+
+def parse_score(score):
+    """Parses the benchmark score reported by a node at registration
+    (see :meth:`Kaylee.register`). The score is a positive number: the
+    amount of the client benchmark rounds completed per second.
+
+    :returns: the score (:class:`float`) or ``None`` if the score is
+              missing or invalid, i.e. the node is treated as a node of
+              unknown speed.
+    """
+    if score is None:
+        return None
+    try:
+        score = float(score)
+    except (TypeError, ValueError):
+        return None
+    # NaN and infinity are rejected as well
+    if not 0 < score < float('inf'):
+        return None
+    return score
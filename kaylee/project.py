@@ -11,6 +11,8 @@
 
 from abc import ABCMeta, abstractmethod
 
+from .session import validate_session_keys
+
 
 #: Defines auto project mode (see :attr:`Project.mode`)
 AUTO_PROJECT_MODE = 0x2
@@ -34,6 +36,14 @@ class Project(object, metaclass=ABCMeta):
     :param script_url: The URL of the project's client part (\\*.js file).
     :param mode: defines :attr:`Project.mode <kaylee.Project.mode>`.
     """
+    #: The names of the session variables which the project's tasks
+    #: may contain, e.g. ``('#s1', '#s2')``. If declared, the names are
+    #: validated when the project is loaded and the session data managers
+    #: look up the declared variables only, instead of validating every
+    #: ``#``-key of a task (a task with an undeclared ``#``-key is rejected).
+    #: ``None`` means that the session variables are not declared.
+    session_keys = None
+
 
     def __init__(self, script_url, mode, **kwargs):
         if mode not in [AUTO_PROJECT_MODE, MANUAL_PROJECT_MODE]:
@@ -66,6 +76,9 @@ class Project(object, metaclass=ABCMeta):
         #: Indicates whether the project was completed.
         self.completed = False
 
+        if self.session_keys is not None:
+            self.session_keys = validate_session_keys(self.session_keys)
+
     @abstractmethod
     def next_task(self):
         """Returns the next task. The returned ``None`` value indicates that
@@ -99,6 +112,22 @@ class Project(object, metaclass=ABCMeta):
         :return: normalized result.
         """
 
+    def task_cost(self, task):
+        """Returns the estimated cost of solving the task, e.g. the amount
+        of the operations or the size of the data to be processed. The
+        costs are only compared among the project's tasks, thus the units
+        do not matter. Used by the controllers which match the tasks to
+        the nodes' speed (see :class:`SimpleController
+        <kaylee.contrib.SimpleController>`). By default all the tasks
+        cost the same.
+
+        :param task: a task returned by :meth:`next_task`.
+        :returns: a non-negative number.
+        """
+        #pylint: disable-msg=W0613
+        #W0613: Unused argument 'task'
+        return 1
+
     def result_stored(self, task_id, data, storage):
         """A callback invoked by the bound controller when
         a result is successfully stored to a permanent storage.
@@ -120,3 +149,82 @@ class Project(object, metaclass=ABCMeta):
     #     total amount of tasks.
     #     """
     #     pass
+
+
+class RangeProject(Project):
+    """The base class of the projects whose work is a range of
+    ``units_count`` work units, e.g. the Monte Carlo samples to be drawn
+    or the integers to be searched. The range is split into the tasks on
+    demand: a task covers the units ``[start, stop)`` of the range::
+
+      {
+          'id' : '2000-3500',
+          'start' : 2000,
+          'stop' : 3500,
+      }
+
+    The tasks returned by :meth:`next_task` cover :attr:`task_size` units,
+    whereas a controller which adapts the tasks to the nodes' speed (see
+    :class:`SimpleController <kaylee.contrib.SimpleController>`) requests
+    the tasks of any size via :meth:`next_range`. Thus the results of the
+    differently sized ranges have to be merged by the project, e.g. by
+    summing the samples counts in :meth:`Project.result_stored`.
+
+    :param units_count: the total amount of the work units.
+    :param task_size: overrides :attr:`task_size`.
+    """
+    #: The amount of the work units covered by a task returned by
+    #: :meth:`next_task`.
+    task_size = 1000
+
+    def __init__(self, script_url, mode, units_count, **kwargs):
+        super(RangeProject, self).__init__(script_url, mode, **kwargs)
+        self.units_count = int(units_count)
+        self.task_size = int(kwargs.get('task_size', self.task_size))
+        if self.task_size < 1:
+            raise ValueError('task_size must be positive')
+        self._next_unit = 0
+
+    def next_range(self, size):
+        """Returns the task which covers at most ``size`` of the remaining
+        work units or ``None`` if the whole range has been handed out.
+
+        :param size: the requested amount of units, at least one unit is
+                     covered by the task.
+        """
+        start = self._next_unit
+        if start >= self.units_count:
+            return None
+        stop = min(start + max(int(size), 1), self.units_count)
+        self._next_unit = stop
+        return self.range_task(start, stop)
+
+    def next_task(self):
+        return self.next_range(self.task_size)
+
+    def range_task(self, start, stop):
+        """Returns the task which covers the units ``[start, stop)``.
+        Extend the returned dict in order to pass additional data to the
+        client, the task ID must not be changed."""
+        return {
+            'id' : '{}-{}'.format(start, stop),
+            'start' : start,
+            'stop' : stop,
+        }
+
+    def __getitem__(self, task_id):
+        return self.range_task(*self.task_range(task_id))
+
+    def task_cost(self, task):
+        return task['stop'] - task['start']
+
+    @staticmethod
+    def task_range(task_id):
+        """Returns the ``(start, stop)`` units range of the task.
+
+        :throws ValueError: if the task ID is malformed.
+        """
+        start, sep, stop = str(task_id).partition('-')
+        if not sep:
+            raise ValueError('Wrong range task id: {}'.format(task_id))
+        return int(start), int(stop)
@@ -12,22 +12,49 @@
 #Pylint false alarm of missing hashlib functions
 #pylint: disable-msg=E0611
 
-import random
-import pickle
-import string
+import os
 import re
-from base64 import b64encode, b64decode
-from hmac import new as hmac
+import json
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+from base64 import b64decode, urlsafe_b64encode, urlsafe_b64decode
+from functools import lru_cache
+from hmac import new as hmac, compare_digest
 from hashlib import sha1, sha256
-from Crypto.Cipher import AES
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from abc import ABCMeta, abstractmethod
 
-from .util import random_string
-from .errors import KayleeError, SessionKeyNameError
+from .node import node_key
+from .util import random_string, parse_timedelta
+from .errors import KayleeError, InvalidResultError, SessionKeyNameError
 
 
 SESSION_DATA_ATTRIBUTE = '__kl_session_data__'
 
+# the session variable name regular expression
+_session_key_reo = re.compile(r'^#\w+$', re.ASCII)
+
+
+def validate_session_keys(session_keys):
+    """Validates the names of the session variables and returns them as
+    a tuple.
+
+    :raises SessionKeyNameError: if a name is invalid.
+    """
+    if isinstance(session_keys, str):
+        raise SessionKeyNameError('{!r} is not a list of names'
+                                  .format(session_keys))
+    session_keys = tuple(session_keys)
+    for key in session_keys:
+        if not isinstance(key, str) or _session_key_reo.match(key) is None:
+            raise SessionKeyNameError(key)
+    return session_keys
+
 
 class SessionDataManager(object, metaclass=ABCMeta):
     """The abstract base class representing Session data manager
@@ -71,23 +98,42 @@ class SessionDataManager(object, metaclass=ABCMeta):
         """
 
     @staticmethod
-    def get_session_data(task):
-        """Returns a dict with session variables found in task."""
-        # data keys regular expression
-        try:
-            key_reo = _encrypt.key_reo
-        except AttributeError:
-            key_reo = _encrypt.key_reo = re.compile(r'^#[\w]+$', re.ASCII)
+    def get_session_data(task, session_keys=None):
+        """Returns a dict with session variables found in task.
+
+        :param session_keys: the declared names of the session variables
+                             (see :attr:`Project.session_keys`). If
+                             ``None``, all the task keys are validated.
+        :raises SessionKeyNameError: if a session variable name is invalid
+                                     or is not declared.
+        """
+        if session_keys is not None:
+            ret = {key : task[key] for key in session_keys if key in task}
+            # an undeclared variable must not be sent to the node as is
+            for key in task:
+                if key.startswith('#') and key not in ret:
+                    raise SessionKeyNameError('{} is not declared in '
+                                              'session_keys'.format(key))
+            return ret
 
         # find task data by #keys, test names, store to dict and return
         ret = {}
         for key in task:
             if key.startswith('#'):
-                if key_reo.match(key) is None:
+                if _session_key_reo.match(key) is None:
                     raise SessionKeyNameError(key)
                 ret[key] = task[key]
         return ret
 
+    @staticmethod
+    def declared_session_keys(node):
+        """Returns the names of the session variables declared by the
+        project of the node's application (see
+        :attr:`Project.session_keys`) or ``None``."""
+        if node.controller is None:
+            return None
+        return node.controller.project.session_keys
+
     @staticmethod
     def remove_session_data_from_task(session_data_keys, task):
         for key in session_data_keys:
@@ -114,7 +160,8 @@ class PhonySessionDataManager(SessionDataManager):
     """The default session data manager which throws :class:`KayleeError`
     if any session variables are encountered in an outgoing task."""
     def store(self, node, task):
-        session_data = self.get_session_data(task)
+        session_data = self.get_session_data(
+            task, self.declared_session_keys(node))
         if session_data == {}:
             return
         else:
@@ -131,7 +178,8 @@ class ServerSessionDataManager(SessionDataManager):
     """A session data manager, which keeps the data in
     :attr:`Node.session_data`."""
     def store(self, node, task):
-        session_data = self.get_session_data(task)
+        session_data = self.get_session_data(
+            task, self.declared_session_keys(node))
         if session_data == {}:
             return
 
@@ -146,6 +194,171 @@ class ServerSessionDataManager(SessionDataManager):
         result.update(session_data)
 
 
+class SessionStore(object):
+    """A server-side session data store keyed by ``(node id, task id)``.
+    The entries are kept in memory up to ``max_size`` bytes (the size of
+    the pickled session data). When the limit is exceeded, the least
+    recently stored entries are evicted, or moved to a SQLite database
+    file if ``spill_path`` is set. The entries expire in ``ttl`` after
+    being stored, so that the session data of the abandoned tasks is
+    reclaimed automatically.
+
+    The store is thread-safe.
+
+    :param max_size: the maximum size of the in-memory entries in bytes.
+    :param ttl: the time to live of the entries, e.g. ``'30m'``.
+    :param spill_path: the path of the database file to which the evicted
+                       entries are moved, or ``None``.
+    :type ttl: str or :class:`datetime.timedelta`
+    """
+    def __init__(self, max_size=64 * 1024 * 1024, ttl='1h', spill_path=None):
+        self.max_size = int(max_size)
+        if isinstance(ttl, str):
+            ttl = parse_timedelta(ttl)
+        self.ttl = ttl.total_seconds()
+        self.spill_path = spill_path
+        self.size = 0
+        # {(node key, task id) : (expiration time, pickled data)},
+        # in the order of storing (and thus of expiration)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._next_db_purge = 0
+        if spill_path is not None:
+            self._db = sqlite3.connect(spill_path, check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=OFF')
+            self._db.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                             'node BLOB NOT NULL, '
+                             'task TEXT NOT NULL, '
+                             'expires REAL NOT NULL, '
+                             'data BLOB NOT NULL, '
+                             'PRIMARY KEY (node, task))')
+
+    def put(self, node_id, task_id, data):
+        """Stores the session data of the task leased by the node."""
+        key = (node_key(node_id), task_id)
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[key] = (now + self.ttl, blob)
+            self.size += len(blob)
+            self._expire(now)
+            if self.size > self.max_size:
+                self._evict()
+
+    def pop(self, node_id, task_id):
+        """Removes the session data of the task leased by the node and
+        returns it. Returns ``None`` if there is no such data or
+        the data has expired."""
+        key = (node_key(node_id), task_id)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+            elif self._db is not None:
+                entry = self._db_pop(key)
+        if entry is None or entry[0] < time.time():
+            return None
+        return pickle.loads(entry[1])
+
+    def __len__(self):
+        """Returns the amount of the in-memory entries."""
+        return len(self._entries)
+
+    def close(self):
+        """Closes the spill database."""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _expire(self, now):
+        entries = self._entries
+        while entries:
+            key, (expires, blob) = next(iter(entries.items()))
+            if expires >= now:
+                break
+            del entries[key]
+            self.size -= len(blob)
+        if self._db is not None and now >= self._next_db_purge:
+            self._db.execute('DELETE FROM sessions WHERE expires < ?',
+                             (now, ))
+            self._next_db_purge = now + min(self.ttl, 60)
+
+    def _evict(self):
+        evicted = []
+        while self.size > self.max_size and self._entries:
+            key, (expires, blob) = self._entries.popitem(last=False)
+            self.size -= len(blob)
+            evicted.append((key[0], key[1], expires, blob))
+        if self._db is not None:
+            with self._db:
+                self._db.execute('BEGIN')
+                self._db.executemany('INSERT OR REPLACE INTO sessions '
+                                     'VALUES (?, ?, ?, ?)', evicted)
+
+    def _db_pop(self, key):
+        with self._db:
+            self._db.execute('BEGIN')
+            row = self._db.execute('SELECT expires, data FROM sessions '
+                                   'WHERE node = ? AND task = ?',
+                                   key).fetchone()
+            if row is not None:
+                self._db.execute('DELETE FROM sessions '
+                                 'WHERE node = ? AND task = ?', key)
+        return row
+
+
+class ExternalSessionDataManager(SessionDataManager):
+    """A session data manager, which keeps the data in a
+    :class:`SessionStore` instead of :attr:`Node.session_data`, so that
+    the nodes stay small and storing the session data does not modify
+    the nodes. The session data is keyed by the node and the task id, thus
+    every task leased by a batched request has its own session data.
+
+    The session variables of a task are replaced by the
+    ``'__kl_session_data__'`` marker, which is attached to the result by
+    the Kaylee client-side engine. A result with the marker whose session
+    data has been evicted from the store or has expired is rejected by
+    :class:`InvalidResultError`.
+
+    The arguments are passed to :class:`SessionStore`.
+    """
+    def __init__(self, max_size=64 * 1024 * 1024, ttl='1h',
+                 spill_path=None):
+        self.SESSION_DATA_ATTRIBUTE = SESSION_DATA_ATTRIBUTE
+        super(ExternalSessionDataManager, self).__init__()
+        self.session_store = SessionStore(max_size, ttl, spill_path)
+
+    def store(self, node, task):
+        session_data = self.get_session_data(
+            task, self.declared_session_keys(node))
+        if session_data == {}:
+            return
+
+        self.session_store.put(node.id, str(task['id']).strip(),
+                               session_data)
+        self.remove_session_data_from_task(session_data.keys(), task)
+        task[self.SESSION_DATA_ATTRIBUTE] = 1
+
+    def restore(self, node, result):
+        marked = result.pop(self.SESSION_DATA_ATTRIBUTE, None) is not None
+        session_data = None
+        if node.task_id is not None:
+            session_data = self.session_store.pop(node.id,
+                                                  str(node.task_id).strip())
+        if session_data is not None:
+            result.update(session_data)
+        elif marked:
+            raise InvalidResultError(result, 'the session data of the task '
+                                     'has expired or has been evicted')
+
+
 class ClientSessionDataManager(EncryptedSessionDataManager):
     """Stores encrypted session variables in task and restores them
     from the results. For example, the following task data::
@@ -160,9 +373,13 @@ class ClientSessionDataManager(EncryptedSessionDataManager):
 
       task = {
           id: 'i1',
-          '#__kl_sd__': 'yn/fCyEcW8AFrPps7XoxunC...' # 143 chars in total
+          '#__kl_sd__': '2.nSNqnVx5en1hV0LCxV1rJvL...' # 94 chars in total
       }
 
+    The session data is encrypted and authenticated by AES-GCM (see
+    :func:`_encrypt`), the data encrypted by the previous Kaylee versions
+    is accepted as well.
+
     The Kaylee client-side engine automatically attaches the ``'#__kl_sd__``
     data to the JSON result sent to the server, so that the session data
     could be decrypted and restored, e.g.::
@@ -181,7 +398,8 @@ class ClientSessionDataManager(EncryptedSessionDataManager):
         super(ClientSessionDataManager, self).__init__(secret_key)
 
     def store(self, node, task):
-        session_data = self.get_session_data(task)
+        session_data = self.get_session_data(
+            task, self.declared_session_keys(node))
         if session_data == {}:
             return
 
@@ -197,67 +415,204 @@ class ClientSessionDataManager(EncryptedSessionDataManager):
         result.update(sd)
 
 
-def _encrypt(data, secret_key):
-    """Encrypt the data and return its base64 representation.
+class SignedSessionDataManager(SessionDataManager):
+    """Stores the signed session variables in task and restores them
+    from the results. The session variables are serialized to JSON and
+    signed by HMAC-SHA256, so that the node can read but not modify them.
+    It is faster than :class:`ClientSessionDataManager` and should be used
+    when the session data needs no secrecy. For example, the following
+    task data::
 
-    :param data: Data to encrypt. The data is pickled prior to encryption.
+      task = {
+          'id' : 'i1',
+          '#s1' : 10,
+          '#s2' : [1, 2, 3]
+      }
+
+    Signed via the "abc" secret key turns into::
+
+      task = {
+          id: 'i1',
+          '#__kl_sd__': 'eyIjczEiOjEwLCIjczIiOlsxLDIsM119.-E48yrmJP5l25jbADj1DGw'
+      }
+
+    :param secret_key: A key used to sign the data.
+    :type secret_key: str
+    """
+    def __init__(self, secret_key):
+        self.secret_key = secret_key
+        self.SESSION_DATA_ATTRIBUTE = SESSION_DATA_ATTRIBUTE
+        super(SignedSessionDataManager, self).__init__()
+
+    def store(self, node, task):
+        session_data = self.get_session_data(
+            task, self.declared_session_keys(node))
+        if session_data == {}:
+            return
+
+        task[self.SESSION_DATA_ATTRIBUTE] = _sign(session_data,
+                                                  self.secret_key)
+        self.remove_session_data_from_task(session_data.keys(), task)
+
+    def restore(self, node, result):
+        if self.SESSION_DATA_ATTRIBUTE not in result:
+            return
+        sd = _unsign(result.pop(self.SESSION_DATA_ATTRIBUTE), self.secret_key)
+        result.update(sd)
+
+
+#: The length of the signature of the signed session data in bytes.
+SIGNATURE_LENGTH = 16
+
+_json_encode = json.JSONEncoder(separators=(',', ':')).encode
+_json_decode = json.JSONDecoder().decode
+
+
+@lru_cache(maxsize=32)
+def _signing_mac(secret_key):
+    """Returns the HMAC object (copied for every signature) of the key
+    derived from the secret key."""
+    key = hmac(secret_key.encode('utf-8'), b'kaylee.session|signed',
+               sha256).digest()
+    return hmac(key, None, sha256)
+
+
+def _sign(data, secret_key):
+    """Serialize the data to JSON and return it with its signature::
+
+      <base64(JSON)>.<base64(signature)>
+
+    :param data: JSON-serializable data.
     :param secret_key: A secret key to use.
-    :type data: any pickable Python object
     :type secret_key: str
     """
-    bsecret_key = secret_key.encode('utf-8')
-    mac = hmac(bsecret_key, None, sha1)
-    encryption_key = sha256(bsecret_key).digest()
+    try:
+        serialized = _json_encode(data)
+    except (TypeError, ValueError) as e:
+        raise KayleeError('Cannot serialize session data: {}'.format(e))
+    payload = urlsafe_b64encode(serialized.encode('utf-8')).rstrip(b'=')
+    mac = _signing_mac(secret_key).copy()
+    mac.update(payload)
+    signature = urlsafe_b64encode(mac.digest()[:SIGNATURE_LENGTH])
+    return (payload + b'.' + signature.rstrip(b'=')).decode('ascii')
+
+
+def _unsign(s, secret_key):
+    """Verify the signature of the data returned by :func:`_sign` and
+    return the deserialized data.
+
+    :raises KayleeError: if the data is malformed or forged.
+    """
+    try:
+        payload, signature = s.encode('ascii').rsplit(b'.', 1)
+        signature = urlsafe_b64decode(signature + b'==')
+    except (ValueError, AttributeError):
+        raise KayleeError('Signed data is malformed.')
+    mac = _signing_mac(secret_key).copy()
+    mac.update(payload)
+    if not compare_digest(mac.digest()[:SIGNATURE_LENGTH], signature):
+        raise KayleeError('Signed data signature verification failed.')
+    return _json_decode(urlsafe_b64decode(payload + b'==').decode('utf-8'))
 
-    iv = bytes(random.randint(0, 0xFF) for i in range(16))
-    encryptor = AES.new(encryption_key, AES.MODE_CBC, iv)
 
-    encrypted_data = _encrypt_data(data, encryptor)
-    mac.update(b'|' + encrypted_data)
+#: The prefix of the session data encrypted in the current format.
+SESSION_DATA_FORMAT_PREFIX = '2.'
 
-    b64_iv = b64encode(iv)
-    data_out_list = [b64_iv, encrypted_data]
-    data_out = (b'&'.join(data_out_list)).decode('utf-8')
-    mac_out = b64encode(mac.digest()).decode('utf-8')
+#: The length of the nonce in bytes.
+NONCE_LENGTH = 12
 
-    return '{}?{}'.format(mac_out, data_out)
+#: The length of the authentication tag in bytes.
+TAG_LENGTH = 16
 
 
-def _decrypt(s, secret_key):
-    bsecret_key = secret_key.encode('utf-8')
-    base64_hash, data = s.split('?', 1)
-    mac = hmac(bsecret_key, None, sha1)
+class _SessionCipher(object):
+    """Encrypts and authenticates the session data by AES-256-GCM. The key
+    is derived and the AEAD object is built once per secret key (see
+    :func:`_session_cipher`)."""
+    def __init__(self, secret_key):
+        bsecret_key = secret_key.encode('utf-8')
+        master_key = hmac(bsecret_key, b'kaylee.session|2', sha256).digest()
+        self._encryption_key = hmac(master_key, b'encryption',
+                                    sha256).digest()
+        self._aead = AESGCM(self._encryption_key)
+        # the keys of the legacy format
+        self.legacy_encryption_key = sha256(bsecret_key).digest()
+        self.legacy_mac_key = bsecret_key
+
+    def encrypt(self, data):
+        nonce = os.urandom(NONCE_LENGTH)
+        # the tag is appended to the ciphertext
+        return nonce + self._aead.encrypt(nonce, data, None)
+
+    def decrypt(self, buf):
+        if len(buf) < NONCE_LENGTH + TAG_LENGTH:
+            raise KayleeError('Encrypted data is malformed.')
+        try:
+            return self._aead.decrypt(buf[:NONCE_LENGTH],
+                                      buf[NONCE_LENGTH:], None)
+        except InvalidTag:
+            raise KayleeError('Encrypted data signature verification failed.')
 
-    iv, data = data.split('&', 1)
-    iv = b64decode(iv)
 
-    decryption_key = sha256(bsecret_key).digest()
-    decryptor = AES.new(decryption_key, AES.MODE_CBC, iv)
+@lru_cache(maxsize=32)
+def _session_cipher(secret_key):
+    """Returns the (shared) :class:`_SessionCipher` of the secret key."""
+    return _SessionCipher(secret_key)
 
-    mac.update(b'|' + data.encode('utf-8'))
-    decrypted_data = _decrypt_data(data, decryptor)
 
-    if b64decode(base64_hash) == mac.digest():
-        return decrypted_data
-    else:
-        raise KayleeError('Encrypted data signature verification failed.')
+def _encrypt(data, secret_key):
+    """Encrypt the data and return its string representation::
 
+      2.<base64(nonce + ciphertext + tag)>
 
-def _pad_data(s):
-    BLOCK_SIZE = 32
-    PADDING = b' '
-    return s + (BLOCK_SIZE - len(s) % BLOCK_SIZE) * PADDING
+    :param data: Data to encrypt. The data is pickled prior to encryption.
+    :param secret_key: A secret key to use.
+    :type data: any pickable Python object
+    :type secret_key: str
+    """
+    buf = _session_cipher(secret_key).encrypt(
+        pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+    return SESSION_DATA_FORMAT_PREFIX + urlsafe_b64encode(buf).decode('ascii')
 
 
-def _encrypt_data(data, encryptor):
-    val = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
-    val = encryptor.encrypt(_pad_data(val))
-    val = b64encode(val)
-    return val
+def _decrypt(s, secret_key):
+    """Decrypt the data returned by :func:`_encrypt`. The data
+    encrypted in the legacy (AES-CBC and HMAC-SHA1) format is accepted
+    as well.
+
+    :raises KayleeError: if the data is malformed or forged.
+    """
+    if not s.startswith(SESSION_DATA_FORMAT_PREFIX):
+        return _decrypt_legacy(s, secret_key)
+    try:
+        buf = urlsafe_b64decode(s[len(SESSION_DATA_FORMAT_PREFIX):])
+    except (ValueError, TypeError):
+        raise KayleeError('Encrypted data is malformed.')
+    return pickle.loads(_session_cipher(secret_key).decrypt(buf))
+
+
+def _decrypt_legacy(s, secret_key):
+    # the format used by the previous versions:
+    # <base64(HMAC-SHA1)>?<base64(iv)>&<base64(AES-CBC(data))>
+    cipher = _session_cipher(secret_key)
+    try:
+        base64_hash, data = s.split('?', 1)
+        iv, data = data.split('&', 1)
+        iv = b64decode(iv)
+        signature = b64decode(base64_hash)
+    except ValueError:
+        raise KayleeError('Encrypted data is malformed.')
+
+    mac = hmac(cipher.legacy_mac_key, b'|' + data.encode('utf-8'), sha1)
+    if not compare_digest(signature, mac.digest()):
+        raise KayleeError('Encrypted data signature verification failed.')
+    decryptor = Cipher(algorithms.AES(cipher.legacy_encryption_key),
+                       modes.CBC(iv)).decryptor()
+    return _decrypt_data(data, decryptor)
 
 
 def _decrypt_data(data, decryptor):
     val = b64decode(data)
-    val = decryptor.decrypt(val).rstrip(b' ')
+    val = (decryptor.update(val) + decryptor.finalize()).rstrip(b' ')
     val = pickle.loads(val)
     return val
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import asyncio
+import threading
+
+from kaylee.testsuite import KayleeTest, load_tests
+from kaylee import NodeID, loader
+from kaylee.aio import (AsyncKaylee, AsyncController, ThreadPoolController,
+                        ThreadPoolTemporalStorage, ThreadPoolPermanentStorage)
+from kaylee.contrib import MemoryTemporalStorage, MemoryPermanentStorage
+from kaylee.contrib.registries import ArrayNodesRegistry
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class AsyncKayleeTests(KayleeTest):
+    def setUp(self):
+        self.settings = __import__('test_settings')
+
+    def test_wrap(self):
+        kl = loader.load(self.settings)
+        akl = AsyncKaylee.wrap(kl)
+        self.assertIs(akl.config, kl.config)
+        self.assertEqual(akl.applications.names, kl.applications.names)
+        self.assertIsInstance(akl.applications['test.1'], ThreadPoolController)
+        self.assertIs(akl.applications['test.1'].wrapped,
+                      kl.applications['test.1'])
+
+    def test_is_abstract(self):
+        self.assertRaises(TypeError, AsyncController)
+
+    def test_register_subscribe_and_actions(self):
+        kl = loader.load(self.settings)
+        akl = AsyncKaylee.wrap(kl)
+
+        async def scenario():
+            node_id = json.loads(await akl.register('127.0.0.1'))['node_id']
+            self.assertIn(NodeID(node_id), kl.registry)
+            app_config = json.loads(await akl.subscribe(node_id, 'test.1'))
+            self.assertEqual(app_config['test_key'], 'test_value')
+
+            action = json.loads(await akl.get_action(node_id))
+            self.assertEqual(action['action'], 'task')
+            action = json.loads(await akl.accept_result(node_id,
+                                                        '{"res" : 1}'))
+            self.assertEqual(action['action'], 'task')
+            self.assertEqual(len(kl.applications['test.1'].permanent_storage),
+                             1)
+
+            # an invalid result unsubscribes the node
+            res = json.loads(await akl.accept_result(node_id, '{"r" : 1}'))
+            self.assertIn('error', res)
+            self.assertIsNone(kl.registry[node_id].controller)
+
+            await akl.unregister(node_id)
+            self.assertNotIn(NodeID(node_id), kl.registry)
+            # a registry which does not return the removed nodes
+            kl.registry.clean = lambda: None
+            await akl.clean()
+            res = json.loads(await akl.get_action(node_id))
+            self.assertIn('error', res)
+        run(scenario())
+
+    def test_unsubscribe_releases_tasks(self):
+        kl = loader.load(self.settings)
+        akl = AsyncKaylee.wrap(kl)
+
+        async def scenario():
+            node_id = json.loads(await akl.register('127.0.0.1'))['node_id']
+            other_id = json.loads(await akl.register('127.0.0.1'))['node_id']
+            await akl.subscribe(other_id, 'test.1')
+
+            await akl.subscribe(node_id, 'test.1')
+            action = json.loads(await akl.get_action(node_id))
+            await akl.unsubscribe(node_id)
+            self.assertEqual(json.loads(await akl.get_action(other_id))
+                             ['data']['id'], action['data']['id'])
+
+            # an invalid result unsubscribes the node as well
+            await akl.subscribe(node_id, 'test.1')
+            action = json.loads(await akl.get_action(node_id))
+            res = json.loads(await akl.accept_result(node_id, '{"r" : 1}'))
+            self.assertIn('error', res)
+            self.assertEqual(json.loads(await akl.accept_result(
+                other_id, '{"res" : 1}'))['data']['id'],
+                action['data']['id'])
+        run(scenario())
+
+    def test_batched_actions(self):
+        kl = loader.load(self.settings)
+        # the nodes are stored back to the registry on every request
+        kl.registry = ArrayNodesRegistry(timeout='10s')
+        app = kl.applications['test.1']
+        app.tasks_batch_limit = 2
+        akl = AsyncKaylee.wrap(kl)
+
+        async def scenario():
+            node_id = json.loads(await akl.register('127.0.0.1'))['node_id']
+            await akl.subscribe(node_id, 'test.1')
+            action = json.loads(await akl.get_action(node_id, 2))
+            self.assertEqual(action['action'], 'tasks')
+            results = [{'task_id' : t['id'], 'result' : {'res' : 1}}
+                       for t in action['data']]
+            action = json.loads(await akl.accept_result(node_id,
+                                                        json.dumps(results)))
+            self.assertEqual(action['errors'], [])
+            self.assertEqual(action['action'], 'tasks')
+            self.assertEqual(kl.registry[node_id].task_ids,
+                             tuple(t['id'] for t in action['data']))
+
+            # no tasks for the next batch
+            app.get_task = lambda node: None
+            results = [{'task_id' : t['id'], 'result' : {'res' : 1}}
+                       for t in action['data']]
+            action = json.loads(await akl.accept_results(node_id, results))
+            self.assertEqual(action['action'], 'nop')
+            self.assertEqual(kl.registry[node_id].task_ids, ())
+        run(scenario())
+
+    def test_concurrent_requests(self):
+        kl = loader.load(self.settings)
+        akl = AsyncKaylee.wrap(kl)
+
+        async def node_scenario():
+            node_id = json.loads(await akl.register('127.0.0.1'))['node_id']
+            await akl.subscribe(node_id, 'test.1')
+            return json.loads(await akl.get_action(node_id))
+
+        async def scenario():
+            return await asyncio.gather(*[node_scenario() for i in range(20)])
+
+        actions = run(scenario())
+        self.assertEqual(len(kl.registry), 20)
+        # the project has 10 tasks, the leased tasks are not duplicated
+        tasks = [a['data']['id'] for a in actions if a['action'] == 'task']
+        self.assertEqual(len(set(tasks)), 10)
+        self.assertEqual(len(tasks), 10)
+        self.assertEqual(sum(a['action'] == 'nop' for a in actions), 10)
+
+    def test_long_poll(self):
+        kl = loader.load(self.settings)
+        kl.config.LONG_POLL_TIMEOUT = 10
+        app = kl.applications['test.1']
+        get_task = app.get_task
+        app.tasks_available = False
+        app.get_task = lambda node: (get_task(node) if app.tasks_available
+                                     else None)
+        # the leases are examined in the thread pool as well
+        reissue_threads = []
+        app.reissue_due_in = lambda: reissue_threads.append(
+            threading.current_thread())
+        akl = AsyncKaylee.wrap(kl)
+
+        async def produce_task():
+            await asyncio.sleep(0.05)
+            app.tasks_available = True
+            app.notify_tasks_available()
+
+        async def scenario():
+            node_id = json.loads(await akl.register('127.0.0.1'))['node_id']
+            await akl.subscribe(node_id, 'test.1')
+            start = time.monotonic()
+            action, _ = await asyncio.gather(akl.get_action(node_id),
+                                             produce_task())
+            self.assertLess(time.monotonic() - start, 5)
+            return json.loads(action)
+
+        self.assertEqual(run(scenario())['action'], 'task')
+        self.assertEqual(app._tasks_listeners, [])
+        self.assertTrue(reissue_threads)
+        self.assertNotIn(threading.main_thread(), reissue_threads)
+
+
+class ThreadPoolStoragesTests(KayleeTest):
+    def test_temporal_storage(self):
+        ts = ThreadPoolTemporalStorage(MemoryTemporalStorage())
+        node_id = NodeID()
+
+        async def scenario():
+            await ts.add('t1', node_id, 'r1')
+            self.assertTrue(await ts.contains('t1', node_id))
+            self.assertEqual(await ts.get('t1'), {node_id : 'r1'})
+            self.assertEqual(await ts.count(), 1)
+            await ts.remove('t1')
+            self.assertEqual(await ts.count(), 0)
+        run(scenario())
+
+    def test_permanent_storage(self):
+        ps = ThreadPoolPermanentStorage(MemoryPermanentStorage())
+
+        async def scenario():
+            await ps.add('t1', 'r1')
+            self.assertTrue(await ps.contains('t1', 'r1'))
+            self.assertEqual(await ps.get('t1'), ['r1'])
+            self.assertEqual(await ps.count(), 1)
+        run(scenario())
+
+
+kaylee_suite = load_tests([AsyncKayleeTests, ThreadPoolStoragesTests])
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import asyncio
+import tempfile
+import unittest
+
+from kaylee.testsuite import KayleeTest, load_tests
+from kaylee import loader
+from kaylee.codecs import get_codec
+from kaylee.contrib.frontends.asgi_frontend import make_asgi_app
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def request(app, method, path, body=b'', query_string=b'', chunk_size=None,
+            headers=()):
+    """Calls the ASGI application and returns a ``(status, headers, body)``
+    tuple."""
+    chunk_size = chunk_size or max(len(body), 1)
+    chunks = [body[i:i + chunk_size]
+              for i in range(0, len(body), chunk_size)] or [b'']
+    messages = [{'type' : 'http.request', 'body' : chunk,
+                 'more_body' : i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        'type' : 'http',
+        'method' : method,
+        'path' : path,
+        'query_string' : query_string,
+        'headers' : list(headers),
+        'client' : ('127.0.0.1', 12345),
+    }
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(app(scope, receive, send))
+    finally:
+        loop.close()
+    start, body = sent
+    return start['status'], dict(start['headers']), body['body']
+
+
+def websocket_session(app, requests, path='/kaylee/ws'):
+    """Sends the requests to the application's WebSocket endpoint and
+    returns the list of sent messages."""
+    messages = [{'type' : 'websocket.connect'}]
+    messages += [{'type' : 'websocket.receive', 'text' : json.dumps(r)}
+                 for r in requests]
+    messages.append({'type' : 'websocket.disconnect', 'code' : 1000})
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        'type' : 'websocket',
+        'path' : path,
+        'client' : ('127.0.0.1', 12345),
+    }
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(app(scope, receive, send))
+    finally:
+        loop.close()
+    return sent
+
+
+class ASGIFrontendTests(KayleeTest):
+    def setUp(self):
+        self.settings = __import__('test_settings')
+        self.kl = loader.load(self.settings)
+        self.app = make_asgi_app(self.kl)
+
+    def test_routes(self):
+        app = self.app
+        status, headers, body = request(app, 'GET', '/kaylee/register')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], b'application/json')
+        self.assertEqual(int(headers[b'content-length']), len(body))
+        node_id = json.loads(body.decode())['node_id']
+
+        status, _, body = request(
+            app, 'POST', '/kaylee/apps/test.1/subscribe/{}'.format(node_id))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode())['test_key'], 'test_value')
+
+        status, _, body = request(app, 'GET',
+                                  '/kaylee/actions/{}'.format(node_id))
+        self.assertEqual(json.loads(body.decode())['action'], 'task')
+
+        # the body is read in chunks
+        status, _, body = request(app, 'POST',
+                                  '/kaylee/actions/{}'.format(node_id),
+                                  body=b'{"res" : 10}', chunk_size=3)
+        self.assertEqual(json.loads(body.decode())['action'], 'task')
+        app_obj = self.kl.applications['test.1']
+        self.assertEqual(len(app_obj.permanent_storage), 1)
+
+    def test_batched_action(self):
+        self.kl.applications['test.1'].tasks_batch_limit = 5
+        _, _, body = request(self.app, 'GET', '/kaylee/register')
+        node_id = json.loads(body.decode())['node_id']
+        request(self.app, 'POST',
+                '/kaylee/apps/test.1/subscribe/{}'.format(node_id))
+        _, _, body = request(self.app, 'GET',
+                             '/kaylee/actions/{}'.format(node_id),
+                             query_string=b'count=3')
+        action = json.loads(body.decode())
+        self.assertEqual(action['action'], 'tasks')
+        self.assertEqual(len(action['data']), 3)
+
+    @unittest.skipIf(fcntl is None, 'requires POSIX file locking')
+    def test_shared_memory_registry(self):
+        # the nodes are restored from the shared file by the registry
+        tmpdir = tempfile.mkdtemp(prefix='kl_unit_test__')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        settings = {k : getattr(self.settings, k) for k in dir(self.settings)
+                    if k == k.upper()}
+        settings['REGISTRY'] = {
+            'name' : 'SharedMemoryNodesRegistry',
+            'config' : {'timeout' : '10s',
+                        'path' : os.path.join(tmpdir, 'nodes.shm')},
+        }
+        kl = loader.load(settings)
+        self.addCleanup(kl.registry.close)
+        app = make_asgi_app(kl)
+        _, _, body = request(app, 'GET', '/kaylee/register')
+        node_id = json.loads(body.decode())['node_id']
+        request(app, 'POST',
+                '/kaylee/apps/test.1/subscribe/{}'.format(node_id))
+        _, _, body = request(app, 'GET',
+                             '/kaylee/actions/{}'.format(node_id))
+        self.assertEqual(json.loads(body.decode())['action'], 'task')
+        _, _, body = request(app, 'POST',
+                             '/kaylee/actions/{}'.format(node_id),
+                             body=b'{"res" : 10}')
+        self.assertEqual(json.loads(body.decode())['action'], 'task')
+        self.assertEqual(len(kl.applications['test.1'].permanent_storage), 1)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_negotiated_codec(self):
+        self.kl.codecs.insert(0, get_codec('msgpack'))
+        status, headers, body = request(
+            self.app, 'GET', '/kaylee/register',
+            headers=[(b'accept', b'application/msgpack, application/json')])
+        self.assertEqual(headers[b'content-type'], b'application/msgpack')
+        node_id = msgpack.unpackb(body, raw=False)['node_id']
+        request(self.app, 'POST',
+                '/kaylee/apps/test.1/subscribe/{}'.format(node_id))
+        request(self.app, 'GET', '/kaylee/actions/{}'.format(node_id))
+        _, headers, body = request(self.app, 'POST',
+                                   '/kaylee/actions/{}'.format(node_id),
+                                   body=msgpack.packb({'res' : 10}))
+        self.assertEqual(headers[b'content-type'], b'application/msgpack')
+        self.assertEqual(msgpack.unpackb(body, raw=False)['action'], 'task')
+
+    def test_errors(self):
+        status, _, _ = request(self.app, 'GET', '/kaylee/unknown')
+        self.assertEqual(status, 404)
+        status, _, _ = request(self.app, 'POST', '/kaylee/register')
+        self.assertEqual(status, 405)
+        status, _, _ = request(self.app, 'GET', '/kaylee/actions/abc')
+        self.assertEqual(status, 404)
+        status, _, body = request(self.app, 'GET',
+                                  '/kaylee/actions/' + '0' * 20)
+        self.assertEqual(status, 200)
+        self.assertIn('error', json.loads(body.decode()))
+
+    def test_websocket(self):
+        sent = websocket_session(self.app, [
+            {'id' : 1, 'method' : 'register'},
+            {'id' : 2, 'method' : 'subscribe', 'app_name' : 'test.1'},
+            {'id' : 3, 'method' : 'get_action'},
+            {'id' : 4, 'method' : 'send_result', 'result' : {'res' : 10}},
+            {'id' : 5, 'method' : 'unknown'},
+        ])
+        self.assertEqual(sent[0]['type'], 'websocket.accept')
+        replies = [json.loads(m['text']) for m in sent[1:]]
+        self.assertEqual([r['id'] for r in replies], [1, 2, 3, 4, 5])
+        node_id = replies[0]['data']['node_id']
+        self.assertIn(node_id, self.kl.registry)
+        self.assertEqual(replies[1]['data']['test_key'], 'test_value')
+        self.assertEqual(replies[2]['data']['action'], 'task')
+        self.assertEqual(replies[3]['data']['action'], 'task')
+        self.assertIn('error', replies[4]['data'])
+        app_obj = self.kl.applications['test.1']
+        self.assertEqual(len(app_obj.permanent_storage), 1)
+
+    def test_websocket_batched_results(self):
+        self.kl.applications['test.1'].tasks_batch_limit = 2
+        sent = websocket_session(self.app, [
+            {'id' : 1, 'method' : 'register'},
+            {'id' : 2, 'method' : 'subscribe', 'app_name' : 'test.1'},
+            {'id' : 3, 'method' : 'get_action', 'count' : 2},
+        ])
+        replies = [json.loads(m['text']) for m in sent[1:]]
+        node_id = replies[0]['data']['node_id']
+        tasks = replies[2]['data']['data']
+        self.assertEqual(len(tasks), 2)
+
+        # a new connection, the node id is passed explicitly
+        results = [{'task_id' : t['id'], 'result' : {'res' : 1}}
+                   for t in tasks]
+        sent = websocket_session(self.app, [
+            {'id' : 1, 'method' : 'send_result', 'node_id' : node_id,
+             'result' : results},
+        ])
+        reply = json.loads(sent[1]['text'])
+        self.assertEqual(reply['data']['errors'], [])
+        app_obj = self.kl.applications['test.1']
+        self.assertEqual(len(app_obj.permanent_storage), 2)
+
+    def test_websocket_unknown_path(self):
+        sent = websocket_session(self.app, [], path='/kaylee/unknown')
+        self.assertEqual(sent, [{'type' : 'websocket.close'}])
+
+
+kaylee_suite = load_tests([ASGIFrontendTests])
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+from kaylee.testsuite import KayleeTest, load_tests
+from kaylee import loader, KayleeError
+from kaylee.codecs import (get_codec, negotiate, content_type, JSONCodec,
+                           EncodedData, ResponseEncoder, JSONResponseEncoder)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class CodecsTests(KayleeTest):
+    def setUp(self):
+        self.settings = __import__('test_settings')
+
+    def test_json_codec(self):
+        codec = get_codec('json')
+        self.assertIs(codec, get_codec('json'))
+        data = codec.encode({'a' : [1, 2.5]})
+        self.assertEqual(data, '{"a":[1,2.5]}')
+        self.assertEqual(content_type(data), 'application/json')
+        self.assertEqual(codec.decode(data), {'a' : [1, 2.5]})
+        self.assertEqual(codec.decode(data.encode('utf-8')), {'a' : [1, 2.5]})
+
+    def test_json_response_encoder(self):
+        codec = get_codec('json')
+        encoder = codec.response_encoder()
+        self.assertIsInstance(encoder, JSONResponseEncoder)
+        generic = ResponseEncoder(codec)
+
+        def assert_same(method, *args, **kwargs):
+            self.assertEqual(
+                json.loads(getattr(encoder, method)(*args, **kwargs)),
+                json.loads(getattr(generic, method)(*args, **kwargs)))
+
+        assert_same('action', 'nop')
+        assert_same('action', 'task', {'id' : 't1', 'data' : [1, 2]})
+        assert_same('action', 'tasks', [{'id' : 't1'}, {'id' : '"t2"'}])
+        assert_same('action', 'unsubscribe', 'The node has been unsubscribed')
+        assert_same('action', 'custom', 10)
+        assert_same('action', 'nop', errors=[{'task_id' : '1', 'error' : 'e'}])
+        self.assertIs(encoder.action('nop'), encoder.action('nop'))
+
+        config = {'AUTO_GET_ACTION' : True}
+        apps = ['app.1', 'app.2']
+        assert_same('register', 'abcdef', config, apps)
+        # a new configuration dict replaces the serialized fragment
+        config = {'AUTO_GET_ACTION' : False}
+        assert_same('register', 'abcdef', config, apps)
+        self.assertFalse(json.loads(encoder.register('ab', config, apps))
+                         ['config']['AUTO_GET_ACTION'])
+
+        # a released configuration dict does not match a new one,
+        # even if the new dict reuses its memory (and id)
+        for i in range(10):
+            config = {'LONG_POLL_TIMEOUT' : i}
+            data = encoder.register('ab', config, apps)
+            self.assertEqual(json.loads(data)['config'], config)
+            del config
+
+    def test_json_dumps_is_not_patched(self):
+        self.assertEqual(json.dumps([1, 2]), '[1, 2]')
+
+    def test_unknown_codec(self):
+        self.assertRaises(KayleeError, get_codec, 'xml')
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack_codec(self):
+        codec = get_codec('msgpack')
+        data = codec.encode({'a' : [1, 2.5]})
+        self.assertIsInstance(data, EncodedData)
+        self.assertEqual(content_type(data), 'application/msgpack')
+        self.assertEqual(codec.decode(data), {'a' : [1, 2.5]})
+        self.assertRaises(ValueError, codec.decode, '{}')
+
+    @unittest.skipIf(cbor2 is None, 'cbor2 is not installed')
+    def test_cbor_codec(self):
+        codec = get_codec('cbor')
+        data = codec.encode({'a' : [1, 2.5]})
+        self.assertEqual(content_type(data), 'application/cbor')
+        self.assertEqual(codec.decode(data), {'a' : [1, 2.5]})
+
+    def test_negotiate(self):
+        json_codec = get_codec('json')
+        self.assertIs(negotiate(None, [json_codec]), json_codec)
+        self.assertIs(negotiate('text/html, */*', [json_codec]), json_codec)
+        self.assertIs(negotiate(['json'], [json_codec]), json_codec)
+
+        codecs = [json_codec, DummyCodec()]
+        self.assertIs(negotiate(['dummy', 'json'], codecs), codecs[1])
+        self.assertIs(negotiate('application/x-dummy;q=0.9, application/json',
+                                codecs), codecs[1])
+        self.assertIs(negotiate('application/json, application/x-dummy',
+                                codecs), json_codec)
+        # the codecs which are not available on the server are ignored
+        self.assertIs(negotiate(['dummy'], [json_codec]), json_codec)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_negotiated_node_communication(self):
+        settings = {k : getattr(self.settings, k) for k in dir(self.settings)
+                    if k == k.upper()}
+        settings['CODECS'] = ['msgpack', 'json']
+        kl = loader.load(settings)
+        codec = get_codec('msgpack')
+
+        # a node which accepts JSON only
+        json_node = json.loads(kl.register('127.0.0.1'))
+        self.assertEqual(json_node['codec'], 'json')
+
+        data = kl.register('127.0.0.1', 'application/msgpack')
+        self.assertEqual(content_type(data), 'application/msgpack')
+        node_id = codec.decode(data)['node_id']
+        self.assertEqual(kl.registry[node_id].codec, 'msgpack')
+
+        app_config = codec.decode(kl.subscribe(node_id, 'test.1'))
+        self.assertEqual(app_config['test_key'], 'test_value')
+        action = codec.decode(kl.get_action(node_id))
+        self.assertEqual(action['action'], 'task')
+        action = codec.decode(kl.accept_result(node_id,
+                                               codec.encode({'res' : 1})))
+        self.assertEqual(action['action'], 'task')
+        self.assertEqual(len(kl.applications['test.1'].permanent_storage), 1)
+
+        # the errors are always JSON-formatted
+        res = kl.accept_result(node_id, '{"res" : 1}')
+        self.assertEqual(content_type(res), 'application/json')
+        self.assertIn('error', json.loads(res))
+
+
+class DummyCodec(JSONCodec):
+    name = 'dummy'
+    content_type = 'application/x-dummy'
+
+
+kaylee_suite = load_tests([CodecsTests])
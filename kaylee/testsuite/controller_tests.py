@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
+import time
 from abc import ABCMeta, abstractmethod
+from unittest import mock
 
 from kaylee import Controller
-from kaylee.testsuite import (load_tests, TestPermanentStorage)
-from kaylee.testsuite.helper import SubclassTestsBase
+from kaylee.controller import (TaskLeases, NodeScores, NO_SOLUTION,
+                               result_digest)
+from kaylee.testsuite import (KayleeTest, load_tests, TestPermanentStorage,
+                              TestTemporalStorage)
+from kaylee.testsuite.helper import SubclassTestsBase, NonAbstractRangeProject
 from kaylee.testsuite.projects.auto_test_project import AutoTestProject
 from kaylee.node import Node, NodeID
-from kaylee.contrib.controllers import SimpleController
-from kaylee.errors import InvalidResultError
+from kaylee.contrib.controllers import (SimpleController,
+                                       ResultsComparatorController)
+from kaylee.errors import (InvalidResultError, ApplicationCompletedError,
+                           NodeRequestRejectedError)
 
 
 
@@ -35,6 +42,19 @@ class ControllerTestsBase(SubclassTestsBase, metaclass=ABCMeta):
             task = ctr.get_task(node)
             self.assertTrue(task is None or isinstance(task, dict))
 
+    def test_get_tasks(self):
+        node, ctr = self.make_node_and_controller()
+        ctr.tasks_batch_limit = 3
+        tasks = ctr.get_tasks(node, 5)
+        self.assertEqual(len(tasks), 3)
+        self.assertEqual(node.task_ids, tuple(t['id'] for t in tasks))
+        self.assertEqual(node.task_id, tasks[-1]['id'])
+
+        ctr.tasks_batch_limit = 1
+        tasks = ctr.get_tasks(node, 5)
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(node.task_ids, (tasks[0]['id'], ))
+
     def test_accept_result(self):
         node, ctr = self.make_node_and_controller()
         task = ctr.get_task(node)
@@ -53,6 +73,173 @@ class SimpleControllerTests(ControllerTestsBase):
     def test_init(self):
         pass
 
+    def test_tasks_batch_limit(self):
+        self.assertRaises(ValueError, SimpleController, 'app',
+                          AutoTestProject(), TestPermanentStorage(),
+                          tasks_batch_limit=0)
+        ctr = SimpleController('app', AutoTestProject(),
+                               TestPermanentStorage(), tasks_batch_limit=5)
+        self.assertEqual(ctr.tasks_batch_limit, 5)
+        self.assertEqual(ctr.client_config['__kl_tasks_batch_limit__'], 5)
+
+    def test_release_tasks(self):
+        node, ctr = self.make_node_and_controller()
+        tasks = [ctr.get_task(node)['id'] for i in range(3)]
+        node.lease_tasks(tasks[:2])
+        ctr.release_tasks(node)
+        other = Node(NodeID())
+        other.subscribe(ctr)
+        self.assertEqual(ctr.get_task(other)['id'], tasks[0])
+        # a solved released task is not handed out
+        other.task_id = tasks[1]
+        ctr.accept_result(other, {'res' : tasks[1]})
+        self.assertNotIn(ctr.get_task(other)['id'], tasks)
+
+    def test_lease_timeout(self):
+        ctr = SimpleController('app', AutoTestProject(tasks_count=2),
+                               TestPermanentStorage(), lease_timeout=10)
+        n1, n2, n3 = Node(NodeID()), Node(NodeID()), Node(NodeID())
+        for node in (n1, n2, n3):
+            node.subscribe(ctr)
+        t1 = ctr.get_task(n1)['id']
+        t2 = ctr.get_task(n2)['id']
+        # the leased tasks are not re-issued before the timeout
+        self.assertIsNone(ctr.get_task(n3))
+        self.assertLessEqual(ctr.reissue_due_in(), 10)
+
+        # the oldest expired lease is re-issued first
+        later = time.monotonic() + 11
+        with mock.patch('kaylee.controller.time.monotonic', lambda: later):
+            self.assertEqual(ctr.reissue_due_in(), 0)
+            self.assertEqual(ctr.get_task(n3)['id'], t1)
+            self.assertEqual(ctr.leases.owners(t1),
+                             {n1.id.binary, n3.id.binary})
+            self.assertEqual(ctr.get_task(n3)['id'], t2)
+            self.assertIsNone(ctr.get_task(n3))
+
+        # the leases are released on the results acceptance
+        n2.task_id = t1
+        ctr.accept_result(n2, {'res' : 1})
+        n3.task_id = t2
+        ctr.accept_result(n3, {'res' : 2})
+        self.assertEqual(len(ctr.leases), 0)
+        self.assertIsNone(ctr.reissue_due_in())
+        self.assertRaises(ApplicationCompletedError, ctr.get_task, n1)
+
+    def test_speculative_execution(self):
+        clock = [0.0]
+        with mock.patch('kaylee.controller.time.monotonic',
+                        lambda: clock[0]), \
+             mock.patch('kaylee.contrib.controllers.time.monotonic',
+                        lambda: clock[0]):
+            storage = TestPermanentStorage()
+            ctr = SimpleController('app', AutoTestProject(tasks_count=12),
+                                   storage, speculation_factor=2)
+            fast, slow, unknown = Node(NodeID()), Node(NodeID()), Node(NodeID())
+            for node in (fast, slow, unknown):
+                node.subscribe(ctr)
+
+            # the fast node solves a task per second
+            for i in range(10):
+                ctr.get_task(fast)
+                clock[0] += 1
+                ctr.accept_result(fast, {'res' : 1})
+            self.assertEqual(ctr.completion_times.median(), 1)
+            straggler = ctr.get_task(slow)['id']
+            ctr.get_task(fast)
+            clock[0] += 1
+            ctr.accept_result(fast, {'res' : 1})
+
+            # the straggler is not overdue yet
+            self.assertIsNone(ctr.get_task(fast))
+            self.assertEqual(ctr.reissue_due_in(), 1)
+            clock[0] += 2
+            self.assertEqual(ctr.reissue_due_in(), 0)
+            # the node without statistics is not considered fast
+            self.assertIsNone(ctr.get_task(unknown))
+            self.assertEqual(ctr.get_task(fast)['id'], straggler)
+            self.assertEqual(ctr.leases.owners(straggler),
+                             {fast.id.binary, slow.id.binary})
+            self.assertIsNone(ctr.get_task(unknown))
+
+            # the first result is accepted, the late one is discarded
+            clock[0] += 1
+            ctr.accept_result(fast, {'res' : 1})
+            self.assertEqual(len(storage), 12)
+            ctr.accept_result(slow, {'res' : 1})
+            self.assertEqual(len(storage), 12)
+            self.assertEqual(ctr._late, {})
+            self.assertRaises(ApplicationCompletedError, ctr.get_task, slow)
+
+    def test_cost_lookahead(self):
+        class CostlyProject(AutoTestProject):
+            def task_cost(self, task):
+                return int(task['id'])
+
+        storage = TestPermanentStorage()
+        ctr = SimpleController('app', CostlyProject(tasks_count=12),
+                               storage, cost_lookahead=4)
+        nodes = []
+        for score in (10, 20, 30, 40):
+            node = Node(NodeID())
+            node.score = score
+            node.subscribe(ctr)
+            ctr.node_scores.record(node)
+            nodes.append(node)
+        slow, fast = nodes[0], nodes[-1]
+        unknown = Node(NodeID())
+        unknown.subscribe(ctr)
+
+        # tasks 1-4 are fetched in advance
+        self.assertEqual(ctr.get_task(fast)['id'], '4')
+        self.assertEqual(ctr.get_task(slow)['id'], '1')
+        self.assertEqual(ctr.get_task(unknown)['id'], '2')
+        # task 3 is handed out after it has been passed over 4 times
+        self.assertEqual([ctr.get_task(fast)['id'] for i in range(9)],
+                         ['7', '8', '9', '3', '11', '5', '6', '12', '10'])
+        self.assertIsNone(ctr.get_task(fast))
+        self.assertEqual(len(ctr.leases), 12)
+
+        self.assertRaises(ValueError, SimpleController, 'app',
+                          AutoTestProject(), storage, cost_lookahead=0)
+
+    def test_target_task_time(self):
+        clock = [0.0]
+        with mock.patch('kaylee.controller.time.monotonic',
+                        lambda: clock[0]), \
+             mock.patch('kaylee.contrib.controllers.time.monotonic',
+                        lambda: clock[0]):
+            project = NonAbstractRangeProject(100000, task_size=100)
+            ctr = SimpleController('app', project, TestPermanentStorage(),
+                                   target_task_time='10s')
+            self.assertEqual(ctr.target_task_time, 10)
+            fast, slow, unknown = Node(NodeID()), Node(NodeID()), Node(NodeID())
+            for node in (fast, slow, unknown):
+                node.subscribe(ctr)
+
+            # the throughputs are not measured yet
+            self.assertEqual(ctr.get_task(fast)['id'], '0-100')
+            self.assertEqual(ctr.get_task(slow)['id'], '100-200')
+            clock[0] += 1
+            ctr.accept_result(fast, {'res' : 1})
+            clock[0] += 9
+            ctr.accept_result(slow, {'res' : 1})
+            self.assertEqual(ctr.throughputs.node_throughput(fast), 100)
+            self.assertEqual(ctr.throughputs.node_throughput(slow), 10)
+
+            # 10 seconds of work
+            self.assertEqual(ctr.get_task(fast)['id'], '200-1200')
+            self.assertEqual(ctr.get_task(slow)['id'], '1200-1300')
+            self.assertEqual(ctr.get_task(unknown)['id'], '1300-2300')
+
+        storage = TestPermanentStorage()
+        self.assertRaises(TypeError, SimpleController, 'app',
+                          AutoTestProject(), storage, target_task_time=10)
+        self.assertRaises(ValueError, SimpleController, 'app', project,
+                          storage, target_task_time=0)
+        self.assertRaises(ValueError, SimpleController, 'app', project,
+                          storage, target_task_time=10, cost_lookahead=4)
+
     def test_is_abstract(self):
         project = AutoTestProject()
         storage = TestPermanentStorage()
@@ -64,4 +251,174 @@ class SimpleControllerTests(ControllerTestsBase):
                                 TestPermanentStorage())
 
 
-kaylee_suite = load_tests([SimpleControllerTests,])
+class ResultsComparatorControllerTests(ControllerTestsBase):
+    def test_init(self):
+        pass
+
+    def test_compare_results(self):
+        storage = TestPermanentStorage()
+        ctr = ResultsComparatorController('app', AutoTestProject(), storage,
+                                          TestTemporalStorage(),
+                                          results_count_threshold=3)
+        n1, n2, n3 = Node(NodeID()), Node(NodeID()), Node(NodeID())
+        for node in (n1, n2, n3):
+            node.subscribe(ctr)
+
+        # matching results, the nodes solve the same task
+        task_id = ctr.get_task(n1)['id']
+        n2.task_id = n3.task_id = task_id
+        ctr.accept_result(n1, {'res' : 10})
+        self.assertRaises(NodeRequestRejectedError, ctr.accept_result,
+                          n1, {'res' : 10})
+        ctr.accept_result(n2, {'res' : 10})
+        # only the digests are kept in the temporal storage
+        self.assertEqual(set(ctr.temporal_storage[task_id].values()),
+                         {result_digest(10)})
+        ctr.accept_result(n3, {'res' : 10})
+        self.assertEqual(storage[task_id], [10])
+        self.assertNotIn(task_id, ctr.temporal_storage)
+        self.assertEqual(ctr._candidates, {})
+
+        # a mismatching result, the task is solved again
+        task_id = ctr.get_task(n1)['id']
+        n2.task_id = n3.task_id = task_id
+        ctr.accept_result(n1, {'res' : 1})
+        ctr.accept_result(n2, {'res' : 2})
+        ctr.accept_result(n3, {'res' : 1})
+        self.assertNotIn(task_id, storage)
+        self.assertNotIn(task_id, ctr.temporal_storage)
+        self.assertIn(task_id, ctr._tasks_pool)
+
+        # no solution
+        task_id = ctr.get_task(n2)['id']
+        n1.task_id = n3.task_id = task_id
+        for node in (n1, n2, n3):
+            ctr.accept_result(node, NO_SOLUTION)
+        self.assertNotIn(task_id, storage)
+        self.assertNotIn(task_id, ctr._tasks_pool)
+
+    def cls_instance(self):
+        return ResultsComparatorController('test_comparator_app',
+                                           AutoTestProject(),
+                                           TestPermanentStorage(),
+                                           TestTemporalStorage(),
+                                           results_count_threshold=2)
+
+
+class TaskLeasesTests(KayleeTest):
+    def test_leases(self):
+        leases = TaskLeases('1m')
+        self.assertEqual(leases.timeout, 60)
+        self.assertIsNone(leases.due_in())
+        n1, n2 = Node(NodeID()), Node(NodeID())
+        leases.issue('t1', n1)
+        leases.issue('t2', n1)
+        leases.issue('t3', n2)
+        self.assertEqual(len(leases), 3)
+        self.assertIn('t1', leases)
+        self.assertEqual(leases.owners('t1'), {n1.id.binary})
+        self.assertIsNone(leases.reissue(n2))
+        self.assertTrue(55 < leases.due_in() <= 60)
+
+        # the lease expires immediately when its last owner leaves
+        leases.release_owner('t2', n1)
+        self.assertEqual(leases.due_in(), 0)
+        self.assertEqual(leases.reissue(n2), 't2')
+        self.assertEqual(leases.owners('t2'), {n2.id.binary})
+        self.assertIsNone(leases.reissue(n2))
+
+        self.assertTrue(leases.release('t1'))
+        self.assertFalse(leases.release('t1'))
+        self.assertNotIn('t1', leases)
+
+        later = time.monotonic() + 61
+        with mock.patch('kaylee.controller.time.monotonic', lambda: later):
+            # t3 was issued before t2 was re-issued
+            self.assertEqual(leases.reissue(n1), 't3')
+            self.assertEqual(leases.reissue(n1), 't2')
+            self.assertIsNone(leases.reissue(n1))
+
+        self.assertRaises(ValueError, TaskLeases, -1)
+
+    def test_stale_entries(self):
+        leases = TaskLeases(0)
+        node = Node(NodeID())
+        for i in range(1000):
+            leases.issue(i, node)
+            leases.release(i)
+        self.assertLess(len(leases._heap), 100)
+        self.assertIsNone(leases.due_in())
+
+
+class ResultDigestTests(KayleeTest):
+    def test_result_digest(self):
+        digest = result_digest({'a' : [1, 2.5, 'x'], 'b' : {'c' : None}})
+        self.assertEqual(len(digest), 32)
+        self.assertEqual(digest,
+                         result_digest({'b' : {'c' : None},
+                                        'a' : [1, 2.5, 'x']}))
+        self.assertNotEqual(digest,
+                            result_digest({'a' : [1, 2.5, 'y'],
+                                           'b' : {'c' : None}}))
+        self.assertEqual(result_digest((1, 2)), result_digest([1, 2]))
+        # the equal numbers
+        self.assertEqual(result_digest(1), result_digest(1.0))
+        self.assertEqual(result_digest({'a' : 1, 'b' : [3, -0.0, 0.5]}),
+                         result_digest({'a' : 1.0, 'b' : [3.0, 0, 0.5]}))
+        self.assertEqual(result_digest({2.0 : (1.5, 4.0)}),
+                         result_digest({2 : [1.5, 4]}))
+        self.assertNotEqual(result_digest([2.5]), result_digest([2]))
+        self.assertNotEqual(result_digest([True]), result_digest([1]))
+        self.assertNotEqual(result_digest([True]), result_digest([1.0]))
+        self.assertNotEqual(result_digest([1, 2]),
+                            result_digest([[1, 2]]))
+        # the dicts are not confused with the lists of pairs
+        self.assertNotEqual(result_digest({'a' : 1}),
+                            result_digest([('a', 1)]))
+        # the shared objects
+        item = {'x' : 'y' * 10}
+        self.assertEqual(result_digest([item, item]),
+                         result_digest([{'x' : 'y' * 10},
+                                        {'x' : 'y' * 10}]))
+        # the keys which are not comparable
+        self.assertEqual(result_digest({1 : 'a', 'b' : 2}),
+                         result_digest({1 : 'a', 'b' : 2}))
+        self.assertNotEqual(result_digest(NO_SOLUTION), result_digest(None))
+
+
+class NodeScoresTests(KayleeTest):
+    def test_rank(self):
+        scores = NodeScores(window=4, min_samples=3)
+        nodes = [Node(NodeID()) for i in range(5)]
+        for score, node in zip((10, 20, 30, 40, None), nodes):
+            node.score = score
+        scores.record(nodes[0])
+        scores.record(nodes[1])
+        self.assertIsNone(scores.rank(nodes[0]))
+        scores.record(nodes[2])
+        self.assertEqual(scores.rank(nodes[0]), 0)
+        self.assertEqual(scores.rank(nodes[1]), 0.5)
+        self.assertEqual(scores.rank(nodes[2]), 1)
+        self.assertIsNone(scores.rank(nodes[4]))
+
+        # a node which has not been recorded
+        self.assertEqual(scores.rank(nodes[3]), 1)
+        nodes[3].score = 20
+        self.assertEqual(scores.rank(nodes[3]), 0.5)
+        # the same scores
+        nodes[3].score = 15
+        scores.record(nodes[3])
+        nodes[1].score = 15
+        scores.record(nodes[1])
+        self.assertEqual(scores.rank(nodes[3]), 0.5)
+
+        # the least recently served node is pushed out of the window
+        nodes[4].score = 50
+        scores.record(nodes[4])
+        scores.forget(nodes[3])
+        self.assertEqual(scores.rank(nodes[1]), 0)
+
+
+kaylee_suite = load_tests([SimpleControllerTests,
+                           ResultsComparatorControllerTests, TaskLeasesTests,
+                           NodeScoresTests, ResultDigestTests])
@@ -1,5 +1,5 @@
 import unittest
-from kaylee.project import Project
+from kaylee.project import Project, RangeProject, AUTO_PROJECT_MODE
 from kaylee.contrib.storages import (MemoryTemporalStorage,
                                      MemoryPermanentStorage)
 from kaylee.contrib.controllers import SimpleController
@@ -44,6 +44,16 @@ class NonAbstractProject(Project):
         pass
 
 
+class NonAbstractRangeProject(RangeProject):
+    def __init__(self, units_count, **kwargs):
+        super(NonAbstractRangeProject, self).__init__('/script.js',
+                                                     AUTO_PROJECT_MODE,
+                                                     units_count, **kwargs)
+
+    def normalize_result(self, task_id, result):
+        return result
+
+
 class TestTemporalStorage(MemoryTemporalStorage):
     pass
 
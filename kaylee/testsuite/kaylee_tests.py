@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 import json
+import time
+import threading
+from unittest import mock
 
 from kaylee.testsuite import KayleeTest, load_tests
 from kaylee import NodeID, loader
+from kaylee.tokens import NodeTokens, is_node_token
+from kaylee.contrib.registries import ArrayNodesRegistry
 
 from datetime import datetime
 
@@ -14,10 +19,11 @@ class KayleeTests(KayleeTest):
         kl = loader.load(self.settings)
         node_json_config = kl.register('127.0.0.1')
         node_config = json.loads(node_json_config)
-        self.assertEqual(len(node_config), 3)
+        self.assertEqual(len(node_config), 4)
         self.assertIn('node_id', node_config)
         self.assertIn('config', node_config)
         self.assertIn('applications', node_config)
+        self.assertEqual(node_config['codec'], 'json')
 
         nid = NodeID(node_id = node_config['node_id'])
         self.assertIn(nid, kl.registry)
@@ -26,6 +32,13 @@ class KayleeTests(KayleeTest):
         kl.unregister(nid)
         self.assertNotIn(nid, kl.registry)
 
+        # the benchmark score
+        node_id = json.loads(kl.register('127.0.0.1', score='250'))['node_id']
+        self.assertEqual(kl.registry[node_id].score, 250)
+        node_id = json.loads(kl.register('127.0.0.1',
+                                         score='fast'))['node_id']
+        self.assertIsNone(kl.registry[node_id].score)
+
     def test_subscribe_unsubscribe(self):
         kl = loader.load(self.settings)
         app = kl.applications['test.1']
@@ -48,5 +61,270 @@ class KayleeTests(KayleeTest):
         self.assertIsNone(node.subscription_timestamp)
         self.assertIn(node, kl.registry)
 
+    def test_get_action(self):
+        kl = loader.load(self.settings)
+        node_id = json.loads(kl.register('127.0.0.1'))['node_id']
+        kl.subscribe(node_id, 'test.1')
+
+        action = json.loads(kl.get_action(node_id))
+        self.assertEqual(action['action'], 'task')
+        self.assertEqual(kl.registry[node_id].task_ids,
+                         (action['data']['id'], ))
+
+        action = json.loads(kl.accept_result(node_id, '{"res" : 1}'))
+        self.assertEqual(action['action'], 'task')
+
+    def test_get_action_batch(self):
+        kl = loader.load(self.settings)
+        app = kl.applications['test.1']
+        app.tasks_batch_limit = 3
+        node_id = json.loads(kl.register('127.0.0.1'))['node_id']
+        app_config = json.loads(kl.subscribe(node_id, 'test.1'))
+        self.assertEqual(app_config['__kl_tasks_batch_limit__'], 3)
+
+        # the requested amount is limited by the application
+        action = json.loads(kl.get_action(node_id, 5))
+        self.assertEqual(action['action'], 'tasks')
+        tasks = action['data']
+        self.assertEqual(len(tasks), 3)
+        self.assertEqual(len(set(t['id'] for t in tasks)), 3)
+        node = kl.registry[node_id]
+        self.assertEqual(node.task_ids, tuple(t['id'] for t in tasks))
+
+        # the leased tasks are solved in arbitrary order, the next
+        # batch is returned after the last leased task result
+        for task in [tasks[1], tasks[2]]:
+            res = json.dumps({'res' : 1, '__kl_task_id__' : task['id']})
+            action = json.loads(kl.accept_result(node_id, res))
+            self.assertEqual(action['action'], 'nop')
+        self.assertEqual(node.task_ids, (tasks[0]['id'], ))
+        self.assertEqual(len(app.permanent_storage), 2)
+
+        # a result of a task which is not leased is rejected
+        res = json.dumps({'res' : 1, '__kl_task_id__' : tasks[1]['id']})
+        self.assertIn('error', json.loads(kl.accept_result(node_id, res)))
+
+        res = json.dumps({'res' : 1, '__kl_task_id__' : tasks[0]['id']})
+        action = json.loads(kl.accept_result(node_id, res))
+        self.assertEqual(action['action'], 'tasks')
+        self.assertEqual(len(action['data']), 3)
+        self.assertEqual(len(app.permanent_storage), 3)
+
+    def test_accept_results(self):
+        kl = loader.load(self.settings)
+        app = kl.applications['test.1']
+        app.tasks_batch_limit = 4
+        node_id = json.loads(kl.register('127.0.0.1'))['node_id']
+        kl.subscribe(node_id, 'test.1')
+        tasks = json.loads(kl.get_action(node_id, 4))['data']
+        self.assertEqual(len(tasks), 4)
+
+        results = [
+            {'task_id' : tasks[0]['id'], 'result' : {'res' : 1}},
+            # invalid result
+            {'task_id' : tasks[1]['id'], 'result' : {'abc' : 1}},
+            # malformed entry
+            {'result' : {'res' : 1}},
+            # the task is not leased by the node
+            {'task_id' : 'xyz', 'result' : {'res' : 1}},
+            {'task_id' : tasks[2]['id'], 'result' : {'res' : 1}},
+        ]
+        action = json.loads(kl.accept_result(node_id, json.dumps(results)))
+        self.assertEqual(action['action'], 'nop')
+        self.assertEqual([e['task_id'] for e in action['errors']],
+                         [tasks[1]['id'], None, 'xyz'])
+        self.assertEqual(len(app.permanent_storage), 2)
+        node = kl.registry[node_id]
+        self.assertIsNotNone(node.controller)
+        self.assertEqual(node.task_ids, (tasks[3]['id'], ))
+
+        # the last leased task completes the batch
+        results = [{'task_id' : tasks[3]['id'], 'result' : {'res' : 1}}]
+        action = json.loads(kl.accept_results(node_id, results))
+        self.assertEqual(action['action'], 'tasks')
+        self.assertEqual(action['errors'], [])
+        self.assertEqual(len(app.permanent_storage), 3)
+
+        self.assertIn('error', json.loads(kl.accept_results(node_id, '{}')))
+
+    def _subscribed_node_with_no_tasks(self, kl):
+        app = kl.applications['test.1']
+        get_task = app.get_task
+        app.tasks_available = False
+        app.get_task = lambda node: (get_task(node) if app.tasks_available
+                                     else None)
+        node_id = json.loads(kl.register('127.0.0.1'))['node_id']
+        kl.subscribe(node_id, 'test.1')
+        return app, node_id
+
+    def test_accept_results_stored_node(self):
+        # ArrayNodesRegistry returns a new node object on every lookup,
+        # the node has to be stored back after the results are accepted.
+        kl = loader.load(self.settings)
+        kl.registry = ArrayNodesRegistry(timeout='10s')
+        app, node_id = self._subscribed_node_with_no_tasks(kl)
+        app.tasks_batch_limit = 3
+        app.tasks_available = True
+        tasks = json.loads(kl.get_action(node_id, 3))['data']
+        self.assertEqual(kl.registry[node_id].task_ids,
+                         tuple(t['id'] for t in tasks))
+
+        # no tasks for the next batch
+        app.tasks_available = False
+        results = [{'task_id' : t['id'], 'result' : {'res' : 1}}
+                   for t in tasks[:2]]
+        action = json.loads(kl.accept_results(node_id, results))
+        self.assertEqual(action['action'], 'nop')
+        self.assertEqual(kl.registry[node_id].task_ids, (tasks[2]['id'], ))
+
+        res = json.dumps({'res' : 1, '__kl_task_id__' : tasks[2]['id']})
+        action = json.loads(kl.accept_result(node_id, res))
+        self.assertEqual(action['action'], 'nop')
+        self.assertEqual(kl.registry[node_id].task_ids, ())
+        self.assertEqual(len(app.permanent_storage), 3)
+
+    def test_get_action_nop(self):
+        kl = loader.load(self.settings)
+        self.assertEqual(kl.config.LONG_POLL_TIMEOUT, 0)
+        app, node_id = self._subscribed_node_with_no_tasks(kl)
+        action = json.loads(kl.get_action(node_id))
+        self.assertEqual(action['action'], 'nop')
+        action = json.loads(kl.get_action(node_id, 3))
+        self.assertEqual(action['action'], 'nop')
+
+        app.tasks_available = True
+        action = json.loads(kl.get_action(node_id))
+        self.assertEqual(action['action'], 'task')
+
+    def test_long_poll(self):
+        kl = loader.load(self.settings)
+        kl.config.LONG_POLL_TIMEOUT = 0.1
+        self.assertEqual(kl.config.client_config()['LONG_POLL_TIMEOUT'], 0.1)
+        app, node_id = self._subscribed_node_with_no_tasks(kl)
+
+        # timeout
+        start = time.monotonic()
+        action = json.loads(kl.get_action(node_id))
+        self.assertEqual(action['action'], 'nop')
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+        # notification
+        kl.config.LONG_POLL_TIMEOUT = 10
+        def produce_task():
+            app.tasks_available = True
+            app.notify_tasks_available()
+        threading.Timer(0.05, produce_task).start()
+        start = time.monotonic()
+        action = json.loads(kl.get_action(node_id))
+        self.assertEqual(action['action'], 'task')
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(app._tasks_listeners, [])
+
+        # a task re-issue becomes due
+        app.tasks_available = False
+        due = time.monotonic() + 0.05
+        app.reissue_due_in = lambda: due - time.monotonic()
+        get_available_task = app.get_task
+        def get_task(node):
+            app.tasks_available = time.monotonic() >= due
+            return get_available_task(node)
+        app.get_task = get_task
+        start = time.monotonic()
+        action = json.loads(kl.get_action(node_id))
+        self.assertEqual(action['action'], 'task')
+        self.assertLess(time.monotonic() - start, 5)
+
+        # the next batch is waited for after the batch results
+        del app.reissue_due_in
+        app.get_task = get_available_task
+        app.tasks_available = True
+        tasks = json.loads(kl.get_action(node_id, 1))['data']
+        app.tasks_available = False
+        threading.Timer(0.05, produce_task).start()
+        res = json.dumps({'res' : 1, '__kl_task_id__' : tasks[0]['id']})
+        action = json.loads(kl.accept_result(node_id, res))
+        self.assertEqual(action['action'], 'tasks')
+        self.assertEqual(app._tasks_listeners, [])
+
+    def test_clean_releases_tasks(self):
+        kl = loader.load(self.settings)
+        app = kl.applications['test.1']
+        node_id = json.loads(kl.register('127.0.0.1'))['node_id']
+        kl.subscribe(node_id, 'test.1')
+        task_id = json.loads(kl.get_action(node_id))['data']['id']
+
+        # the node becomes inactive in a minute
+        later = time.time() + 60
+        with mock.patch('kaylee.contrib.registries.time.time',
+                        lambda: later):
+            kl.clean()
+        self.assertNotIn(node_id, kl.registry)
+
+        # the released task is the first to be handed out
+        other_id = json.loads(kl.register('127.0.0.1'))['node_id']
+        kl.subscribe(other_id, 'test.1')
+        action = json.loads(kl.get_action(other_id))
+        self.assertEqual(action['data']['id'], task_id)
+        self.assertEqual(app._tasks_listeners, [])
+
+        # a registry which does not return the removed nodes
+        kl.registry.clean = lambda: None
+        kl.clean()
+
+    def test_unsubscribe_releases_tasks(self):
+        kl = loader.load(self.settings)
+        app = kl.applications['test.1']
+        node_id = json.loads(kl.register('127.0.0.1'))['node_id']
+        other_id = json.loads(kl.register('127.0.0.1'))['node_id']
+        kl.subscribe(other_id, 'test.1')
+
+        kl.subscribe(node_id, 'test.1')
+        task_id = json.loads(kl.get_action(node_id))['data']['id']
+        kl.unsubscribe(node_id)
+        action = json.loads(kl.get_action(other_id))
+        self.assertEqual(action['data']['id'], task_id)
+
+        # an invalid result unsubscribes the node as well
+        kl.subscribe(node_id, 'test.1')
+        task_id = json.loads(kl.get_action(node_id))['data']['id']
+        res = json.loads(kl.accept_result(node_id, '{"r" : 1}'))
+        self.assertIn('error', res)
+        self.assertIsNone(kl.registry[node_id].controller)
+        action = json.loads(kl.accept_result(other_id, '{"res" : 1}'))
+        self.assertEqual(action['data']['id'], task_id)
+        self.assertEqual(app._tasks_listeners, [])
+
+    def test_node_tokens(self):
+        kl = loader.load(self.settings)
+        kl.node_tokens = NodeTokens(kl.config.SECRET_KEY, kl.registry.timeout)
+        app = kl.applications['test.1']
+        token = json.loads(kl.register('127.0.0.1'))['node_id']
+        self.assertTrue(is_node_token(token))
+        self.assertEqual(len(kl.registry), 0)
+
+        app_config = json.loads(kl.subscribe(token, 'test.1'))
+        token = app_config['__kl_node_id__']
+        action = json.loads(kl.get_action(token))
+        self.assertEqual(action['action'], 'task')
+        task_id = action['data']['id']
+
+        # the node state is carried by the token only: another Kaylee
+        # object (e.g. in another process) accepts the result
+        other = loader.load(self.settings)
+        other.node_tokens = kl.node_tokens
+        other._applications = kl.applications
+        res = json.dumps({'res' : 1})
+        action = json.loads(other.accept_result(action['node_id'], res))
+        self.assertEqual(action['action'], 'task')
+        self.assertNotEqual(action['data']['id'], task_id)
+        self.assertEqual(len(app.permanent_storage), 1)
+        self.assertEqual(len(kl.registry), 0)
+        self.assertEqual(len(other.registry), 0)
+
+        # a forged token is rejected
+        forged = action['node_id'][:-2] + 'AA'
+        self.assertIn('error', json.loads(kl.get_action(forged)))
+        kl.unregister(action['node_id'])
+
 
 kaylee_suite = load_tests([KayleeTests])
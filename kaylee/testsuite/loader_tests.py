@@ -11,7 +11,7 @@ from kaylee.errors import SettingsError
 from kaylee.contrib import (MemoryTemporalStorage,
                             MemoryPermanentStorage,
                             MemoryNodesRegistry)
-from kaylee.session import ClientSessionDataManager
+from kaylee.session import ClientSessionDataManager, SignedSessionDataManager
 from kaylee.loader import Loader, SettingsValidator
 from kaylee.util import generate_sercret_key
 
@@ -115,6 +115,13 @@ class KayleeLoaderTests(KayleeTest):
         sdm = ldr.session_data_manager
         self.assertIsInstance(sdm, ClientSessionDataManager)
 
+        settings['SESSION_DATA_MANAGER'] = {
+            'name' : 'SignedSessionDataManager',
+            'config' : { 'secret_key' : settings['SECRET_KEY'] },
+        }
+        sdm = Loader(settings).session_data_manager
+        self.assertIsInstance(sdm, SignedSessionDataManager)
+
     def test_load_kaylee(self):
         kl = loader.load(TestSettingsWithApps)
         self.assertIsInstance(kl.registry, MemoryNodesRegistry)
@@ -139,6 +146,16 @@ class KayleeLoaderTests(KayleeTest):
     def test_settings_validator(self):
         sv = SettingsValidator
         self.assertRaises(SettingsError, sv.validate_AUTO_GET_ACTION, {'AUTO_GET_ACTION': 10})
+        self.assertRaises(SettingsError, sv.validate_LONG_POLL_TIMEOUT, {'LONG_POLL_TIMEOUT': '10'})
+        self.assertRaises(SettingsError, sv.validate_LONG_POLL_TIMEOUT, {'LONG_POLL_TIMEOUT': -1})
+        sv.validate_LONG_POLL_TIMEOUT({'LONG_POLL_TIMEOUT': 30})
+        self.assertRaises(SettingsError, sv.validate_CODECS, {'CODECS': 'json'})
+        self.assertRaises(SettingsError, sv.validate_CODECS, {'CODECS': []})
+        self.assertRaises(SettingsError, sv.validate_CODECS, {'CODECS': ['xml']})
+        sv.validate_CODECS({'CODECS': ['json']})
+        self.assertRaises(SettingsError, sv.validate_NODE_TOKENS, {'NODE_TOKENS': 1})
+        self.assertRaises(SettingsError, sv.validate_NODE_TOKENS, {'NODE_TOKENS': True})
+        sv.validate_NODE_TOKENS({'NODE_TOKENS': True, 'SECRET_KEY': 'k' * 32})
         # self.assertRaises(KayleeError, Settings, SECRET_KEY=123)
         # self.assertRaises(KayleeError, Settings, SECRET_KEY='abc')
 
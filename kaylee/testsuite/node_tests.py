@@ -1,11 +1,22 @@
 from kaylee.testsuite import KayleeTest, load_tests
+import os
+import time
+import threading
+import multiprocessing
 from datetime import datetime, timedelta
 from kaylee import Node, NodeID
-from kaylee.node import extract_node_id
+from kaylee.node import (extract_node_id, node_key, NODE_ID_CACHE_SIZE,
+                         NODE_ID_BLOCK_SIZE, parse_score, _parse_hex)
 from kaylee import InvalidNodeIDError
 from kaylee.testsuite import TestController
 
 
+def _generate_ids(count):
+    #pylint: disable-msg=W0612
+    #W0612: Unused variable 'i'
+    return [NodeID().binary for i in range(count)]
+
+
 class NodeIDTests(KayleeTest):
     def setUp(self):
         pass
@@ -38,7 +49,9 @@ class NodeIDTests(KayleeTest):
         self.assertEqual(n, n2)
         node = Node(n)
         n3 = extract_node_id(node)
-        self.assertEqual(n, n3)
+        self.assertIs(n, n3)
+        # the parsed hex ids are cached
+        self.assertIs(extract_node_id(str(n)), n2)
         self.assertRaises(InvalidNodeIDError, extract_node_id, 'abc')
         self.assertRaises(TypeError, extract_node_id, 10)
         node = Node(n)
@@ -46,26 +59,73 @@ class NodeIDTests(KayleeTest):
         self.assertRaises(InvalidNodeIDError, extract_node_id, node)
 
     def test_internal_counter(self):
-        #pylint: disable-msg=W0612,W0212
+        #pylint: disable-msg=W0612
+        #W0612: Unused variable 'i'
+        ids = [NodeID().binary for i in range(NODE_ID_BLOCK_SIZE * 3)]
+        self.assertEqual(len(set(ids)), len(ids))
+        for nid in ids:
+            self.assertEqual(int.from_bytes(nid[4:7], 'big'),
+                             os.getpid() % 2**24)
+        # the counter is sequential within the thread's blocks
+        counters = [int.from_bytes(nid[7:], 'big') for nid in ids]
+        steps = [c2 - c1 for c1, c2 in zip(counters, counters[1:])]
+        self.assertTrue(steps.count(1) >= len(steps) - 3)
+
+    def test_threads_and_processes(self):
+        #pylint: disable-msg=W0612
         #W0612: Unused variable 'i'
-        #W0212: Access to a protected member _inc of a client class
-
-        ###
-        NodeID._inc = 0 # modified for test purposes only
-        remote = '127.0.0.1'
-        for i in range(0, 2**16 - 1):
-            n = NodeID.for_host(remote)
-        bid = bytearray(n.binary)
-        self.assertEqual(bid[4], 0xFF)
-        self.assertEqual(bid[5], 0xFE)
-
-        n = NodeID.for_host(remote)
-        bid = bytearray(n.binary)
-        self.assertEqual(bid[4], 0x0)
-        self.assertEqual(bid[5], 0x0)
+        count = 20000
+        results = []
+        def generate():
+            results.append([NodeID().binary for i in range(count)])
+        threads = [threading.Thread(target=generate) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ids = set()
+        for r in results:
+            ids.update(r)
+        self.assertEqual(len(ids), count * 8)
+
+        if hasattr(os, 'fork'):
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(4) as pool:
+                for r in pool.map(_generate_ids, [count] * 4):
+                    ids.update(r)
+            self.assertEqual(len(ids), count * 12)
+
+    def test_node_key(self):
+        n = NodeID()
+        self.assertIs(node_key(n), n.binary)
+        self.assertEqual(node_key(str(n)), n.binary)
+        self.assertEqual(node_key(n.binary), n.binary)
+        self.assertEqual(node_key(Node(n)), n.binary)
+        self.assertRaises(InvalidNodeIDError, node_key, 'abc')
+        self.assertRaises(InvalidNodeIDError, node_key, b'abc')
+        self.assertRaises(TypeError, node_key, 10)
+
+    def test_from_binary(self):
+        n1 = NodeID()
+        n2 = NodeID.from_binary(n1.binary)
+        self.assertEqual(n1, n2)
+        self.assertIs(n2.binary, n1.binary)
+        self.assertFalse(hasattr(n2, '__dict__'))
 
     def test_compare(self):
         self.assertLess(NodeID(), NodeID())
+        n1 = NodeID()
+        n2 = NodeID()
+        for other in (n2, str(n2), n2.binary):
+            self.assertNotEqual(n1, other)
+            self.assertLess(n1, other)
+            self.assertLessEqual(n1, other)
+            self.assertGreater(n2, n1.binary)
+            self.assertGreaterEqual(n2, str(n1))
+        self.assertEqual(n1, str(n1))
+        self.assertEqual(n1, n1.binary)
+        self.assertFalse(n1 != n1)
+        self.assertRaises(InvalidNodeIDError, n1.__eq__, 'abc')
 
     def test_parse(self):
         n1 = NodeID.for_host('127.0.0.1')
@@ -79,6 +139,14 @@ class NodeIDTests(KayleeTest):
         self.assertRaises(TypeError, NodeID, 123)
         self.assertRaises(InvalidNodeIDError, NodeID, 'abc')
         self.assertRaises(InvalidNodeIDError, NodeID, '1'*10)
+        self.assertRaises(InvalidNodeIDError, NodeID, 'z'*20)
+
+    def test_parse_cache(self):
+        ids = [str(NodeID()) for i in range(NODE_ID_CACHE_SIZE + 10)]
+        for nid in ids:
+            self.assertEqual(str(extract_node_id(nid)), nid)
+        # the cache is bounded
+        self.assertEqual(_parse_hex.cache_info().currsize, NODE_ID_CACHE_SIZE)
 
     def test_dates(self):
         n1 = NodeID.for_host('127.0.0.1')
@@ -143,6 +211,49 @@ class NodeTests(KayleeTest):
         self.assertTrue(timedelta(seconds = 0) <= now - node.task_timestamp
                         <= timedelta(seconds = 3))
         self.assertEqual(node.task_id, 'tid789')
+        self.assertEqual(node.task_ids, ('tid789', ))
+
+    def test_leased_tasks(self):
+        node = Node(NodeID.for_host('127.0.0.1'))
+        self.assertEqual(node.task_ids, ())
+
+        node.lease_tasks([1, 2, 3])
+        self.assertTrue(node.dirty)
+        self.assertEqual(node.task_ids, (1, 2, 3))
+        self.assertEqual(node.task_id, 3)
+
+        node.release_task(3)
+        self.assertEqual(node.task_ids, (1, 2))
+        self.assertEqual(node.task_id, 2)
+        node.release_task(1)
+        self.assertEqual(node.task_id, 2)
+        node.release_task(10)
+        self.assertEqual(node.task_ids, (2, ))
+
+        node.task_id = None
+        self.assertEqual(node.task_ids, ())
+
+    def test_score(self):
+        node = Node(NodeID.for_host('127.0.0.1'))
+        self.assertIsNone(node.score)
+        node.score = 120.0
+        self.assertEqual(Node.from_state(node.__getstate__()).score, 120.0)
+
+        self.assertEqual(parse_score('250'), 250.0)
+        self.assertEqual(parse_score(12.5), 12.5)
+        for invalid in [None, '', 'fast', '0', '-10', 'nan', 'inf', [1]]:
+            self.assertIsNone(parse_score(invalid))
+
+    def test_touch(self):
+        node = Node(NodeID.for_host('127.0.0.1'))
+        self.assertLessEqual(time.time() - node.last_activity, 1)
+        node.touch()
+        self.assertFalse(node.dirty)
+
+        node.last_activity -= 60
+        node.touch()
+        self.assertTrue(node.dirty)
+        self.assertLessEqual(time.time() - node.last_activity, 1)
 
 
 kaylee_suite = load_tests([NodeTests, NodeIDTests, ])
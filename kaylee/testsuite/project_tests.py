@@ -1,6 +1,7 @@
 from kaylee.testsuite import KayleeTest, load_tests
 from kaylee.project import Project, AUTO_PROJECT_MODE, MANUAL_PROJECT_MODE
-from kaylee.testsuite.helper import NonAbstractProject
+from kaylee.testsuite.helper import NonAbstractProject, NonAbstractRangeProject
+from kaylee.errors import SessionKeyNameError
 
 class ProjectTests(KayleeTest):
     def setUp(self):
@@ -31,6 +32,38 @@ class ProjectTests(KayleeTest):
                 super(MyProjectWithManualMode, self).__init__("/script.js", MANUAL_PROJECT_MODE)
         MyProjectWithManualMode()
 
+    def test_session_keys(self):
+        class MyProject(NonAbstractProject):
+            session_keys = ['#s1', '#s2']
+            def __init__(self):
+                super(MyProject, self).__init__("/script.js", AUTO_PROJECT_MODE)
+        self.assertEqual(MyProject().session_keys, ('#s1', '#s2'))
+        self.assertIsNone(NonAbstractProject("/script.js",
+                                             AUTO_PROJECT_MODE).session_keys)
+
+        # the invalid names are rejected when the project is loaded
+        for keys in [['s1'], ['#s-1'], ['#я1'], '#s1', [1]]:
+            MyProject.session_keys = keys
+            self.assertRaises(SessionKeyNameError, MyProject)
+
+    def test_range_project(self):
+        project = NonAbstractRangeProject(2500, task_size=1000)
+        task = project.next_task()
+        self.assertEqual(task, {'id' : '0-1000', 'start' : 0, 'stop' : 1000})
+        self.assertEqual(project.task_cost(task), 1000)
+        self.assertEqual(project.next_range(10)['id'], '1000-1010')
+        self.assertEqual(project.next_range(0)['id'], '1010-1011')
+        self.assertEqual(project.next_range(5000)['id'], '1011-2500')
+        self.assertIsNone(project.next_range(10))
+        self.assertIsNone(project.next_task())
+
+        self.assertEqual(project['1000-1010'],
+                         {'id' : '1000-1010', 'start' : 1000, 'stop' : 1010})
+        self.assertEqual(project.task_range('1000-1010'), (1000, 1010))
+        self.assertRaises(ValueError, project.task_range, '1000')
+        self.assertRaises(ValueError, NonAbstractRangeProject, 10,
+                          task_size=0)
+
     def test_is_abstract(self):
         self.assertRaises(TypeError, Project, '/script.ks', AUTO_PROJECT_MODE)
 
@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+import time
+import os
+import json
+import shutil
+import asyncio
+import sqlite3
+import tempfile
+import unittest
+import threading
+import multiprocessing
+
+from kaylee import loader
+from kaylee.testsuite import load_tests, TestController
+from kaylee.testsuite.helper import SubclassTestsBase
+from kaylee.node import Node, NodeID, NodesRegistry
+from kaylee.contrib.registries import (MemoryNodesRegistry, ArrayNodesRegistry,
+                                      ShardedNodesRegistry, SQLiteNodesRegistry,
+                                      SharedMemoryNodesRegistry)
+from kaylee.errors import KayleeError
+from kaylee.core import Applications
+from kaylee.aio import AsyncKaylee
+
+
+def _inactive_node(seconds):
+    """Returns a node which has been inactive for the given amount of
+    seconds."""
+    node = Node(NodeID())
+    node.last_activity = int(time.time() - seconds)
+    return node
+
+
+class NodesRegistryTestsBase(SubclassTestsBase):
+    def test_init(self):
+        reg = self.cls_instance()
+        self.assertIsInstance(reg, NodesRegistry)
+        self.assertEqual(len(reg), 0)
+
+    def test_add_get(self):
+        reg = self.cls_instance()
+        nodes = [Node(NodeID()) for i in range(self.MANY)]
+        for node in nodes:
+            reg.add(node)
+        self.assertEqual(len(reg), self.MANY)
+        for node in nodes:
+            self.assertIn(node, reg)
+            self.assertIn(node.id, reg)
+            self.assertIn(str(node.id), reg)
+            self.assertEqual(reg[node.id].id, node.id)
+            self.assertEqual(reg[str(node.id)].id, node.id)
+        self.assertNotIn(NodeID(), reg)
+        self.assertRaises(KeyError, reg.__getitem__, NodeID())
+
+    def test_update(self):
+        reg = self.cls_instance()
+        node = Node(NodeID())
+        reg.add(node)
+        ctrl = TestController.new_test_instance()
+        node = reg[node.id]
+        node.subscribe(ctrl)
+        node.lease_tasks(['t1', 't2'])
+        node.session_data = b'sd'
+        node.score = 250.5
+        reg.update(node)
+
+        node = reg[node.id]
+        self.assertIs(node.controller, ctrl)
+        self.assertEqual(node.score, 250.5)
+        self.assertEqual(node.task_ids, ('t1', 't2'))
+        self.assertEqual(node.task_id, 't2')
+        self.assertEqual(node.session_data, b'sd')
+        self.assertIsNotNone(node.subscription_timestamp)
+        self.assertIsNotNone(node.task_timestamp)
+
+        node.unsubscribe()
+        reg.update(node)
+        node = reg[node.id]
+        self.assertIsNone(node.controller)
+        self.assertIsNone(node.subscription_timestamp)
+        self.assertEqual(node.task_ids, ())
+
+        new_node = Node(NodeID())
+        new_node.dirty = True
+        self.assertRaises(KeyError, reg.update, new_node)
+
+    def test_delete(self):
+        reg = self.cls_instance()
+        nodes = [Node(NodeID()) for i in range(self.SOME)]
+        for node in nodes:
+            reg.add(node)
+        del reg[nodes[0]]
+        del reg[nodes[1].id]
+        del reg[str(nodes[2].id)]
+        self.assertEqual(len(reg), self.SOME - 3)
+        for node in nodes[:3]:
+            self.assertNotIn(node, reg)
+        for node in nodes[3:]:
+            self.assertIn(node, reg)
+        # deleting a missing node is silently ignored
+        del reg[nodes[0]]
+
+    def test_clean(self):
+        reg = self.cls_instance()
+        inactive = [_inactive_node(60) for i in range(self.SOME)]
+        active = [Node(NodeID()) for i in range(self.SOME)]
+        for node in inactive + active:
+            reg.add(node)
+        removed = reg.clean()
+        self.assertEqual(sorted(n.id for n in removed),
+                         sorted(n.id for n in inactive))
+        for node in inactive:
+            self.assertNotIn(node, reg)
+        for node in active:
+            self.assertIn(node, reg)
+        self.assertEqual(reg.clean(), [])
+
+    def test_clean_reactivated_node(self):
+        reg = self.cls_instance()
+        node = _inactive_node(60)
+        reg.add(node)
+        node = reg[node.id]
+        node.touch()
+        self.assertTrue(node.dirty)
+        reg.update(node)
+        self.assertEqual(reg.clean(), [])
+        self.assertIn(node, reg)
+
+        # a removed node does not affect cleaning
+        removed_node = _inactive_node(60)
+        reg.add(removed_node)
+        del reg[removed_node]
+        self.assertEqual(reg.clean(), [])
+
+    def registry_config(self):
+        return {'timeout' : '10s'}
+
+    def kaylee_settings(self):
+        test_settings = __import__('test_settings')
+        settings = {k : getattr(test_settings, k) for k in dir(test_settings)
+                    if k == k.upper()}
+        settings['REGISTRY'] = {'name' : self.cls.__name__,
+                                'config' : self.registry_config()}
+        return settings
+
+    def test_kaylee_communication(self):
+        kl = loader.load(self.kaylee_settings())
+        self.assertIsInstance(kl.registry, self.cls)
+        node_id = json.loads(kl.register('127.0.0.1'))['node_id']
+        kl.subscribe(node_id, 'test.1')
+        self.assertIsNotNone(kl.registry[node_id].controller)
+        action = json.loads(kl.get_action(node_id))
+        self.assertEqual(kl.registry[node_id].task_id, action['data']['id'])
+        action = json.loads(kl.accept_result(node_id, '{"res" : 1}'))
+        self.assertEqual(action['action'], 'task')
+        self.assertEqual(len(kl.applications['test.1'].permanent_storage), 1)
+        kl.unsubscribe(node_id)
+        self.assertIsNone(kl.registry[node_id].controller)
+
+
+class MemoryNodesRegistryTests(NodesRegistryTestsBase):
+    def test_is_abstract(self):
+        self.assertRaises(TypeError, NodesRegistry, '10s')
+
+    def cls_instance(self):
+        return MemoryNodesRegistry(timeout='10s')
+
+    def test_clean_removed_node(self):
+        # a node unregistered while clean() examines it
+        class RacingDict(dict):
+            def get(self, key, default=None):
+                node = dict.get(self, key, default)
+                self.pop(key, None)
+                return node
+        reg = self.cls_instance()
+        nodes = [_inactive_node(60) for i in range(self.SOME)]
+        for node in nodes:
+            reg.add(node)
+        reg._d = RacingDict(reg._d)
+        self.assertEqual(len(reg.clean()), self.SOME)
+        self.assertEqual(len(reg), 0)
+
+
+class ShardedNodesRegistryTests(NodesRegistryTestsBase):
+    def cls_instance(self):
+        return ShardedNodesRegistry(timeout='10s', shards=4)
+
+    def test_shards(self):
+        self.assertRaises(ValueError, ShardedNodesRegistry, '10s', shards=0)
+        reg = self.cls_instance()
+        for i in range(self.MANY):
+            reg.add(Node(NodeID()))
+        self.assertEqual(sum(len(s) for s in reg._shards), self.MANY)
+        self.assertTrue(all(len(s) > 0 for s in reg._shards))
+
+        reg = ShardedNodesRegistry('10s', shards=2,
+                                   shard_factory=ArrayNodesRegistry)
+        self.assertTrue(all(isinstance(s, ArrayNodesRegistry)
+                            for s in reg._shards))
+
+    def test_concurrent_access(self):
+        reg = self.cls_instance()
+        errors = []
+        def worker():
+            try:
+                for i in range(self.MANY):
+                    node = Node(NodeID())
+                    reg.add(node)
+                    node = reg[node.id]
+                    node.task_id = str(i)
+                    reg.update(node)
+                    if i % 2:
+                        del reg[node]
+                reg.clean()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(reg), 8 * (self.MANY // 2 + 1))
+
+
+class ArrayNodesRegistryTests(NodesRegistryTestsBase):
+    def cls_instance(self):
+        return ArrayNodesRegistry(timeout='10s')
+
+    def test_rows_reuse(self):
+        reg = self.cls_instance()
+        nodes = [Node(NodeID()) for i in range(self.SOME)]
+        for node in nodes:
+            reg.add(node)
+        for node in nodes:
+            del reg[node]
+        for node in nodes:
+            reg.add(node)
+        self.assertEqual(len(reg._ids), self.SOME)
+        self.assertEqual(len(reg), self.SOME)
+
+    def test_tables(self):
+        reg = self.cls_instance()
+        ctrl = TestController.new_test_instance()
+        for i in range(self.SOME):
+            node = Node(NodeID())
+            node.subscribe(ctrl)
+            reg.add(node)
+        # a controller is kept once in the controllers table
+        self.assertEqual(reg._controllers_table, [None, ctrl])
+        self.assertEqual(reg._codecs_table, ['json'])
+
+
+class SQLiteNodesRegistryTests(NodesRegistryTestsBase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='kl_unit_test__')
+        self.path = os.path.join(self.tmpdir, 'nodes.db')
+        self.registries = []
+        super(SQLiteNodesRegistryTests, self).setUp()
+
+    def tearDown(self):
+        for reg in self.registries:
+            reg.close()
+        shutil.rmtree(self.tmpdir)
+
+    def cls_instance(self, flush_interval=0):
+        # every test registry uses a new database
+        path = '{}.{}'.format(self.path, len(self.registries))
+        reg = SQLiteNodesRegistry(timeout='10s', path=path,
+                                  flush_interval=flush_interval)
+        self.registries.append(reg)
+        return reg
+
+    def registry_config(self):
+        return {'timeout' : '10s', 'path' : self.path}
+
+    def _rows_count(self, reg):
+        db = sqlite3.connect(reg.path)
+        try:
+            return db.execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+        finally:
+            db.close()
+
+    def test_write_behind(self):
+        reg = self.cls_instance(flush_interval=60)
+        nodes = [Node(NodeID()) for i in range(self.SOME)]
+        for node in nodes:
+            reg.add(node)
+            node = reg[node.id]
+            node.task_id = 'tid'
+            reg.update(node)
+        self.assertEqual(self._rows_count(reg), 0)
+        reg.flush()
+        self.assertEqual(self._rows_count(reg), self.SOME)
+
+        del reg[nodes[0]]
+        self.assertEqual(self._rows_count(reg), self.SOME)
+        reg.close()
+        self.assertEqual(self._rows_count(reg), self.SOME - 1)
+
+    def test_restart(self):
+        kl = loader.load(self.kaylee_settings())
+        node_id = json.loads(kl.register('127.0.0.1'))['node_id']
+        kl.subscribe(node_id, 'test.1')
+        task_id = json.loads(kl.get_action(node_id))['data']['id']
+        kl.registry.close()
+
+        kl = loader.load(self.kaylee_settings())
+        self.registries.append(kl.registry)
+        node = kl.registry[node_id]
+        self.assertIs(node.controller, kl.applications['test.1'])
+        self.assertEqual(node.task_id, task_id)
+        self.assertIsNotNone(node.subscription_timestamp)
+        action = json.loads(kl.get_action(node_id))
+        self.assertEqual(action['action'], 'task')
+
+        # the restored nodes refer to the asynchronous controllers
+        kl.registry.close()
+        kl = loader.load(self.kaylee_settings())
+        self.registries.append(kl.registry)
+        akl = AsyncKaylee.wrap(kl)
+        node = kl.registry[node_id]
+        self.assertIs(node.controller, akl.applications['test.1'])
+        loop = asyncio.new_event_loop()
+        try:
+            action = json.loads(loop.run_until_complete(
+                akl.get_action(node_id)))
+        finally:
+            loop.close()
+        self.assertEqual(action['action'], 'task')
+
+        # the application is not loaded after another restart
+        kl.registry.close()
+        reg = SQLiteNodesRegistry(timeout='10s', path=self.path)
+        self.registries.append(reg)
+        reg.bind(Applications.empty())
+        node = reg[node_id]
+        self.assertIsNone(node.controller)
+        self.assertEqual(node.task_ids, ())
+
+
+def _add_nodes(path, node_ids):
+    reg = SharedMemoryNodesRegistry(timeout='10s', path=path)
+    for node_id in node_ids:
+        reg.add(Node(NodeID(node_id)))
+    reg.close()
+
+
+class SharedMemoryNodesRegistryTests(NodesRegistryTestsBase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='kl_unit_test__')
+        self.path = os.path.join(self.tmpdir, 'nodes.shm')
+        self.registries = []
+        super(SharedMemoryNodesRegistryTests, self).setUp()
+
+    def tearDown(self):
+        for reg in self.registries:
+            reg.close()
+        shutil.rmtree(self.tmpdir)
+
+    def cls_instance(self, path=None, capacity=1024, record_size=256):
+        if path is None:
+            # every test registry uses a new file
+            path = '{}.{}'.format(self.path, len(self.registries))
+        reg = SharedMemoryNodesRegistry(timeout='10s', path=path,
+                                        capacity=capacity,
+                                        record_size=record_size)
+        self.registries.append(reg)
+        return reg
+
+    def registry_config(self):
+        return {'timeout' : '10s', 'path' : self.path}
+
+    def test_shared_file(self):
+        reg1 = self.cls_instance(self.path)
+        # the geometry of an existing file is used
+        reg2 = self.cls_instance(self.path, capacity=10)
+        self.assertEqual(reg2.capacity, 1024)
+        nodes = [Node(NodeID()) for i in range(self.SOME)]
+        for node in nodes:
+            reg1.add(node)
+        self.assertEqual(len(reg2), self.SOME)
+        for node in nodes:
+            self.assertIn(node, reg2)
+        del reg2[nodes[0]]
+        self.assertNotIn(nodes[0], reg1)
+        self.assertEqual(len(reg1), self.SOME - 1)
+
+    def test_open_addressing(self):
+        reg = self.cls_instance(capacity=4)
+        nodes = [Node(NodeID()) for i in range(4)]
+        for node in nodes:
+            reg.add(node)
+        self.assertRaises(KayleeError, reg.add, Node(NodeID()))
+        # the removed records are reused
+        del reg[nodes[1]]
+        del reg[nodes[2]]
+        reg.add(nodes[2])
+        reg.add(nodes[1])
+        for node in nodes:
+            self.assertIn(node, reg)
+        self.assertEqual(len(reg), 4)
+
+    def test_churn(self):
+        reg = self.cls_instance(capacity=64)
+        probes = []
+        offsets = reg._offsets
+        def counting_offsets(start=0):
+            for offset in offsets(start):
+                probes.append(offset)
+                yield offset
+        reg._offsets = counting_offsets
+
+        # the nodes are added and removed many times over the capacity
+        nodes = []
+        for i in range(2000):
+            node = Node(NodeID())
+            reg.add(node)
+            nodes.append(node)
+            if len(nodes) > 16:
+                del reg[nodes.pop(0)]
+        for node in nodes[:8]:
+            node.last_activity = int(time.time() - 60)
+            reg.add(node)
+        self.assertEqual(len(reg.clean()), 8)
+        self.assertEqual(len(reg), 8)
+        self.assertLessEqual(reg._removed_count(), reg._max_removed)
+        for node in nodes[8:]:
+            self.assertIn(node, reg)
+
+        # a lookup of a missing node does not scan the whole table
+        del probes[:]
+        for i in range(100):
+            self.assertNotIn(NodeID(), reg)
+        self.assertLess(len(probes), 100 * 8)
+
+    def test_record_size(self):
+        self.assertRaises(ValueError, self.cls_instance, record_size=21)
+        reg = self.cls_instance(record_size=64)
+        node = Node(NodeID())
+        node.session_data = b'x' * 64
+        self.assertRaises(KayleeError, reg.add, node)
+        self.assertNotIn(node, reg)
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'x' * 64)
+        self.assertRaises(KayleeError, SharedMemoryNodesRegistry,
+                          '10s', self.path)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'requires os.fork()')
+    def test_processes(self):
+        reg = self.cls_instance(self.path)
+        node_ids = [NodeID().binary for i in range(self.SOME)]
+        ctx = multiprocessing.get_context('fork')
+        process = ctx.Process(target=_add_nodes, args=(self.path, node_ids))
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(len(reg), self.SOME)
+        for node_id in node_ids:
+            self.assertIn(NodeID(node_id), reg)
+
+
+kaylee_suite = load_tests([
+    MemoryNodesRegistryTests,
+    ArrayNodesRegistryTests,
+    ShardedNodesRegistryTests,
+    SQLiteNodesRegistryTests,
+    SharedMemoryNodesRegistryTests,
+])
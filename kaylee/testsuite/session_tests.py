@@ -1,12 +1,21 @@
+import os
+import time
+import tempfile
 from copy import deepcopy
+from unittest import mock
 from kaylee.testsuite import KayleeTest, load_tests
 from kaylee.node import Node, NodeID
 from kaylee import KayleeError
-from kaylee.session import (_encrypt, _decrypt, ClientSessionDataManager,
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from kaylee.session import (_encrypt, _decrypt, _session_cipher, _sign,
+                            _unsign, ClientSessionDataManager,
+                            SignedSessionDataManager, SessionStore,
+                            ExternalSessionDataManager,
                             ServerSessionDataManager, PhonySessionDataManager,
                             SESSION_DATA_ATTRIBUTE, EncryptedSessionDataManager,
                             SessionDataManager,)
-from kaylee.errors import SessionKeyNameError
+from kaylee.errors import SessionKeyNameError, InvalidResultError
+from kaylee.testsuite import TestController
 
 class KayleeSessionTests(KayleeTest):
     def test_encrypt_decrypt(self):
@@ -32,6 +41,40 @@ class KayleeSessionTests(KayleeTest):
         d4_d = _decrypt(s4, 'abc')
         self.assertEqual(d4, d4_d)
 
+        # a forged ciphertext or another key
+        s5 = s1[:-4] + ('AAAA' if s1[-4:] != 'AAAA' else 'BBBB')
+        self.assertRaises(KayleeError, _decrypt, s5, 'abc')
+        self.assertRaises(KayleeError, _decrypt, s1, 'abd')
+        self.assertRaises(KayleeError, _decrypt, '2.abc', 'abc')
+        # the nonces are not reused
+        self.assertNotEqual(_encrypt(d1, 'abc'), _encrypt(d1, 'abc'))
+
+    def test_session_cipher(self):
+        # the data is encrypted by the standard AES-GCM
+        cipher = _session_cipher('abc')
+        self.assertIs(cipher, _session_cipher('abc'))
+        for length in [0, 1, 16, 100, 5000]:
+            data = bytes(i % 251 for i in range(length))
+            buf = cipher.encrypt(data)
+            self.assertEqual(len(buf), 12 + length + 16)
+            gcm = Cipher(algorithms.AES(cipher._encryption_key),
+                         modes.GCM(buf[:12], buf[-16:])).decryptor()
+            self.assertEqual(gcm.update(buf[12:-16]) + gcm.finalize(), data)
+            self.assertEqual(cipher.decrypt(buf), data)
+            # a modified ciphertext is rejected
+            forged = buf[:12] + bytes([buf[12] ^ 1]) + buf[13:]
+            self.assertRaises(KayleeError, cipher.decrypt, forged)
+
+    def test_decrypt_legacy_format(self):
+        # encrypted by the previous (AES-CBC, HMAC-SHA1) implementation
+        s1 = ('5a/P0BtUnAfXjeJCrHF05+tHAYA=?uSuglXwZSD1b6ir0maV8HQ==&'
+              'xtWUUScQX7xEQs3DhhYwByK5FG6vO5IapfaehV9EWCfTMWuYyS8dEW2v'
+              'DFveE/m31Y7qmW8n4D+W82/7cA3NgQ==')
+        self.assertEqual(_decrypt(s1, 'abc'), {'#s1': 10, '#s2': [1, 2, 3]})
+        self.assertRaises(KayleeError, _decrypt, s1[3:], 'abc')
+        self.assertRaises(KayleeError, _decrypt, s1, 'abd')
+        self.assertRaises(KayleeError, _decrypt, 'abc', 'abc')
+
     def test_session_errors(self):
         # test for unicode characters in encrypted data
         derr = [
@@ -41,6 +84,36 @@ class KayleeSessionTests(KayleeTest):
         for d in derr:
             self.assertRaises(SessionKeyNameError, SessionDataManager.get_session_data, d)
 
+    def test_declared_session_keys(self):
+        task = {'id' : 'i1', '#s1' : 10, '#s2' : 20, '#s-3' : 30}
+        get_session_data = SessionDataManager.get_session_data
+        self.assertRaises(SessionKeyNameError, get_session_data, task)
+        # only the declared keys are looked up
+        self.assertEqual(get_session_data({'id' : 'i1', '#s1' : 10},
+                                          ('#s1', '#s4')),
+                         {'#s1' : 10})
+        # the undeclared keys are rejected, even the invalid ones
+        self.assertRaises(SessionKeyNameError, get_session_data, task,
+                          ('#s1', '#s2'))
+        self.assertRaises(SessionKeyNameError, get_session_data, task,
+                          ('#s1', '#s-3'))
+
+        app = TestController.new_test_instance()
+        app.project.session_keys = ('#s1', )
+        node = Node(NodeID())
+        node.subscribe(app)
+        self.assertEqual(SessionDataManager.declared_session_keys(node),
+                         ('#s1', ))
+        for manager in [ServerSessionDataManager(),
+                        ClientSessionDataManager('abc'),
+                        SignedSessionDataManager('abc')]:
+            task_copy = dict(task)
+            self.assertRaises(SessionKeyNameError, manager.store, node,
+                              task_copy)
+        task = {'id' : 'i1', '#s1' : 10}
+        ServerSessionDataManager().store(node, task)
+        self.assertEqual(task, {'id' : 'i1'})
+
     def test_node_session_data_manager(self):
         node = Node(NodeID.for_host('127.0.0.1'))
         task = {
@@ -125,6 +198,154 @@ class KayleeSessionTests(KayleeTest):
         self.assertIsInstance(jsdm2, EncryptedSessionDataManager)
         self.assertEqual(len(jsdm2.secret_key), (len('abc')))
 
+    def test_sign_unsign(self):
+        d1 = {'#f1' : 'val1', '#f2' : [20, None, 'значение']}
+        s1 = _sign(d1, 'abc')
+        self.assertEqual(_unsign(s1, 'abc'), d1)
+
+        payload, signature = s1.split('.')
+        forged = _sign({'#f1' : 'val2', '#f2' : 20}, 'abc').split('.')[0]
+        self.assertRaises(KayleeError, _unsign, forged + '.' + signature,
+                          'abc')
+        self.assertRaises(KayleeError, _unsign, s1, 'abd')
+        self.assertRaises(KayleeError, _unsign, payload, 'abc')
+        self.assertRaises(KayleeError, _unsign, 123, 'abc')
+        # the data must be JSON-serializable
+        self.assertRaises(KayleeError, _sign, {'#f1' : {1, 2}}, 'abc')
+
+    def test_signed_session_data_manager(self):
+        node = Node(NodeID.for_host('127.0.0.1'))
+        task = {
+            'id' : 'i1',
+            '#s1' : 10,
+            '#s2' : [1, 2, 3],
+        }
+
+        ssdm = SignedSessionDataManager(secret_key='abc')
+        ssdm.store(node, task)
+        self.assertEqual(set(task), {'id', SESSION_DATA_ATTRIBUTE})
+        self.assertIsNone(node.session_data)
+
+        result = {
+            'res' : 'someres',
+            SESSION_DATA_ATTRIBUTE : task[SESSION_DATA_ATTRIBUTE],
+        }
+        ssdm.restore(node, result)
+        self.assertEqual(result, {'res' : 'someres', '#s1' : 10,
+                                  '#s2' : [1, 2, 3]})
+
+        task = {'id' : 'i2'}
+        ssdm.store(node, task)
+        self.assertEqual(task, {'id' : 'i2'})
+        ssdm.restore(node, task)
+        self.assertEqual(task, {'id' : 'i2'})
+
+    def test_session_data_managers_round_trip(self):
+        # the throughput of the managers is compared by
+        # benchmarks/session_benchmark.py
+        for manager in [SignedSessionDataManager('abc'),
+                        ClientSessionDataManager('abc')]:
+            node = Node(NodeID())
+            attr = manager.SESSION_DATA_ATTRIBUTE
+            for i in range(100):
+                task = {'id' : str(i), '#n' : i, '#p' : [i, i + 1]}
+                manager.store(node, task)
+                self.assertEqual(set(task), {'id', attr})
+                result = {'res' : i, attr : task[attr]}
+                manager.restore(node, result)
+                self.assertEqual(result, {'res' : i, '#n' : i,
+                                          '#p' : [i, i + 1]})
+
+    def test_session_store(self):
+        store = SessionStore(max_size=1000, ttl='10s')
+        n1, n2 = NodeID(), NodeID()
+        store.put(n1, 't1', {'#s' : 1})
+        store.put(n2, 't1', {'#s' : 2})
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.pop(n1, 't1'), {'#s' : 1})
+        self.assertIsNone(store.pop(n1, 't1'))
+        self.assertEqual(store.pop(str(n2), 't1'), {'#s' : 2})
+        self.assertEqual(store.size, 0)
+
+        # the least recently stored entries are evicted
+        for i in range(20):
+            store.put(n1, str(i), {'#s' : 'x' * 100})
+        self.assertLessEqual(store.size, 1000)
+        self.assertLess(len(store), 20)
+        self.assertIsNone(store.pop(n1, '0'))
+        self.assertEqual(store.pop(n1, '19'), {'#s' : 'x' * 100})
+
+        # the expired entries are reclaimed
+        later = time.time() + 11
+        with mock.patch('kaylee.session.time.time', lambda: later):
+            self.assertIsNone(store.pop(n1, '18'))
+            store.put(n2, 't2', {'#s' : 3})
+        self.assertEqual(len(store), 1)
+
+    def test_session_store_spill(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'sessions.db')
+            store = SessionStore(max_size=1000, ttl='10s', spill_path=path)
+            n1 = NodeID()
+            for i in range(20):
+                store.put(n1, str(i), {'#s' : 'x' * 100})
+            self.assertLess(len(store), 20)
+            # the evicted entries are restored from the disk
+            for i in range(20):
+                self.assertEqual(store.pop(n1, str(i)), {'#s' : 'x' * 100})
+            self.assertIsNone(store.pop(n1, '0'))
+
+            store.put(n1, 'big', {'#s' : 'x' * 2000})
+            later = time.time() + 11
+            with mock.patch('kaylee.session.time.time', lambda: later):
+                self.assertIsNone(store.pop(n1, 'big'))
+            store.close()
+
+    def test_external_session_data_manager(self):
+        node = Node(NodeID.for_host('127.0.0.1'))
+        esdm = ExternalSessionDataManager(ttl='1m')
+        tasks = [{'id' : 't1', '#s1' : 1}, {'id' : 't2', '#s1' : 2}]
+        attr = esdm.SESSION_DATA_ATTRIBUTE
+        for task in tasks:
+            esdm.store(node, task)
+        self.assertEqual(tasks, [{'id' : 't1', attr : 1},
+                                 {'id' : 't2', attr : 1}])
+        self.assertIsNone(node.session_data)
+        self.assertFalse(node.dirty)
+
+        # the session data of the batched tasks is kept separately
+        node.lease_tasks(['t1', 't2'])
+        node.select_task('t1')
+        result = {'res' : 1, attr : 1}
+        esdm.restore(node, result)
+        self.assertEqual(result, {'res' : 1, '#s1' : 1})
+        node.select_task('t2')
+        result = {'res' : 2, attr : 1}
+        esdm.restore(node, result)
+        self.assertEqual(result, {'res' : 2, '#s1' : 2})
+
+        # no session data
+        result = {'res' : 3}
+        esdm.restore(node, result)
+        self.assertEqual(result, {'res' : 3})
+
+        # the session data has expired
+        task = {'id' : 't3', '#s1' : 3}
+        esdm.store(node, task)
+        node.lease_tasks(['t3'])
+        later = time.time() + 61
+        with mock.patch('kaylee.session.time.time', lambda: later):
+            self.assertRaises(InvalidResultError, esdm.restore, node,
+                              {'res' : 3, attr : 1})
+
+        # the session data has been evicted
+        esdm = ExternalSessionDataManager(max_size=100)
+        for i in range(10):
+            esdm.store(node, {'id' : str(i), '#s1' : 'x' * 50})
+        node.lease_tasks(['0'])
+        self.assertRaises(InvalidResultError, esdm.restore, node,
+                          {'res' : 0, attr : 1})
+
     def test_phony_session_data_manager(self):
         node = Node(NodeID.for_host('127.0.0.1'))
         task1 = {
@@ -230,6 +230,7 @@ class TemporalStorageTestsBase(SubclassTestsBase):
         # test nodes count
         nodes = set(n for n, r in ts.values())
         self.assertEqual(len(nodes), 2 * self.MANY)
+        self.assertTrue(all(isinstance(n, NodeID) for n in nodes))
 
     def test_keys_and_iter(self):
         def _basic_ki_test(ts, count):
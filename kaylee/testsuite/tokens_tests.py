@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import time
+from datetime import timedelta
+
+from kaylee.testsuite import KayleeTest, load_tests, TestController
+from kaylee import Node, NodeID, InvalidNodeTokenError
+from kaylee.core import Applications
+from kaylee.tokens import NodeTokens, is_node_token
+
+
+class NodeTokensTests(KayleeTest):
+    def setUp(self):
+        self.tokens = NodeTokens('Some secret key 1234567890',
+                                 timedelta(minutes=1))
+        self.app = TestController.new_test_instance()
+        self.applications = Applications([self.app])
+
+    def _subscribed_node(self):
+        node = Node(NodeID())
+        node.codec = 'msgpack'
+        node.subscribe(self.app)
+        node.task_id = 't1'
+        node.session_data = b'\x00\xffsession'
+        node.score = 250.0
+        return node
+
+    def test_dumps_loads(self):
+        node = self._subscribed_node()
+        token = self.tokens.dumps(node)
+        self.assertTrue(is_node_token(token))
+        self.assertFalse(is_node_token(str(node.id)))
+        self.assertTrue(token.startswith(str(node.id)))
+
+        restored = self.tokens.loads(token, self.applications)
+        self.assertEqual(restored.id, node.id)
+        self.assertEqual(restored.codec, 'msgpack')
+        self.assertIs(restored.controller, self.app)
+        self.assertEqual(restored.task_id, 't1')
+        self.assertEqual(restored.task_ids, ('t1', ))
+        self.assertEqual(restored.session_data, b'\x00\xffsession')
+        self.assertEqual(restored.score, 250.0)
+        self.assertEqual(restored.subscription_timestamp,
+                         node.subscription_timestamp)
+        self.assertEqual(restored.last_activity, node.last_activity)
+
+        node.lease_tasks(('t1', 't2'))
+        restored = self.tokens.loads(self.tokens.dumps(node),
+                                     self.applications)
+        self.assertEqual(restored.task_ids, ('t1', 't2'))
+
+        # an unsubscribed node
+        node = Node(NodeID())
+        restored = self.tokens.loads(self.tokens.dumps(node),
+                                     self.applications)
+        self.assertIsNone(restored.controller)
+        self.assertEqual(restored.task_ids, ())
+
+    def test_invalid_tokens(self):
+        token = self.tokens.dumps(self._subscribed_node())
+        node_id, state, signature = token.split('.')
+
+        forged = '{}.{}.{}'.format(NodeID(), state, signature)
+        self.assertRaises(InvalidNodeTokenError, self.tokens.loads, forged,
+                          self.applications)
+        forged = '{}.{}.{}'.format(node_id, state[:-2], signature)
+        self.assertRaises(InvalidNodeTokenError, self.tokens.loads, forged,
+                          self.applications)
+        for invalid in ['', '.', token + '.', 'abc.def.ghi']:
+            self.assertRaises(InvalidNodeTokenError, self.tokens.loads,
+                              invalid, self.applications)
+
+        # a token signed by another key
+        other = NodeTokens('Another secret key 1234567890',
+                           timedelta(minutes=1))
+        self.assertRaises(InvalidNodeTokenError, other.loads, token,
+                          self.applications)
+
+    def test_expiry(self):
+        node = self._subscribed_node()
+        node.last_activity = time.time() - 61
+        self.assertRaises(InvalidNodeTokenError, self.tokens.loads,
+                          self.tokens.dumps(node), self.applications)
+
+    def test_missing_application(self):
+        token = self.tokens.dumps(self._subscribed_node())
+        node = self.tokens.loads(token, Applications.empty())
+        self.assertIsNone(node.controller)
+        self.assertIsNone(node.task_id)
+        self.assertIsNone(node.subscription_timestamp)
+
+    def test_session_data_type(self):
+        node = self._subscribed_node()
+        node.session_data = {'key' : 'value'}
+        self.assertRaises(TypeError, self.tokens.dumps, node)
+
+
+kaylee_suite = load_tests([NodeTokensTests])
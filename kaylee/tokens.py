@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+    kaylee.tokens
+    ~~~~~~~~~~~~~
+
+    Implements the signed node tokens used in the stateless mode (see
+    :config:`NODE_TOKENS`), in which the state of a node is carried by
+    the node itself instead of being kept in the nodes registry.
+
+    :copyright: (c) 2013 by Zaur Nasibov.
+    :license: MIT, see LICENSE for more details.
+"""
+import hmac
+import json
+import time
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from hashlib import sha256
+
+from .node import Node, NodeID
+from .errors import InvalidNodeTokenError, InvalidNodeIDError
+
+#: Separates the parts of a node token.
+NODE_TOKEN_SEPARATOR = '.'
+
+
+def is_node_token(node_id):
+    """Checks whether the node id received from a node is a token."""
+    return isinstance(node_id, str) and NODE_TOKEN_SEPARATOR in node_id
+
+
+class NodeTokens(object):
+    """Serializes the state of a node into a compact signed token::
+
+      <node id>.<state>.<signature>
+
+    where <node id> is the hex node id, <state> is the base64-encoded
+    (URL-safe alphabet) JSON list of the node's fields and <signature> is
+    the truncated HMAC-SHA256 of the preceding parts. The token is a valid
+    URL path segment. The controller of the node is referred to by the
+    application name.
+
+    The tokens are not encrypted: the node can read but not modify its
+    state.
+
+    :param secret_key: the key used to sign the tokens.
+    :param timeout: the tokens of the nodes which have been inactive for
+                    longer are rejected (usually the nodes registry
+                    timeout).
+    :type secret_key: str
+    :type timeout: :class:`datetime.timedelta`
+    """
+    #: The length of the signature in bytes.
+    SIGNATURE_LENGTH = 16
+
+    def __init__(self, secret_key, timeout):
+        # the tokens key differs from the other keys derived
+        # from the secret key
+        self._key = sha256(b'kaylee.tokens|' +
+                           secret_key.encode('utf-8')).digest()
+        self.timeout = timeout
+        self._encode = json.JSONEncoder(separators=(',', ':')).encode
+        self._decode = json.JSONDecoder().decode
+
+    def dumps(self, node):
+        """Returns the token of the node."""
+        (node_id, codec, controller, session_data, task_id, task_ids,
+         subscription_timestamp, task_timestamp,
+         last_activity, score) = node.__getstate__()
+        if session_data is not None:
+            if not isinstance(session_data, bytes):
+                raise TypeError('Node session data must be bytes in the '
+                                'stateless mode, not {}'
+                                .format(type(session_data).__name__))
+            session_data = _b64encode(session_data)
+        # the usual single leased task is not repeated
+        if task_ids == ((task_id, ) if task_id is not None else ()):
+            task_ids = None
+        state = [codec,
+                 controller.name if controller is not None else None,
+                 session_data, task_id, task_ids,
+                 subscription_timestamp, task_timestamp, last_activity,
+                 score]
+        signed = '{}.{}'.format(node_id,
+                                _b64encode(self._encode(state).encode()))
+        return '{}.{}'.format(signed, self._sign(signed))
+
+    def loads(self, token, applications):
+        """Verifies the token and returns the :class:`Node` restored from
+        it. A node subscribed to an application which is not loaded is
+        returned unsubscribed.
+
+        :param applications: the applications to which the nodes may be
+                             subscribed.
+        :type applications: :class:`kaylee.core.Applications`
+        :raises InvalidNodeTokenError: if the token is malformed, forged
+                                       or expired.
+        """
+        signed, _, signature = token.rpartition(NODE_TOKEN_SEPARATOR)
+        if not hmac.compare_digest(self._sign(signed), signature):
+            raise InvalidNodeTokenError('signature verification failed')
+        try:
+            hex_id, state = signed.split(NODE_TOKEN_SEPARATOR)
+            node_id = NodeID(hex_id)
+            state = self._decode(_b64decode(state).decode())
+            (codec, app_name, session_data, task_id, task_ids,
+             subscription_timestamp, task_timestamp,
+             last_activity, score) = state
+        except (ValueError, InvalidNodeIDError):
+            raise InvalidNodeTokenError('malformed token')
+
+        #pylint: disable-msg=E1101
+        #E1101: Instance of 'timedelta' has no 'total_seconds' member
+        if last_activity < time.time() - self.timeout.total_seconds():
+            raise InvalidNodeTokenError('the token has expired')
+
+        if session_data is not None:
+            session_data = _b64decode(session_data)
+        if task_ids is None:
+            task_ids = (task_id, ) if task_id is not None else ()
+        controller = None
+        if app_name is not None:
+            if app_name in applications:
+                controller = applications[app_name]
+            else:
+                task_id, task_ids = None, ()
+                subscription_timestamp = task_timestamp = None
+        return Node.from_state((node_id, codec, controller, session_data,
+                                task_id, tuple(task_ids),
+                                subscription_timestamp, task_timestamp,
+                                last_activity, score))
+
+    def _sign(self, signed):
+        mac = hmac.new(self._key, signed.encode(), sha256)
+        return _b64encode(mac.digest()[:self.SIGNATURE_LENGTH])
+
+
+def _b64encode(data):
+    return urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(s):
+    return urlsafe_b64decode(s + '=' * (-len(s) % 4))
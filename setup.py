@@ -76,8 +76,12 @@ setup(
     install_requires=[
         'Werkzeug>=0.9.1',
         'Jinja2>=2.7',
-        'pycrypto>=2.6',
+        'cryptography>=2.0',
     ],
+    extras_require={
+        'msgpack': ['msgpack>=0.6'],
+        'cbor': ['cbor2>=4.0'],
+    },
 
     test_suite='kaylee.testsuite.suite',
 